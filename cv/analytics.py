@@ -0,0 +1,266 @@
+import collections
+import threading
+import numpy as np
+
+# Keypoint order of the alwaysai/human-pose results
+KEYPOINT_NAMES = (
+        'Nose', 'Neck', 'Right Shoulder', 'Right Elbow', 'Right Wrist',
+        'Left Shoulder', 'Left Elbow', 'Left Wrist', 'Right Hip',
+        'Right Knee', 'Right Ankle', 'Left Hip', 'Left Knee', 'Left Ankle',
+        'Right Eye', 'Left Eye', 'Right Ear', 'Left Ear')
+
+_NECK = KEYPOINT_NAMES.index('Neck')
+_HIPS = [KEYPOINT_NAMES.index('Right Hip'), KEYPOINT_NAMES.index('Left Hip')]
+
+
+class Exercise:
+    """
+    A repetition of the angle at a joint, measured on both sides.
+
+    A rep goes from `rest_angle` past `peak_angle` and back. The peak can be
+    below the rest angle, like the knee in a squat, or above it, like the
+    shoulder in a lateral raise.
+
+    :type joints: tuple
+    :param joints: Three keypoint names without their side, the angle is
+                   measured at the middle one.
+    :type rest_angle: float
+    :param rest_angle: The angle in degrees a rep starts and ends past.
+    :type peak_angle: float
+    :param peak_angle: The angle in degrees a rep must reach.
+    :type posture: string
+    :param posture: 'upright' or 'horizontal' to only count reps with the
+                    torso in that posture, any posture when None.
+    """
+    def __init__(self, joints, rest_angle, peak_angle, posture=None):
+        self.joints = joints
+        self.rest_angle = rest_angle
+        self.peak_angle = peak_angle
+        self.posture = posture
+
+
+EXERCISES = {
+        'squat': Exercise(('Hip', 'Knee', 'Ankle'), 160, 100, 'upright'),
+        'pushup': Exercise(
+            ('Shoulder', 'Elbow', 'Wrist'), 155, 95, 'horizontal'),
+        'curl': Exercise(('Shoulder', 'Elbow', 'Wrist'), 140, 60, 'upright'),
+        'lateral_raise': Exercise(
+            ('Hip', 'Shoulder', 'Elbow'), 30, 75, 'upright')
+        }
+
+
+class _RepCounter:
+    """
+    State of one exercise for one person, updated in constant time.
+
+    The phase goes from 'rest' through 'to_peak', 'peak' and 'to_rest' back
+    to 'rest', which counts a rep. Turning back before the peak does not.
+    """
+    def __init__(self, exercise, rate_window):
+        self._exercise = exercise
+        self._rate_window = rate_window
+        self._rep_times = collections.deque()
+        self._rep_start = None
+        self._depth = 0.0
+        self.reps = 0
+        self.phase = 'rest'
+        self.last_rep_time = None
+        self.last_depth = None
+
+    def update(self, timestamp, angle, prev_progress):
+        """
+        Advance the phase with a new angle.
+
+        :returns: The progress from rest (0) to peak (1), and whether the
+                  reps or the phase changed.
+        """
+        ex = self._exercise
+        progress = (ex.rest_angle - angle) / (ex.rest_angle - ex.peak_angle)
+        phase = self.phase
+        if progress <= 0:
+            if phase in ('peak', 'to_rest'):
+                self.reps += 1
+                self.last_rep_time = timestamp - self._rep_start
+                self.last_depth = self._depth
+                self._rep_times.append(timestamp)
+            phase = 'rest'
+        else:
+            if phase == 'rest':
+                self._rep_start = timestamp
+                self._depth = 0.0
+            if progress >= 1:
+                phase = 'peak'
+            elif phase in ('rest', 'to_peak'):
+                phase = 'to_peak'
+            elif prev_progress is not None and progress < prev_progress:
+                phase = 'to_rest'
+
+        self._depth = max(self._depth, progress)
+        # Reps outside the window leave it in the order they were added
+        while (len(self._rep_times) > 0 and
+                self._rep_times[0] < timestamp - self._rate_window):
+            self._rep_times.popleft()
+
+        changed = phase != self.phase
+        self.phase = phase
+        return progress, changed
+
+    def get_state(self):
+        """
+        Return the reps, phase, reps per minute, and the duration and depth
+        of the last rep. A depth of 1 reached the peak angle exactly.
+        """
+        state = {
+                'reps': self.reps,
+                'phase': self.phase,
+                'rate': round(
+                    len(self._rep_times) * 60.0 / self._rate_window, 1),
+                'last_rep_time': None,
+                'last_depth': None
+                }
+        if self.reps > 0:
+            state['last_rep_time'] = round(self.last_rep_time, 2)
+            state['last_depth'] = round(self.last_depth, 2)
+        return state
+
+
+class WorkoutAnalytics:
+    """
+    Count the reps of each tracked person from their pose keypoints.
+
+    Each update smooths the keypoints with an exponential moving average,
+    computes the joint angle of every exercise on both sides as one NumPy
+    operation over all people, and advances a small state machine per
+    person and exercise. Nothing is rescanned, so an update costs the same
+    however long the workout has been going. The rep rate covers the last
+    `rate_window` seconds.
+
+    :type exercises: list
+    :param exercises: Names of the :data:`EXERCISES` to count.
+    :type smoothing: float
+    :param smoothing: Weight of the new keypoints in the moving average,
+                      1 for no smoothing.
+    :type rate_window: float
+    :param rate_window: Seconds of reps the rate is computed over.
+    :type timeout: float
+    :param timeout: Seconds after which a person no longer tracked is
+                    removed.
+    """
+    def __init__(
+            self, exercises=None, smoothing=0.5, rate_window=60.0,
+            timeout=10.0):
+        self._names = list(exercises or EXERCISES)
+        self._smoothing = smoothing
+        self._rate_window = rate_window
+        self._timeout = timeout
+        # Keypoint indexes of the three joints per exercise and side
+        self._joints = np.array([
+            [[KEYPOINT_NAMES.index('{} {}'.format(side, joint))
+              for joint in EXERCISES[name].joints]
+             for side in ('Right', 'Left')]
+            for name in self._names])
+        self._people = {}
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def _angles(self, points):
+        """Return the joint angles, shape (people, exercises)."""
+        a = points[:, self._joints[..., 0]]
+        b = points[:, self._joints[..., 1]]
+        c = points[:, self._joints[..., 2]]
+        ba = a - b
+        bc = c - b
+        cos = (ba * bc).sum(axis=-1) / (
+                np.linalg.norm(ba, axis=-1) * np.linalg.norm(bc, axis=-1))
+        angles = np.degrees(np.arccos(np.clip(cos, -1, 1)))
+        # Mean of the sides where all three joints are visible
+        visible = ~np.isnan(angles)
+        counts = visible.sum(axis=-1)
+        angles[~visible] = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, angles.sum(axis=-1) / counts, np.nan)
+
+    def _postures(self, points):
+        """Return 'upright' or 'horizontal' per person, None if unknown."""
+        hips = points[:, _HIPS]
+        visible = ~np.isnan(hips[..., 0])
+        hips[~visible] = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hip = hips.sum(axis=1) / visible.sum(axis=1)[:, None]
+        torso = hip - points[:, _NECK]
+        upright = np.abs(torso[:, 1]) >= np.abs(torso[:, 0])
+        known = ~np.isnan(torso).any(axis=1)
+        return [('upright' if u else 'horizontal') if k else None
+                for u, k in zip(upright.tolist(), known.tolist())]
+
+    def update(self, timestamp, tracks):
+        """
+        Add the keypoints of the tracked people in a frame.
+
+        :type tracks: dictionary
+        :param tracks: Track ids to keypoint arrays of shape (keypoints, 2)
+                       in :data:`KEYPOINT_NAMES` order, NaN where not
+                       detected, as from :func:`tracker.pose_points`.
+        """
+        changed = False
+        ids = [i for i, p in tracks.items() if len(p) == len(KEYPOINT_NAMES)]
+        if len(ids) > 0:
+            points = np.stack([tracks[i] for i in ids])
+            previous = np.stack([
+                self._people[i]['points'] if i in self._people else points[n]
+                for n, i in enumerate(ids)])
+            # Joints missing from either side of the average take the other
+            smoothed = np.where(
+                    np.isnan(previous), points,
+                    np.where(np.isnan(points), previous,
+                             previous + self._smoothing * (
+                                 points - previous)))
+            angles = self._angles(smoothed)
+            postures = self._postures(smoothed)
+
+        with self._lock:
+            for n, person_id in enumerate(ids):
+                person = self._people.get(person_id)
+                if person is None:
+                    person = {
+                            'counters': [
+                                _RepCounter(EXERCISES[name], self._rate_window)
+                                for name in self._names],
+                            'progress': [None] * len(self._names)
+                            }
+                    self._people[person_id] = person
+                    changed = True
+                person['points'] = smoothed[n]
+                person['seen'] = timestamp
+                for e, counter in enumerate(person['counters']):
+                    exercise = EXERCISES[self._names[e]]
+                    angle = float(angles[n, e])
+                    if np.isnan(angle) or (
+                            exercise.posture is not None and
+                            postures[n] != exercise.posture):
+                        continue
+                    progress, counter_changed = counter.update(
+                            timestamp, angle, person['progress'][e])
+                    person['progress'][e] = progress
+                    changed = changed or counter_changed
+
+            for person_id in list(self._people):
+                if timestamp - self._people[person_id]['seen'] > self._timeout:
+                    del self._people[person_id]
+                    changed = True
+
+            if changed:
+                self.version += 1
+
+    def get_state(self):
+        """Return the counts of each person as an `update_workout` message."""
+        with self._lock:
+            people = []
+            for person_id, person in sorted(self._people.items()):
+                people.append({
+                    'id': person_id,
+                    'exercises': {
+                        name: counter.get_state() for name, counter in zip(
+                            self._names, person['counters'])}
+                    })
+            return {'version': self.version, 'people': people}
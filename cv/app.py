@@ -1,66 +1,237 @@
 import time
+import queue
+import argparse
 import edgeiq
-import socketio
-import os
-import cv2
-import base64
-import time
+from client import ServerComm
+from quality import StreamQualityController
+from pipeline import Pipeline
+from previews import PreviewWorker
+from motion import MotionGate
+from recording import EventRecorder
+from analytics import WorkoutAnalytics, EXERCISES
+from fmp4 import Fmp4Encoder
+from encoder import FrameEncoder, BACKENDS, SUBSAMPLING
+from inference import AsyncInference
+from supervisor import CameraSupervisor, parse_camera
 
-class ServerComm:
-    def __init__(self):
-        self._sio = socketio.Client()
-        self._max_image_width = 640
-        self._max_image_height = 480
-
-    def setup(self):
-        print('[INFO] Connecting to server...')
-        self._sio.connect(
-                'http://10.19.191.50:5000', namespaces=['/cv'])
-        print('[INFO] Successfully connected to server.')
-        time.sleep(1)
-
-    def send_frame(self, frame):
-        frame = edgeiq.resize(
-                frame, width=self._max_image_width,
-                height=self._max_image_height, keep_scale=True)
-
-        # Encode frame as jpeg
-        frame = cv2.imencode('.jpg', frame)[1].tobytes()
-        # Encode frame in base64 representation and remove
-        # utf-8 encoding
-        frame = base64.b64encode(frame).decode('utf-8')
-        frame = "data:image/jpeg;base64,{}".format(frame)
-        self._sio.emit('cv-cmd', {'cmd': 'update_frame', 'data': frame})
-
-    def close(self):
-        self._sio.disconnect()
-
-
-def main():
-    pose_estimator = edgeiq.PoseEstimation("alwaysai/human-pose")
-    pose_estimator.load(
-            engine=edgeiq.Engine.DNN_OPENVINO,
-            accelerator=edgeiq.Accelerator.MYRIAD)
-
-    print("Loaded model:\n{}\n".format(pose_estimator.model_id))
-    print("Engine: {}".format(pose_estimator.engine))
-    print("Accelerator: {}\n".format(pose_estimator.accelerator))
-
-    fps = edgeiq.FPS()
-    server_comm = ServerComm()
+_STATS_PERIOD = 10
+_SUPERVISOR_PERIOD = 1
+
+
+def _check_for_errors(error_queue):
+    try:
+        error, traceback = error_queue.get_nowait()
+        print(traceback)
+        raise error
+    except queue.Empty:
+        pass
+
+
+def _send_camera_stats(server_comm, pipeline):
+    fps = 0
+    for s in pipeline.get_stats():
+        if s['stage'] == 'emit':
+            fps = s['fps']
+    server_comm.send_update_camera_stats(
+            fps, pipeline.get_inference_stats()['mean_time'],
+            pipeline.get_metrics())
+
+
+def _print_recorder_stats(recorder):
+    s = recorder.get_stats()
+    print(
+            '[INFO] Pre-roll {} frames in {:.1f} MB of {:.1f} MB, {:.1f} MB '
+            'raw, {} dropped, {} dropped by the writer'.format(
+                s['frames'], s['used_bytes'] / 1e6,
+                s['allocated_bytes'] / 1e6, s['raw_bytes'] / 1e6,
+                s['dropped'], s['write_dropped']))
+
+
+def _open_stream(source):
+    if isinstance(source, int):
+        return edgeiq.WebcamVideoStream(cam=source)
+    return edgeiq.FileVideoStream(source)
+
+
+def run_camera(
+        camera_id, source, stop_event, binary_frames, target_latency,
+        max_bandwidth, motion_threshold, keepalive_period, engine,
+        accelerator, num_requests, pre_roll, post_roll, exercises,
+        live_mode, live_bitrate, jpeg_backend, jpeg_subsampling):
+    """Capture, infer and stream one camera until `stop_event` is set."""
+    error_queue = queue.Queue()
+    model_id = "alwaysai/human-pose"
+    inference = AsyncInference(
+            model_id, engine=engine, accelerator=accelerator,
+            num_requests=num_requests, error_queue=error_queue).load()
+
+    print("[{}] Loaded model:\n{}\n".format(camera_id, model_id))
+    print("[{}] Engine: {}".format(camera_id, inference.engine))
+    print("[{}] Accelerator: {}".format(camera_id, inference.accelerator))
+    print("[{}] Requests in flight: {}\n".format(camera_id, num_requests))
+
+    quality_controller = StreamQualityController(
+            target_latency=target_latency, max_bandwidth=max_bandwidth)
+    encoder = FrameEncoder(
+            backend=jpeg_backend, subsampling=jpeg_subsampling)
+    print('[INFO] Camera {} JPEG encoder: {}, {} subsampling'.format(
+        camera_id, encoder.backend, encoder.subsampling))
+    server_comm = ServerComm(
+            binary_frames=binary_frames,
+            quality_controller=quality_controller, camera_id=camera_id,
+            encoder=encoder)
     server_comm.setup()
 
     try:
-        with edgeiq.WebcamVideoStream(cam=0) as video_stream:
+        with _open_stream(source) as video_stream:
             time.sleep(2.0)
-            fps.start()
-            while True:
-                frame = video_stream.read()
-                server_comm.send_frame(frame)
-                fps.update()
+            motion_gate = None
+            if motion_threshold > 0:
+                motion_gate = MotionGate(
+                        threshold=motion_threshold,
+                        keepalive_period=keepalive_period)
+            recorder = EventRecorder(
+                    camera_id, server_comm, error_queue, pre_roll=pre_roll,
+                    post_roll=post_roll)
+            recorder.start()
+            live_encoder = None
+            if live_mode == 'fmp4':
+                live_encoder = Fmp4Encoder(
+                        server_comm, error_queue,
+                        bitrate=live_bitrate).start()
+            pipeline = Pipeline(
+                    video_stream, inference, server_comm,
+                    motion_gate=motion_gate, recorder=recorder,
+                    analytics=WorkoutAnalytics(exercises),
+                    live_encoder=live_encoder)
+            pipeline.start()
+            try:
+                while not stop_event.wait(_STATS_PERIOD):
+                    pipeline.check_for_errors()
+                    _check_for_errors(error_queue)
+                    print("[{}] Stats:".format(camera_id))
+                    pipeline.print_stats()
+                    _print_recorder_stats(recorder)
+                    _send_camera_stats(server_comm, pipeline)
+                    if (not isinstance(source, int) and
+                            not video_stream.more()):
+                        break
+            finally:
+                pipeline.stop()
+                if live_encoder is not None:
+                    live_encoder.stop()
+                recorder.stop()
+                pipeline.print_stats()
+                _print_recorder_stats(recorder)
+
+    except KeyboardInterrupt:
+        # The supervisor handles Ctrl-C and stops the workers
+        pass
+    finally:
+        stats = server_comm.get_frame_stats()
+        print("[{}] Bytes per frame: {:.0f}".format(
+            camera_id, stats['bytes_per_frame']))
+        print("[{}] Encode time per frame: {:.4f} s".format(
+            camera_id, stats['encode_time']))
+        server_comm.close()
+
 
+def main(cameras, worker_args):
+    supervisor = CameraSupervisor(cameras, run_camera, worker_args)
+    supervisor.start()
+
+    # Previews are made once for all cameras, this connection has no
+    # camera id and only notifies the server of database updates
+    error_queue = queue.Queue()
+    server_comm = ServerComm()
+    server_comm.setup()
+    preview_worker = PreviewWorker(server_comm, error_queue)
+    preview_worker.start()
+
+    try:
+        while supervisor.check() > 0:
+            time.sleep(_SUPERVISOR_PERIOD)
+            _check_for_errors(error_queue)
     finally:
-        fps.stop()
+        supervisor.stop()
+        preview_worker.stop()
+        server_comm.close()
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='BetterWorkout CV app')
+    parser.add_argument(
+            '--camera', action='append', default=None,
+            help='Camera as [id=]source, where the source is a webcam index '
+                 'or a video file. Repeat for more cameras, defaults to 0')
+    parser.add_argument(
+            '--base64-frames', action='store_true',
+            help='Send frames as base64 data URIs instead of binary JPEG')
+    parser.add_argument(
+            '--target-latency', type=float, default=0.25,
+            help='Live feed delivery latency in seconds to adapt quality to')
+    parser.add_argument(
+            '--max-bandwidth', type=int, default=None,
+            help='Upper bound on live feed bytes per second')
+    parser.add_argument(
+            '--motion-threshold', type=float, default=0.005,
+            help='Fraction of changed pixels that triggers inference, '
+                 '0 to infer every frame')
+    parser.add_argument(
+            '--keepalive-period', type=float, default=2.0,
+            help='Longest time in seconds between inferences without motion')
+    parser.add_argument(
+            '--engine', default='DNN_OPENVINO',
+            choices=['DNN', 'DNN_OPENVINO'],
+            help='Inference engine to try first')
+    parser.add_argument(
+            '--accelerator', default='MYRIAD',
+            choices=['DEFAULT', 'CPU', 'GPU', 'MYRIAD'],
+            help='Accelerator to try first, falls back to the CPU')
+    parser.add_argument(
+            '--num-requests', type=int, default=2,
+            help='Number of inference requests in flight')
+    parser.add_argument(
+            '--pre-roll', type=float, default=5.0,
+            help='Seconds of video recorded before people appear')
+    parser.add_argument(
+            '--post-roll', type=float, default=5.0,
+            help='Seconds of video recorded after people leave')
+    parser.add_argument(
+            '--exercise', action='append', default=None,
+            choices=sorted(EXERCISES),
+            help='Exercise to count reps of, repeat for more. Defaults to '
+                 'all of them')
+    parser.add_argument(
+            '--live-mode', default='jpeg', choices=['jpeg', 'fmp4'],
+            help='Send the live feed as JPEG frames, or as H.264 in '
+                 'fragmented MP4 segments encoded by ffmpeg')
+    parser.add_argument(
+            '--live-bitrate', type=int, default=800,
+            help='Live feed bitrate in kbit/s with --live-mode fmp4')
+    parser.add_argument(
+            '--jpeg-backend', default='auto', choices=['auto'] + BACKENDS,
+            help='JPEG encoder for the live feed, auto picks the first '
+                 'installed of ' + ', '.join(BACKENDS))
+    parser.add_argument(
+            '--jpeg-subsampling', default='420', choices=SUBSAMPLING,
+            help='Chroma subsampling of the live feed JPEGs')
+    # The alwaysAI launcher passes its own flags, ignore them here
+    args, _ = parser.parse_known_args()
+    cameras = [parse_camera(c) for c in args.camera or ['0']]
+    main(cameras, dict(
+            binary_frames=not args.base64_frames,
+            target_latency=args.target_latency,
+            max_bandwidth=args.max_bandwidth,
+            motion_threshold=args.motion_threshold,
+            keepalive_period=args.keepalive_period,
+            engine=args.engine,
+            accelerator=args.accelerator,
+            num_requests=args.num_requests,
+            pre_roll=args.pre_roll,
+            post_roll=args.post_roll,
+            exercises=args.exercise,
+            live_mode=args.live_mode,
+            live_bitrate=args.live_bitrate,
+            jpeg_backend=args.jpeg_backend,
+            jpeg_subsampling=args.jpeg_subsampling))
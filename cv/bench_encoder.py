@@ -0,0 +1,140 @@
+"""
+Compare encode time and allocations per frame of the JPEG backends.
+
+Usage:
+
+    $ python3 bench_encoder.py [--frames 100] [--subsampling 420] [--full-size]
+                               [--base64-frames]
+
+Synthetic frames at 480p, 720p and 1080p are fit to the 640x480 live feed,
+or encoded at their own size with `--full-size`, by each installed backend
+of `FrameEncoder` and by the previous path that resized into a new array
+and copied the `cv2.imencode` output. With `--base64-frames` both also build
+the data URI payload, the previous path with its base64, decode and format
+copies. Allocations are the peak bytes traced by `tracemalloc` per frame,
+which counts Python and NumPy memory but not buffers the JPEG libraries
+allocate internally.
+"""
+import argparse
+import base64
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from encoder import FrameEncoder, available_backends
+
+RESOLUTIONS = [('480p', 640, 480), ('720p', 1280, 720), ('1080p', 1920, 1080)]
+QUALITY = 90
+
+
+def _make_frames(width, height, num_frames):
+    # Gradient with some noise so the JPEG size is realistic
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    base = (x[None, :] + y[:, None]) / 2
+    frames = []
+    for i in range(num_frames):
+        noise = np.random.normal(0, 8, (height, width, 3))
+        frame = np.clip(base[:, :, None] + noise + i, 0, 255)
+        frames.append(frame.astype(np.uint8))
+    return frames
+
+
+def _legacy_encoder(subsampling):
+    """Return the encode path before `FrameEncoder`, a new array per step."""
+    params = []
+    if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):
+        params = [cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                  getattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR_' + subsampling)]
+
+    def _encode(frame, width, height, quality):
+        frame_height, frame_width = frame.shape[:2]
+        scale = min(width / frame_width, height / frame_height)
+        frame = cv2.resize(
+                frame, (int(frame_width * scale), int(frame_height * scale)))
+        return cv2.imencode(
+                '.jpg', frame,
+                [cv2.IMWRITE_JPEG_QUALITY, quality] + params)[1].tobytes()
+    return _encode
+
+
+def _legacy_base64(encode):
+    """Add the previous data URI steps to the previous encode path."""
+    def _encode(frame, width, height, quality):
+        frame = base64.b64encode(
+                encode(frame, width, height, quality)).decode('utf-8')
+        return "data:image/jpeg;base64,{}".format(frame)
+    return _encode
+
+
+def _base64(encode):
+    """Add the data URI steps of `ServerComm.encode_frame`."""
+    def _encode(frame, width, height, quality):
+        return 'data:image/jpeg;base64,' + base64.b64encode(
+                encode(frame, width, height, quality)).decode('ascii')
+    return _encode
+
+
+def _run(encode, frames, width, height):
+    # Warm up the resize buffers and the libraries
+    encode(frames[0], width, height, QUALITY)
+
+    total_bytes = 0
+    start = time.perf_counter()
+    for frame in frames:
+        total_bytes += len(encode(frame, width, height, QUALITY))
+    elapsed = time.perf_counter() - start
+
+    # Traced separately, tracing slows the encode down. Starting a trace per
+    # frame resets the peak on any Python 3.
+    peaks = []
+    for frame in frames:
+        tracemalloc.start()
+        encode(frame, width, height, QUALITY)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return (elapsed / len(frames), sum(peaks) / len(peaks),
+            total_bytes / len(frames))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--subsampling', default='420',
+                        choices=['420', '422', '444'])
+    parser.add_argument('--full-size', action='store_true',
+                        help='Encode at the source resolution')
+    parser.add_argument('--base64-frames', action='store_true',
+                        help='Build base64 data URI payloads')
+    args = parser.parse_args()
+
+    legacy = _legacy_encoder(args.subsampling)
+    if args.base64_frames:
+        legacy = _legacy_base64(legacy)
+    encoders = [('legacy', legacy)]
+    for backend in available_backends(args.subsampling):
+        encoder = FrameEncoder(backend=backend, subsampling=args.subsampling)
+        encode = encoder.encode
+        if args.base64_frames:
+            encode = _base64(encode)
+        encoders.append((backend, encode))
+
+    print('Frames: {} per resolution, subsampling {}, {} payloads'.format(
+        args.frames, args.subsampling,
+        'base64' if args.base64_frames else 'binary'))
+    print('{:<6} {:<10} {:>10} {:>16} {:>14}'.format(
+        'Source', 'Encoder', 'ms/frame', 'Alloc KB/frame', 'Payload KB'))
+    for name, width, height in RESOLUTIONS:
+        frames = _make_frames(width, height, args.frames)
+        if not args.full_size:
+            width, height = 640, 480
+        for encoder_name, encode in encoders:
+            encode_time, allocated, jpeg_bytes = _run(
+                    encode, frames, width, height)
+            print('{:<6} {:<10} {:>10.2f} {:>16.1f} {:>14.1f}'.format(
+                name, encoder_name, encode_time * 1000, allocated / 1000,
+                jpeg_bytes / 1000))
+
+
+if __name__ == "__main__":
+    main()
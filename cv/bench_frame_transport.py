@@ -0,0 +1,68 @@
+"""
+Compare bytes per frame and CPU per frame of the live feed frame formats.
+
+Usage:
+
+    $ python3 bench_frame_transport.py [--video path/to/clip.mp4]
+
+Without a video, a synthetic 640x480 test pattern is used.
+"""
+import argparse
+import time
+import cv2
+import numpy as np
+from client import ServerComm
+
+
+def _load_frames(video_path, num_frames):
+    if video_path is None:
+        # Gradient with some noise so the JPEG size is realistic
+        x = np.linspace(0, 255, 640, dtype=np.float32)
+        y = np.linspace(0, 255, 480, dtype=np.float32)
+        base = (x[None, :] + y[:, None]) / 2
+        frames = []
+        for i in range(num_frames):
+            noise = np.random.normal(0, 8, (480, 640, 3))
+            frame = np.clip(base[:, :, None] + noise + i, 0, 255)
+            frames.append(frame.astype(np.uint8))
+        return frames
+
+    frames = []
+    cap = cv2.VideoCapture(video_path)
+    while len(frames) < num_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def _run(frames, binary_frames):
+    server_comm = ServerComm(binary_frames=binary_frames)
+    total_bytes = 0
+    start_cpu = time.process_time()
+    for frame in frames:
+        payload = server_comm.encode_frame(frame)
+        total_bytes += len(payload)
+    cpu = time.process_time() - start_cpu
+    return total_bytes / len(frames), cpu / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--video', default=None, help='Video file to encode')
+    parser.add_argument('--frames', type=int, default=200)
+    args = parser.parse_args()
+
+    frames = _load_frames(args.video, args.frames)
+    print('Frames: {}'.format(len(frames)))
+    print('{:<10} {:>16} {:>16}'.format('Mode', 'Bytes/frame', 'CPU ms/frame'))
+    for name, binary_frames in (('binary', True), ('base64', False)):
+        bytes_per_frame, cpu_per_frame = _run(frames, binary_frames)
+        print('{:<10} {:>16.0f} {:>16.3f}'.format(
+            name, bytes_per_frame, cpu_per_frame * 1000))
+
+
+if __name__ == "__main__":
+    main()
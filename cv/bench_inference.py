@@ -0,0 +1,68 @@
+"""
+Measure pose inference throughput and latency with 1 to N requests in flight.
+
+Usage:
+
+    $ python3 bench_inference.py [--engine DNN] [--accelerator CPU]
+                                 [--max-requests 4] [--frames 100]
+
+Frames are submitted as fast as the requests allow and their results
+collected in order on another thread, like the CV pipeline does. Without a
+video, frames from `bench_frame_transport` are used.
+"""
+import argparse
+import threading
+import time
+from inference import AsyncInference
+from bench_frame_transport import _load_frames
+
+
+def _run(inference, frames):
+    """Return frames per second and sorted submit to result latencies."""
+    latencies = []
+
+    def _collect():
+        for _ in range(len(frames)):
+            submitted, _ = inference.get()
+            latencies.append(time.perf_counter() - submitted)
+
+    collector = threading.Thread(target=_collect)
+    collector.start()
+    start = time.perf_counter()
+    for frame in frames:
+        inference.submit(frame, time.perf_counter())
+    collector.join()
+    duration = time.perf_counter() - start
+    return len(frames) / duration, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--engine', default='DNN')
+    parser.add_argument('--accelerator', default='CPU')
+    parser.add_argument('--max-requests', type=int, default=4)
+    parser.add_argument('--video', default=None, help='Video file to infer')
+    parser.add_argument('--frames', type=int, default=100)
+    args = parser.parse_args()
+
+    frames = _load_frames(args.video, args.frames)
+    print('{:<10} {:>10} {:>10} {:>10}'.format(
+        'Requests', 'FPS', 'p50 ms', 'p99 ms'))
+    for num_requests in range(1, args.max_requests + 1):
+        inference = AsyncInference(
+                'alwaysai/human-pose', engine=args.engine,
+                accelerator=args.accelerator,
+                num_requests=num_requests).load()
+        # Warm up every request before timing
+        _run(inference, frames[:num_requests])
+        fps, latencies = _run(inference, frames)
+        inference.close()
+        print('{:<10} {:>10.2f} {:>10.1f} {:>10.1f}'.format(
+            num_requests, fps, 1000 * latencies[len(latencies) // 2],
+            1000 * latencies[int(len(latencies) * 0.99)]))
+    print('Engine: {}, accelerator: {}'.format(
+        inference.engine, inference.accelerator))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Compare the JPEG and fragmented MP4 live feed modes.
+
+Usage:
+
+    $ python3 bench_live.py [--video clip.mp4] [--fps 30] [--bitrate 800]
+
+Frames are fed at the camera rate through `ServerComm.encode_frame` for the
+JPEG mode and through `Fmp4Encoder` for the fragmented MP4 mode, reporting
+bytes per second and the latency from capture until the frame can be sent.
+For fragmented MP4 that is when the segment holding the frame is complete.
+Network and browser decode time come on top and are about the same for
+both. Needs ffmpeg on the path.
+"""
+import argparse
+import queue
+import threading
+import time
+from bench_frame_transport import _load_frames
+from client import ServerComm
+from fmp4 import Fmp4Encoder, sample_count
+
+
+class _SegmentSink:
+    """Stands in for `ServerComm`, recording when segments are complete."""
+    def __init__(self):
+        self.segments = []
+        self._lock = threading.Lock()
+
+    def send_update_init(self, init, codec):
+        pass
+
+    def emit_segment(self, segment):
+        with self._lock:
+            self.segments.append((time.time(), segment))
+
+
+def _paced(frames, fps):
+    """Yield the frames at `fps`, with the time each was captured."""
+    start = time.time()
+    for i, frame in enumerate(frames):
+        delay = start + i / fps - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        yield time.time(), frame
+
+
+def _run_jpeg(frames, fps):
+    server_comm = ServerComm()
+    total_bytes = 0
+    latencies = []
+    for captured, frame in _paced(frames, fps):
+        total_bytes += len(server_comm.encode_frame(frame))
+        latencies.append(time.time() - captured)
+    return total_bytes, latencies, 0
+
+
+def _run_fmp4(frames, fps, bitrate, key_period):
+    sink = _SegmentSink()
+    error_queue = queue.Queue()
+    encoder = Fmp4Encoder(
+            sink, error_queue, bitrate=bitrate,
+            key_period=key_period).start()
+    captured_times = []
+    for captured, frame in _paced(frames, fps):
+        dropped = encoder.dropped
+        encoder.put(frame)
+        if encoder.dropped == dropped:
+            captured_times.append(captured)
+    encoder.stop()
+    if not error_queue.empty():
+        raise error_queue.get()[0]
+
+    # Segments hold the frames in order
+    latencies = []
+    total_bytes = 0
+    for sent, segment in sink.segments:
+        total_bytes += len(segment)
+        for _ in range(sample_count(segment)):
+            if len(latencies) < len(captured_times):
+                latencies.append(sent - captured_times[len(latencies)])
+    return total_bytes, latencies, encoder.dropped
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--video', default=None, help='Video file to stream')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--bitrate', type=int, default=800,
+                        help='Fragmented MP4 bitrate in kbit/s')
+    parser.add_argument('--key-period', type=float, default=0.5,
+                        help='Seconds between keyframes and segments')
+    args = parser.parse_args()
+
+    frames = _load_frames(args.video, args.frames)
+    duration = len(frames) / args.fps
+    print('Frames: {} at {} FPS'.format(len(frames), args.fps))
+    print('{:<6} {:>12} {:>14} {:>14} {:>8}'.format(
+        'Mode', 'kB/s', 'Latency p50', 'Latency p99', 'Dropped'))
+    for name, run in (
+            ('jpeg', lambda: _run_jpeg(frames, args.fps)),
+            ('fmp4', lambda: _run_fmp4(
+                frames, args.fps, args.bitrate, args.key_period))):
+        total_bytes, latencies, dropped = run()
+        print('{:<6} {:>12.1f} {:>11.1f} ms {:>11.1f} ms {:>8}'.format(
+            name, total_bytes / duration / 1000,
+            1000 * _percentile(latencies, 0.5),
+            1000 * _percentile(latencies, 0.99), dropped))
+
+
+if __name__ == "__main__":
+    main()
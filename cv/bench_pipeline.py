@@ -0,0 +1,343 @@
+"""
+Replay video files through the CV pipeline without a camera, model or server.
+
+Usage:
+
+    $ python3 bench_pipeline.py [--video clip.mp4 ...] [--inference-ms 50]
+                                [--num-requests 2] [--motion-threshold 0]
+                                [--people 1] [--no-record]
+
+Frames go through the same `Pipeline`, `AsyncInference`, `ServerComm`,
+`EventRecorder` and `WorkoutAnalytics` as `run_camera` in `app.py`. The
+model is replaced by a fake with the given latency that finds `--people`
+moving poses, so the tracker, the rep counting and the event recordings do
+their usual work. Recordings go to a temporary data directory that is
+removed afterwards. Without a video, frames from `bench_frame_transport`
+are replayed.
+
+The socket.io client is a fake that records what `ServerComm` sends and
+answers with stream stats like the server, so the numbers leave out
+socket.io serialization, the network and the server. `server/bench_load.py`
+covers those.
+
+The alwaysAI SDK is not needed: when `edgeiq` can't be imported, it is
+replaced by a module with just the `FPS` counter the pipeline uses, and
+`socketio` likewise by an empty module.
+"""
+import argparse
+import math
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+class _FPS:
+    """The subset of `edgeiq.FPS` used by the pipeline."""
+    def __init__(self):
+        self._start = None
+        self._end = None
+        self._frames = 0
+
+    def start(self):
+        self._start = time.time()
+        return self
+
+    def update(self):
+        self._frames += 1
+
+    def stop(self):
+        self._end = time.time()
+
+    def get_elapsed_seconds(self):
+        return (self._end or time.time()) - self._start
+
+    def compute_fps(self):
+        if self._start is None:
+            return 0.0
+        return self._frames / max(self.get_elapsed_seconds(), 1e-9)
+
+
+def _stub_missing(name, **attrs):
+    """Put a module with `attrs` in place of `name` if it isn't installed."""
+    try:
+        __import__(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+
+
+# Before the app modules import them
+_stub_missing('edgeiq', FPS=_FPS)
+_stub_missing('socketio')
+
+import cv2
+import database
+from analytics import KEYPOINT_NAMES, WorkoutAnalytics
+from bench_frame_transport import _load_frames
+from client import ServerComm
+from inference import AsyncInference
+from motion import MotionGate
+from pipeline import Pipeline
+from recording import EventRecorder
+
+
+class _ReplayStream:
+    """Video stream that returns each frame of the sources once."""
+    def __init__(self, videos, frames, loops):
+        self._videos = list(videos) * loops
+        self._frames = list(frames) * loops
+        self._cap = None
+        self._done = False
+
+    def read(self):
+        while True:
+            if self._cap is None:
+                if len(self._frames) > 0:
+                    return self._frames.pop(0)
+                if len(self._videos) == 0:
+                    self._done = True
+                    return None
+                self._cap = cv2.VideoCapture(self._videos.pop(0))
+
+            ok, frame = self._cap.read()
+            if ok:
+                return frame
+            self._cap.release()
+            self._cap = None
+
+    def more(self):
+        return not self._done
+
+
+class _FakePose:
+    """Pose with `key_points` in the order of the human-pose model."""
+    def __init__(self, points, score):
+        self.key_points = dict(zip(KEYPOINT_NAMES, points))
+        self.score = score
+
+
+class _FakeResults:
+    def __init__(self, poses):
+        self.poses = poses
+
+
+def _fake_poses(num_people, t):
+    """Return standing people side by side, bending their arms and knees."""
+    poses = []
+    for i in range(num_people):
+        x = 100 + 150 * i
+        bend = 40 * math.sin(t * math.pi + i)
+        points = [
+                (x, 40), (x, 80), (x - 30, 80), (x - 40, 130),
+                (x - 30 + bend, 170), (x + 30, 80), (x + 40, 130),
+                (x + 30 - bend, 170), (x - 20, 200), (x - 25 + bend, 270),
+                (x - 20, 340), (x + 20, 200), (x + 25 - bend, 270),
+                (x + 20, 340), (x - 8, 32), (x + 8, 32), (x - 15, 38),
+                (x + 15, 38)]
+        poses.append(_FakePose(points, 0.9))
+    return poses
+
+
+class _FakeEstimator:
+    def __init__(self, latency, jitter, num_people):
+        self._latency = latency
+        self._jitter = jitter
+        self._num_people = num_people
+
+    def estimate(self, frame):
+        # Sleeping releases the GIL like the real model does
+        time.sleep(max(random.gauss(self._latency, self._jitter), 0))
+        return _FakeResults(_fake_poses(self._num_people, time.time()))
+
+
+class _FakeInference(AsyncInference):
+    """`AsyncInference` with the model replaced by a fixed latency."""
+    def __init__(self, latency, jitter, num_requests, num_people):
+        self._latency = latency
+        self._jitter = jitter
+        self._num_people = num_people
+        super(_FakeInference, self).__init__(
+                'fake', num_requests=num_requests)
+
+    def _load_estimator(self):
+        estimator = _FakeEstimator(
+                self._latency, self._jitter, self._num_people)
+        estimator.engine = 'fake'
+        estimator.accelerator = 'none'
+        return estimator
+
+
+class _FakeServer:
+    """
+    Fake `socketio.Client` standing in for the connection to the server.
+
+    Records the frames `ServerComm` emits and calls its `server-data`
+    handler with `update_stream_stats` once a second, with the given
+    delivery latency and no drops, as the server would.
+    """
+    def __init__(self, link_latency):
+        self._link_latency = link_latency
+        self._handlers = {}
+        self._last_report = time.time()
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.bytes = 0
+        self.messages = 0
+
+    def on(self, event, handler, namespace=None):
+        self._handlers[event] = handler
+
+    def connect(self, url, namespaces=None):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def emit(self, event, message):
+        if message['cmd'] != 'update_frame':
+            with self._lock:
+                self.messages += 1
+            return
+
+        with self._lock:
+            self.frames += 1
+            self.bytes += len(message['data'])
+            now = time.time()
+            report = now - self._last_report >= 1.0
+            if report:
+                self._last_report = now
+
+        if report:
+            self._handlers['server-data']({
+                'cmd': 'update_stream_stats', 'queue_depth': 0, 'drops': 0,
+                'latency': self._link_latency, 'num_clients': 1})
+
+
+class _ReplayPipeline(Pipeline):
+    """Pipeline that records the exact capture to send time of frames."""
+    def __init__(self, *args, **kwargs):
+        super(_ReplayPipeline, self).__init__(*args, **kwargs)
+        self.latencies = []
+
+    def _emit(self, item):
+        item = super(_ReplayPipeline, self)._emit(item)
+        self.latencies.append(time.time() - item['timestamp'])
+        return item
+
+
+def _check_for_errors(error_queue):
+    try:
+        error, tb = error_queue.get_nowait()
+        print(tb)
+        raise error
+    except queue.Empty:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--video', action='append', default=[])
+    parser.add_argument('--frames', type=int, default=300,
+                        help='Synthetic frames to replay without a video')
+    parser.add_argument('--loops', type=int, default=1)
+    parser.add_argument('--inference-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=5)
+    parser.add_argument('--num-requests', type=int, default=2)
+    parser.add_argument('--motion-threshold', type=float, default=0)
+    parser.add_argument('--max-fps', type=float, default=30)
+    parser.add_argument('--link-latency', type=float, default=0.05)
+    parser.add_argument('--people', type=int, default=1,
+                        help='People the fake model finds in every frame')
+    parser.add_argument('--no-record', action='store_true',
+                        help='Run without the event recorder')
+    parser.add_argument('--pre-roll', type=float, default=5.0)
+    parser.add_argument('--post-roll', type=float, default=5.0)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+    database.DATA_DIR = data_dir
+    database.VIDEO_DIR = os.path.join(data_dir, 'recordings')
+    database.KEYPOINT_DIR = os.path.join(data_dir, 'keypoints')
+    database.DB_FILE = os.path.join(data_dir, 'person_detections.db')
+    try:
+        _run(args)
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def _run(args):
+    frames = [] if args.video else _load_frames(None, args.frames)
+    stream = _ReplayStream(args.video, frames, args.loops)
+    error_queue = queue.Queue()
+    inference = _FakeInference(
+            args.inference_ms / 1000, args.jitter_ms / 1000,
+            args.num_requests, args.people).load()
+    server = _FakeServer(args.link_latency)
+    server_comm = ServerComm(camera_id='replay', sio=server)
+    server_comm.setup()
+    motion_gate = None
+    if args.motion_threshold > 0:
+        motion_gate = MotionGate(threshold=args.motion_threshold)
+
+    recorder = None
+    if not args.no_record:
+        recorder = EventRecorder(
+                'replay', server_comm, error_queue, pre_roll=args.pre_roll,
+                post_roll=args.post_roll)
+        recorder.start()
+
+    pipeline = _ReplayPipeline(
+            stream, inference, server_comm, max_capture_fps=args.max_fps,
+            motion_gate=motion_gate, recorder=recorder,
+            analytics=WorkoutAnalytics())
+    start_cpu = time.process_time()
+    start = time.time()
+    pipeline.start()
+    try:
+        while stream.more():
+            time.sleep(0.1)
+            pipeline.check_for_errors()
+            _check_for_errors(error_queue)
+        # Let the frames in flight drain
+        time.sleep(args.inference_ms / 1000 * args.num_requests + 0.2)
+    finally:
+        pipeline.stop()
+        if recorder is not None:
+            # Includes writing the event in progress
+            recorder.stop()
+    duration = time.time() - start
+    cpu = time.process_time() - start_cpu
+    _check_for_errors(error_queue)
+
+    latencies = sorted(pipeline.latencies)
+    print('Frames sent: {} in {:.1f} s, {:.2f} FPS'.format(
+        server.frames, duration, server.frames / duration))
+    if latencies:
+        print('Latency ms: p50 {:.1f}, p90 {:.1f}, p99 {:.1f}'.format(
+            1000 * latencies[len(latencies) // 2],
+            1000 * latencies[int(len(latencies) * 0.9)],
+            1000 * latencies[int(len(latencies) * 0.99)]))
+    print('Bytes sent: {}, {:.0f} per frame'.format(
+        server.bytes, server.bytes / max(server.frames, 1)))
+    print('Other messages sent: {}'.format(server.messages))
+    print('CPU: {:.0f}% of one core'.format(100 * cpu / duration))
+    if recorder is not None:
+        stats = recorder.get_stats()
+        with database.Database() as db:
+            num_events = db.get_usage()[1]
+        print('Recorder: {} events, pre-roll {:.1f} MB, {} frames '
+              'dropped, {} by the writer'.format(
+                  num_events, stats['used_bytes'] / 1e6, stats['dropped'],
+                  stats['write_dropped']))
+    pipeline.print_stats()
+
+
+if __name__ == "__main__":
+    main()
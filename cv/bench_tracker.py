@@ -0,0 +1,129 @@
+"""
+Compare the vectorized centroid tracker with a per-object loop.
+
+Usage:
+
+    $ python3 bench_tracker.py [--max-people 50] [--frames 300]
+
+People walk randomly in a 640x480 frame, with some missed detections.
+Both trackers are updated with the same detections, reporting the time per
+update and the number of ids assigned, which is the number of unique people
+counted for an event.
+"""
+import argparse
+import math
+import time
+import numpy as np
+from tracker import CentroidTracker, box_points, pose_points
+
+
+class _NaiveTracker:
+    """
+    Centroid tracker with a Python loop per object, as in the readme.
+
+    Each track takes its nearest unmatched detection, closest pairs first.
+    """
+    def __init__(self, max_disappeared=30, max_distance=150.0):
+        self._max_disappeared = max_disappeared
+        self._max_distance = max_distance
+        self._objects = {}
+        self._disappeared = {}
+        self.next_id = 0
+
+    def update(self, centroids):
+        pairs = []
+        for object_id, (x, y) in self._objects.items():
+            for i, (cx, cy) in enumerate(centroids):
+                d = math.hypot(x - cx, y - cy)
+                if d <= self._max_distance:
+                    pairs.append((d, object_id, i))
+        pairs.sort()
+
+        used_objects = set()
+        used_centroids = set()
+        for d, object_id, i in pairs:
+            if object_id in used_objects or i in used_centroids:
+                continue
+            self._objects[object_id] = centroids[i]
+            self._disappeared[object_id] = 0
+            used_objects.add(object_id)
+            used_centroids.add(i)
+
+        for object_id in list(self._objects):
+            if object_id in used_objects:
+                continue
+            self._disappeared[object_id] += 1
+            if self._disappeared[object_id] > self._max_disappeared:
+                del self._objects[object_id]
+                del self._disappeared[object_id]
+
+        for i, centroid in enumerate(centroids):
+            if i not in used_centroids:
+                self._objects[self.next_id] = centroid
+                self._disappeared[self.next_id] = 0
+                self.next_id += 1
+
+
+class _Pose:
+    def __init__(self, keypoints):
+        self.key_points = dict(enumerate(keypoints))
+
+
+def _simulate(num_people, num_frames, miss_prob, rng):
+    """Return boxes and 18 keypoint poses per frame of walking people."""
+    positions = rng.uniform((40, 80), (600, 400), size=(num_people, 2))
+    offsets = rng.normal(0, 20, size=(18, 2))
+    frames = []
+    for _ in range(num_frames):
+        positions += rng.normal(0, 4, size=positions.shape)
+        positions = np.clip(positions, (40, 80), (600, 400))
+        seen = positions[rng.random(num_people) >= miss_prob]
+        boxes = [(x - 30, y - 70, x + 30, y + 70) for x, y in seen]
+        keypoints = seen[:, None] + offsets[None]
+        # Joints the pose estimator missed are given as (-1, -1)
+        keypoints[rng.random(keypoints.shape[:2]) < 0.2] = -1
+        poses = [_Pose([tuple(k) for k in person]) for person in keypoints]
+        frames.append((boxes, poses))
+    return frames
+
+
+def _time(update, inputs):
+    start = time.perf_counter()
+    for value in inputs:
+        update(value)
+    return (time.perf_counter() - start) / len(inputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--max-people', type=int, default=50)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--miss-prob', type=float, default=0.05,
+                        help='Chance a person is not detected in a frame')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    counts = sorted({1, 2, 5, 10, 20, 35, args.max_people})
+    print('{:>6} {:>12} {:>12} {:>12} {:>18}'.format(
+        'People', 'Loop us', 'Boxes us', 'Keypoints us', 'Ids loop/vector'))
+    for num_people in [n for n in counts if n <= args.max_people]:
+        frames = _simulate(num_people, args.frames, args.miss_prob, rng)
+        centroids = [
+                [((b[0] + b[2]) / 2, (b[1] + b[3]) / 2) for b in boxes]
+                for boxes, _ in frames]
+
+        naive = _NaiveTracker()
+        loop_time = _time(naive.update, centroids)
+        boxes = CentroidTracker()
+        box_time = _time(
+                lambda f: boxes.update(box_points(f[0])), frames)
+        poses = CentroidTracker()
+        pose_time = _time(
+                lambda f: poses.update(pose_points(f[1])), frames)
+        print('{:>6} {:>12.1f} {:>12.1f} {:>12.1f} {:>18}'.format(
+            num_people, 1e6 * loop_time, 1e6 * box_time, 1e6 * pose_time,
+            '{}/{}'.format(naive.next_id, boxes.next_id)))
+
+
+if __name__ == "__main__":
+    main()
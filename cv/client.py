@@ -1,49 +1,195 @@
-import edgeiq
-import cv2
 import socketio
 import base64
 import time
+import urllib.parse
+from quality import StreamQualityController
+from encoder import FrameEncoder
+
+_DATA_URI_PREFIX = 'data:image/jpeg;base64,'
 
 
 class ServerComm:
-    def __init__(self):
-        self._sio = socketio.Client()
+    """
+    Send frames and notifications to the server app.
+
+    :type binary_frames: boolean
+    :param binary_frames: Send frames as raw JPEG bytes in a socket.io
+                          binary attachment. When False, frames are sent
+                          as base64 data URI strings.
+    :type quality_controller: :class:`quality.StreamQualityController`
+    :param quality_controller: Adjusts the stream settings from the stats
+                               reported by the server. A default controller
+                               is used when None.
+    :type camera_id: string
+    :param camera_id: The camera the messages are from. None for a
+                      connection that only sends notifications.
+    :type sio: :class:`socketio.Client`
+    :param sio: The socket.io client to send with, a new client if None.
+    :type encoder: :class:`encoder.FrameEncoder`
+    :param encoder: Resizes and encodes the frames. When None, one with the
+                    fastest installed JPEG backend and 4:2:0 subsampling is
+                    made for the first frame, so connections that only send
+                    notifications never load a backend.
+    """
+    def __init__(
+            self, binary_frames=True, quality_controller=None,
+            camera_id=None, sio=None, encoder=None):
+        self._sio = sio if sio is not None else socketio.Client()
+        self._camera_id = camera_id
         self._max_image_width = 640
         self._max_image_height = 480
+        self._binary_frames = binary_frames
+        self._encoder = encoder
+
+        if quality_controller is None:
+            quality_controller = StreamQualityController(
+                    self._max_image_width, self._max_image_height)
+        self._quality_controller = quality_controller
+        self._settings = quality_controller.get_settings()
+        self._sio.on(
+                'server-data', self._handle_message_from_server,
+                namespace='/cv')
+        self._sio.on('connect', self._handle_connect, namespace='/cv')
+        # Fragmented MP4 initialization segment, resent on reconnect
+        self._live_init = None
+        # When the next frame may be sent at the current send rate
+        self._next_due = 0
+        self._bandwidth_start = time.time()
+        self._bandwidth_bytes = 0
+
+        self._frames_encoded = 0
+        self._encode_time = 0.0
+        self._frames_sent = 0
+        self._bytes_sent = 0
 
     def setup(self):
         print('[INFO] Connecting to server...')
-        self._sio.connect(
-                'http://10.19.191.50:5000', namespaces=['/cv'])
+        url = 'http://10.19.191.50:5000'
+        if self._camera_id is not None:
+            url += '?' + urllib.parse.urlencode({'camera_id': self._camera_id})
+        self._sio.connect(url, namespaces=['/cv'])
         print('[INFO] Successfully connected to server.')
         time.sleep(1)
 
+    def encode_frame(self, frame):
+        """Resize and encode a frame into an `update_frame` payload."""
+        start = time.perf_counter()
+        settings = self._settings
+        if self._encoder is None:
+            self._encoder = FrameEncoder()
+        # The JPEG bytes are sent as they are in a binary attachment
+        frame = self._encoder.encode(
+                frame, settings['width'], settings['height'],
+                settings['quality'])
+        if not self._binary_frames:
+            frame = _DATA_URI_PREFIX + base64.b64encode(frame).decode('ascii')
+
+        self._encode_time += time.perf_counter() - start
+        self._frames_encoded += 1
+        return frame
+
+    def frame_due(self):
+        """Check whether the current send rate allows another frame."""
+        return time.time() >= self._next_due
+
+    def _emit(self, message):
+        message['camera_id'] = self._camera_id
+        self._sio.emit('cv-cmd', message)
+
+    def emit_frame(self, frame):
+        """Send an encoded frame to the server."""
+        self._emit({'cmd': 'update_frame', 'data': frame})
+        # Deadlines advance by the period from the last one rather than
+        # from the send, so capture jitter doesn't skip frames. A late send
+        # lets the next frame go at once, but never a burst.
+        period = 1.0 / self._settings['fps']
+        self._next_due = max(self._next_due, time.time() - period) + period
+        self._frames_sent += 1
+        self._bytes_sent += len(frame)
+        self._bandwidth_bytes += len(frame)
+
+    def send_update_init(self, init, codec):
+        """
+        Send the initialization segment of the fragmented MP4 live feed.
+
+        :type codec: string
+        :param codec: The MIME type and codecs for Media Source Extensions.
+        """
+        self._live_init = {'cmd': 'update_init', 'data': init, 'codec': codec}
+        self._emit(dict(self._live_init))
+
+    def _handle_connect(self):
+        # Settings are otherwise only sent on change, and the server forgets
+        # them and the init segment when the connection drops or it restarts
+        if self._camera_id is not None:
+            self._emit(
+                    {'cmd': 'update_stream_settings', 'data': self._settings})
+        if self._live_init is not None:
+            self._emit(dict(self._live_init))
+
+    def emit_segment(self, segment):
+        """Send a media segment of the fragmented MP4 live feed."""
+        self._emit({'cmd': 'update_segment', 'data': segment})
+        self._bytes_sent += len(segment)
+        self._bandwidth_bytes += len(segment)
+
+    def _handle_message_from_server(self, message):
+        if message['cmd'] != 'update_stream_stats':
+            return
+
+        now = time.time()
+        bandwidth = self._bandwidth_bytes / max(
+                now - self._bandwidth_start, 1e-3)
+        self._bandwidth_start = now
+        self._bandwidth_bytes = 0
+
+        if self._quality_controller.update(message, bandwidth):
+            self._settings = self._quality_controller.get_settings()
+            print('[INFO] Stream settings: {}x{} quality {} at {} FPS'.format(
+                self._settings['width'], self._settings['height'],
+                self._settings['quality'], self._settings['fps']))
+            self._emit(
+                    {'cmd': 'update_stream_settings', 'data': self._settings})
+
     def send_frame(self, frame):
-        frame = edgeiq.resize(
-                frame, width=self._max_image_width,
-                height=self._max_image_height, keep_scale=True)
-
-        # Encode frame as jpeg
-        frame = cv2.imencode('.jpg', frame)[1].tobytes()
-        # Encode frame in base64 representation and remove
-        # utf-8 encoding
-        frame = base64.b64encode(frame).decode('utf-8')
-        frame = "data:image/jpeg;base64,{}".format(frame)
-        self._sio.emit('cv-cmd', {'cmd': 'update_frame', 'data': frame})
+        self.emit_frame(self.encode_frame(frame))
+
+    def get_frame_stats(self):
+        """Return the average payload size and encode time per frame."""
+        frames_sent = max(self._frames_sent, 1)
+        frames_encoded = max(self._frames_encoded, 1)
+        return {
+                'frames': self._frames_sent,
+                'bytes_per_frame': self._bytes_sent / frames_sent,
+                'encode_time': self._encode_time / frames_encoded
+                }
 
     def send_notify_db_update(self):
-        return
-        # self._sio.emit('cv-cmd', {'cmd': 'notify_db_update'})
-
-    def send_update_camera_stats(self, fps, inf_time):
-        return
-        # self._sio.emit(
-        #         'cv-cmd',
-        #         {
-        #             'cmd': 'update_camera_stats',
-        #             'fps': fps,
-        #             'inf_time': inf_time
-        #             })
+        self._emit({'cmd': 'notify_db_update'})
+
+    def send_update_workout(self, workout):
+        """
+        Send the rep counts of the people in view.
+
+        :type workout: dictionary
+        :param workout: From :meth:`analytics.WorkoutAnalytics.get_state`.
+        """
+        self._emit({'cmd': 'update_workout', 'data': workout})
+
+    def send_update_camera_stats(self, fps, inf_time, metrics=None):
+        """
+        Send the camera throughput and pipeline metrics to the server.
+
+        :type metrics: dictionary
+        :param metrics: The histograms and drops from
+                        :meth:`pipeline.Pipeline.get_metrics`.
+        """
+        self._emit({
+            'cmd': 'update_camera_stats',
+            'fps': round(fps, 1),
+            'inf_time': round(inf_time, 3),
+            'metrics': metrics
+            })
 
     def close(self):
         self._sio.disconnect()
@@ -1,60 +1,190 @@
 import os
 import sqlite3
+import threading
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 VIDEO_DIR = os.path.join(DATA_DIR, 'recordings')
+THUMBNAIL_DIR = os.path.join(DATA_DIR, 'thumbnails')
+KEYPOINT_DIR = os.path.join(DATA_DIR, 'keypoints')
+DB_FILE = os.path.join(DATA_DIR, 'person_detections.db')
+# Number of changes kept in the event log for incremental sync
+EVENT_LOG_SIZE = 10000
+# Above this many inserted events a full listing is sent instead
+_MAX_CHANGED_EVENTS = 500
+
+# Schema migrations in the order they are applied. The database stores the
+# number already applied in its user_version.
+_MIGRATIONS = [
+        'CREATE TABLE IF NOT EXISTS person_detections ('
+        'path TEXT, date TEXT, time TEXT, num_people INTEGER)',
+        'CREATE INDEX IF NOT EXISTS person_detections_date_time '
+        'ON person_detections (date, time)',
+        # Every insert and delete gets a version in the event log, so
+        # clients can fetch only what changed since the version they have
+        'CREATE TABLE IF NOT EXISTS event_log ('
+        'version INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, '
+        'event_id INTEGER)',
+        'CREATE TRIGGER IF NOT EXISTS person_detections_insert '
+        'AFTER INSERT ON person_detections BEGIN '
+        "INSERT INTO event_log (op, event_id) VALUES ('insert', NEW.rowid); "
+        'END',
+        'CREATE TRIGGER IF NOT EXISTS person_detections_delete '
+        'AFTER DELETE ON person_detections BEGIN '
+        "INSERT INTO event_log (op, event_id) VALUES ('delete', OLD.rowid); "
+        'END',
+        'CREATE TRIGGER IF NOT EXISTS event_log_prune '
+        'AFTER INSERT ON event_log BEGIN '
+        'DELETE FROM event_log WHERE version <= NEW.version - {:d}; '
+        'END'.format(EVENT_LOG_SIZE),
+        # Size of the video file in bytes, for retention
+        'ALTER TABLE person_detections ADD COLUMN size INTEGER',
+        # Poster and keyframe strip filenames in THUMBNAIL_DIR, NULL until
+        # extracted and empty if the video could not be read
+        'ALTER TABLE person_detections ADD COLUMN thumbnail TEXT',
+        'ALTER TABLE person_detections ADD COLUMN keyframes TEXT',
+        # Previews are added after the event, clients fetch it again
+        'CREATE TRIGGER IF NOT EXISTS person_detections_previews '
+        'AFTER UPDATE OF thumbnail ON person_detections BEGIN '
+        "INSERT INTO event_log (op, event_id) VALUES ('update', NEW.rowid); "
+        'END',
+        # Camera that recorded the event, NULL for single camera recordings
+        'ALTER TABLE person_detections ADD COLUMN camera_id TEXT',
+        # Keypoint archive filename in KEYPOINT_DIR
+        'ALTER TABLE person_detections ADD COLUMN keypoints TEXT'
+        ]
+
+
+class _ConnectionMgr:
+    """
+    Share one SQLite connection per database file across the process.
+
+    Connections are opened in WAL mode so the server can read while the CV
+    app writes. Access to a connection is serialized with its lock.
+    """
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _open(self, db_file):
+        conn = sqlite3.connect(
+                db_file, timeout=5.0, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._migrate(conn)
+        return conn
+
+    def _migrate(self, conn):
+        if (conn.execute('PRAGMA user_version').fetchone()[0] ==
+                len(_MIGRATIONS)):
+            return
+
+        # The server and the CV app may open the database at the same time.
+        # The write lock is taken before the version is read, so the other
+        # process waits and then finds the migrations already applied.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for i in range(version, len(_MIGRATIONS)):
+                conn.execute(_MIGRATIONS[i])
+            # PRAGMA does not take parameters
+            conn.execute('PRAGMA user_version={:d}'.format(len(_MIGRATIONS)))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        for i in range(version, len(_MIGRATIONS)):
+            print('[INFO] Applied database migration {}'.format(i + 1))
+
+    def get(self, db_file):
+        """Return the connection and its lock, opening it on first use."""
+        with self._lock:
+            entry = self._connections.get(db_file, None)
+            if entry is None:
+                if not os.path.exists(DATA_DIR):
+                    os.makedirs(DATA_DIR)
+                entry = (self._open(db_file), threading.RLock())
+                self._connections[db_file] = entry
+            return entry
+
+
+_connection_mgr = _ConnectionMgr()
+
+# Called as listener(op, event_id) after this process changes the events
+_change_listeners = []
+
+
+def add_change_listener(listener):
+    """
+    Register a callback for events added or deleted by this process.
+
+    :type listener: function
+    :param listener: Called with the operation, `'insert'`, `'update'` or
+                     `'delete'`, and the id of the event.
+    """
+    _change_listeners.append(listener)
+
+
+def _notify_change(op, event_id):
+    for listener in _change_listeners:
+        listener(op, event_id)
 
 
 class Database:
     def __init__(self):
-        self._db_file = os.path.join(DATA_DIR, 'person_detections.db')
+        self._db_file = DB_FILE
         self._conn = None
-        self._c = None
+        self._lock = None
         self._table_name = 'person_detections'
 
-        self._PATH_COL = 'path'
-        self._DATE_COL = 'date'
-        self._TIME_COL = 'time'
-        self._NUM_PEOPLE_COL = 'num_people'
-        self._columns = [
-                (self._PATH_COL, 'TEXT'),
-                (self._DATE_COL, 'TEXT'),
-                (self._TIME_COL, 'TEXT'),
-                (self._NUM_PEOPLE_COL, 'INTEGER')]
-
     def connect(self):
-        if not os.path.exists(DATA_DIR):
-            os.makedirs(DATA_DIR)
-        if not os.path.isfile(self._db_file):
-            init_required = True
-        else:
-            init_required = False
-
-        self._conn = sqlite3.connect(self._db_file)
-        self._c = self._conn.cursor()
+        self._conn, self._lock = _connection_mgr.get(self._db_file)
+        return self
 
-        if init_required:
-            create_table_cmd = 'CREATE TABLE {} ('.format(self._table_name)
-            for c in self._columns:
-                create_table_cmd += '{} {}'.format(c[0], c[1])
-                if c != self._columns[-1]:
-                    create_table_cmd += ','
-            create_table_cmd += ')'
-            self._c.execute(create_table_cmd)
-            self._conn.commit()
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
 
-        return self
+    def _write(self, sql, params=()):
+        with self._lock:
+            with self._conn:
+                return self._conn.execute(sql, params)
 
-    def add_entry(self, video_path, date, time, num_people):
+    def add_entry(
+            self, video_path, date, time, num_people, size=None,
+            camera_id=None, keypoints=None):
         try:
-            self._c.execute(
-                    "INSERT INTO {} VALUES ('{}', '{}', '{}', '{}')".format(
-                        self._table_name, video_path, date, time, num_people))
-            self._conn.commit()
+            c = self._write(
+                    'INSERT INTO {} '
+                    '(path, date, time, num_people, size, camera_id, '
+                    'keypoints) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)'.format(self._table_name),
+                    (video_path, date, time, num_people, size, camera_id,
+                     keypoints))
         except sqlite3.IntegrityError:
-            print(
-                    'ERROR: ID already exists in column {}'.format(
-                        self._columns[0]))
+            print('ERROR: Entry already exists for {}'.format(video_path))
+            return
+
+        _notify_change('insert', c.lastrowid)
+
+    def add_entries(self, entries):
+        """
+        Add events in a single transaction.
+
+        Listeners are notified once, without an event id.
+
+        :type entries: list
+        :param entries: Tuples of (video_path, date, time, num_people, size,
+                        camera_id).
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                        'INSERT INTO {} '
+                        '(path, date, time, num_people, size, camera_id) '
+                        'VALUES (?, ?, ?, ?, ?, ?)'.format(self._table_name),
+                        entries)
+
+        _notify_change('insert', None)
 
     def _format_result(self, result):
         entry = {}
@@ -63,78 +193,284 @@ class Database:
         entry['date'] = result[2]
         entry['time'] = result[3]
         entry['num_people'] = result[4]
+        entry['size'] = result[5]
+        entry['thumbnail'] = result[6]
+        entry['keyframes'] = result[7]
+        entry['camera_id'] = result[8]
+        entry['keypoints'] = result[9]
         return entry
 
     def get_all(self, organize_by_date=False):
         try:
-            self._c.execute('SELECT rowid, * FROM {}'.format(self._table_name))
-            results = self._c.fetchall()
+            results = self._query(
+                    'SELECT rowid, * FROM {} ORDER BY date, time'.format(
+                        self._table_name))
         except sqlite3.OperationalError:
             return []
 
         if organize_by_date:
+            # Rows are ordered by time, so each date list is in order too
             all_results = {}
             for result in results:
                 entry = self._format_result(result)
-                if all_results.get(entry['date'], None) is None:
-                    all_results[entry['date']] = [entry]
-                else:
-                    all_results[entry['date']].append(entry)
-
-            # Order lists for each date by the time of the recording
-            for date in all_results:
-                all_results[date] = sorted(all_results[date], key = lambda i: i['time'])
-
+                all_results.setdefault(entry['date'], []).append(entry)
             return all_results
 
         else:
-            all_results = []
-            for result in results:
-                entry = self._format_result(result)
-                all_results.append(entry)
-            return all_results
+            return [self._format_result(result) for result in results]
 
     def get_for_date(self, date):
         try:
-            self._c.execute('SELECT rowid, * FROM {} WHERE {}={}'.format(
-                self._table_name, self._DATE_COL, date))
-            results = self._c.fetchall()
+            results = self._query(
+                    'SELECT rowid, * FROM {} WHERE date=? '
+                    'ORDER BY time'.format(self._table_name), (date,))
         except sqlite3.OperationalError:
             return []
 
-        all_results = []
-        for result in results:
-            entry = self._format_result(result)
-            all_results.append(entry)
+        return [self._format_result(result) for result in results]
 
-        all_results = sorted(all_results, key = lambda i: i['time'])
-        return all_results
+    def _filter(self, start, end, num_people, camera_id):
+        """Build the WHERE terms of the event query filters."""
+        terms = []
+        params = []
+        if start is not None:
+            terms.append('date >= ?')
+            params.append(start)
+        if end is not None:
+            terms.append('date <= ?')
+            params.append(end)
+        if num_people is not None:
+            terms.append('num_people >= ?')
+            params.append(num_people)
+        if camera_id is not None:
+            terms.append('camera_id = ?')
+            params.append(camera_id)
+        return terms, params
+
+    def query_events(
+            self, start=None, end=None, num_people=None, camera_id=None,
+            limit=50, cursor=None):
+        """
+        Return a page of events, most recent first.
+
+        :type start: string
+        :param start: The first date to include, as `YYYY-MM-DD`.
+        :type end: string
+        :param end: The last date to include, as `YYYY-MM-DD`.
+        :type num_people: integer
+        :param num_people: The minimum number of people in the event.
+        :type camera_id: string
+        :param camera_id: Only return events recorded by this camera.
+        :type limit: integer
+        :param limit: The maximum number of events in the page.
+        :type cursor: list
+        :param cursor: The cursor returned with the previous page.
+        :returns: A tuple of the events and the cursor of the next page, or
+                  None for the cursor if this is the last page.
+        """
+        terms, params = self._filter(start, end, num_people, camera_id)
+        if cursor is not None:
+            # Keyset pagination on the (date, time) index, rowid breaks ties
+            # The plain date term lets SQLite seek instead of scan
+            date, time, rowid = cursor
+            terms.append(
+                    'date <= ? AND (date < ? OR (date = ? AND '
+                    '(time < ? OR (time = ? AND rowid < ?))))')
+            params.extend([date, date, date, time, time, rowid])
+
+        sql = 'SELECT rowid, * FROM {}'.format(self._table_name)
+        if len(terms) > 0:
+            sql += ' WHERE ' + ' AND '.join(terms)
+        sql += ' ORDER BY date DESC, time DESC, rowid DESC LIMIT ?'
+        params.append(limit)
+
+        results = [self._format_result(r) for r in self._query(sql, params)]
+        if len(results) < limit:
+            return results, None
+
+        last = results[-1]
+        return results, [last['date'], last['time'], last['id']]
 
     def get_for_id(self, id):
         try:
-            self._c.execute('SELECT rowid, * FROM {} WHERE rowid={}'.format(
-                self._table_name, id))
-            results = self._c.fetchall()
+            results = self._query(
+                    'SELECT rowid, * FROM {} WHERE rowid=?'.format(
+                        self._table_name), (id,))
         except sqlite3.OperationalError:
+            results = []
+
+        if len(results) == 0:
             print('Rowid not found!')
-            return []
+            return None
 
-        entry = self._format_result(results[0])
-        return entry
+        return self._format_result(results[0])
+
+    def get_version(self):
+        """Return the version of the latest change to the events."""
+        results = self._query('SELECT MAX(version) FROM event_log')
+        return results[0][0] or 0
+
+    def get_changes(self, since_version):
+        """
+        Return the changes to the events after `since_version`.
+
+        Rowids of deleted events can be reused, so an id is reported by
+        the latest operation on it only. An id deleted and added again is
+        an inserted entry that replaces the old event.
+
+        :returns: A tuple of the new version, the inserted or updated entries
+                  and the deleted ids, or None if the event log no longer
+                  covers `since_version` and the client needs a full
+                  listing.
+        """
+        with self._lock:
+            oldest, latest = self._conn.execute(
+                    'SELECT MIN(version), MAX(version) '
+                    'FROM event_log').fetchone()
+            if latest is None or latest < since_version:
+                return None
+            if oldest > since_version + 1:
+                return None
+
+            log = self._conn.execute(
+                    'SELECT version, op, event_id FROM event_log '
+                    'WHERE version > ? ORDER BY version',
+                    (since_version,)).fetchall()
+
+        version = since_version
+        last_op = {}
+        for v, op, event_id in log:
+            version = v
+            last_op[event_id] = op
+
+        deleted = [i for i, op in last_op.items() if op == 'delete']
+        inserted_ids = [i for i, op in last_op.items() if op != 'delete']
+        if len(inserted_ids) > _MAX_CHANGED_EVENTS:
+            return None
+
+        inserted = []
+        if len(inserted_ids) > 0:
+            results = self._query(
+                    'SELECT rowid, * FROM {} WHERE rowid IN ({}) '
+                    'ORDER BY date, time'.format(
+                        self._table_name,
+                        ','.join('?' * len(inserted_ids))),
+                    inserted_ids)
+            inserted = [self._format_result(r) for r in results]
+
+        return version, inserted, sorted(deleted)
 
     def delete_by_id(self, id):
         try:
-            self._c.execute('DELETE FROM {} WHERE rowid={}'.format(
-                self._table_name, id))
-            self._conn.commit()
+            self._write(
+                    'DELETE FROM {} WHERE rowid=?'.format(self._table_name),
+                    (id,))
         except sqlite3.OperationalError:
             print('Rowid not found!')
+            return
+
+        _notify_change('delete', id)
+
+    def get_usage(self):
+        """Return the total size in bytes and the number of events."""
+        results = self._query(
+                'SELECT SUM(size), COUNT(*) FROM {}'.format(self._table_name))
+        return results[0][0] or 0, results[0][1]
+
+    def get_missing_sizes(self, limit):
+        """Return up to `limit` (id, path) of events without a size."""
+        return self._query(
+                'SELECT rowid, path FROM {} WHERE size IS NULL '
+                'LIMIT ?'.format(self._table_name), (limit,))
+
+    def set_sizes(self, sizes):
+        """Set the size of events from a list of (id, size)."""
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                        'UPDATE {} SET size=? WHERE rowid=?'.format(
+                            self._table_name),
+                        [(size, id) for id, size in sizes])
+
+    def get_missing_previews(self, limit):
+        """Return up to `limit` (id, path) of events without previews."""
+        return self._query(
+                'SELECT rowid, path FROM {} WHERE thumbnail IS NULL '
+                'ORDER BY rowid DESC LIMIT ?'.format(self._table_name),
+                (limit,))
+
+    def set_previews(self, previews):
+        """
+        Set the previews of events.
+
+        :type previews: list
+        :param previews: Tuples of (id, path, thumbnail, keyframes), with the
+                         path of the video the previews were made from.
+        :returns: The ids of the events deleted, or whose id was reused,
+                  while their previews were made. Nothing refers to those
+                  previews.
+        """
+        updated = []
+        deleted = []
+        with self._lock:
+            with self._conn:
+                for id, path, thumbnail, keyframes in previews:
+                    cursor = self._conn.execute(
+                            'UPDATE {} SET thumbnail=?, keyframes=? '
+                            'WHERE rowid=? AND path=?'.format(
+                                self._table_name),
+                            (thumbnail, keyframes, id, path))
+                    if cursor.rowcount > 0:
+                        updated.append(id)
+                    else:
+                        deleted.append(id)
+
+        for id in updated:
+            _notify_change('update', id)
+        return deleted
+
+    def get_oldest(self, limit, before_date=None):
+        """Return up to `limit` events, oldest first."""
+        sql = 'SELECT rowid, * FROM {}'.format(self._table_name)
+        params = []
+        if before_date is not None:
+            sql += ' WHERE date < ?'
+            params.append(before_date)
+        sql += ' ORDER BY date, time, rowid LIMIT ?'
+        params.append(limit)
+        return [self._format_result(r) for r in self._query(sql, params)]
+
+    def delete_by_ids(self, ids):
+        """
+        Delete events in a single transaction.
+
+        :returns: The deleted events.
+        """
+        if len(ids) == 0:
+            return []
+
+        placeholders = ','.join('?' * len(ids))
+        with self._lock:
+            with self._conn:
+                # Rows can't change between reading their files and deleting
+                # them, or previews set meanwhile would never be removed
+                self._conn.execute('BEGIN IMMEDIATE')
+                results = self._conn.execute(
+                        'SELECT rowid, * FROM {} WHERE rowid IN ({})'.format(
+                            self._table_name, placeholders), ids).fetchall()
+                self._conn.execute(
+                        'DELETE FROM {} WHERE rowid IN ({})'.format(
+                            self._table_name, placeholders), ids)
+
+        entries = [self._format_result(r) for r in results]
+        for entry in entries:
+            _notify_change('delete', entry['id'])
+        return entries
 
     def close(self):
-        if self._conn is not None:
-            self._conn.close()
-            self._conn = None
-            self._c = None
+        # The connection is shared, so only drop this instance's reference
+        self._conn = None
+        self._lock = None
 
     def __enter__(self):
         self.connect()
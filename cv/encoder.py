@@ -0,0 +1,152 @@
+import io
+import cv2
+import numpy as np
+
+SUBSAMPLING = ['420', '422', '444']
+BACKENDS = ['turbojpeg', 'opencv', 'pil']
+# Resize buffers kept, one per stream resolution in use
+_MAX_BUFFERS = 4
+
+
+class _OpenCVBackend:
+    """JPEG encoding with `cv2.imencode`."""
+    name = 'opencv'
+
+    def __init__(self, subsampling):
+        self._params = []
+        # Older OpenCV builds only encode 4:2:0
+        if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):
+            self._params = [
+                    cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                    getattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR_' + subsampling)
+                    ]
+        elif subsampling != '420':
+            raise ValueError(
+                    'OpenCV {} only supports 4:2:0 subsampling'.format(
+                        cv2.__version__))
+
+    def encode(self, image, quality):
+        jpeg = cv2.imencode(
+                '.jpg', image,
+                [cv2.IMWRITE_JPEG_QUALITY, quality] + self._params)[1]
+        # The transport needs bytes, this is the only copy
+        return jpeg.tobytes()
+
+
+class _TurboJPEGBackend:
+    """JPEG encoding with libjpeg-turbo through PyTurboJPEG."""
+    name = 'turbojpeg'
+
+    def __init__(self, subsampling):
+        import turbojpeg
+        # Raises RuntimeError when the shared library is not installed
+        self._turbojpeg = turbojpeg.TurboJPEG()
+        self._pixel_format = turbojpeg.TJPF_BGR
+        self._subsampling = getattr(turbojpeg, 'TJSAMP_' + subsampling)
+
+    def encode(self, image, quality):
+        # Encoded straight into the bytes object that is sent
+        return self._turbojpeg.encode(
+                image, quality=quality, pixel_format=self._pixel_format,
+                jpeg_subsample=self._subsampling)
+
+
+class _PILBackend:
+    """JPEG encoding with Pillow, which is built on libjpeg-turbo."""
+    name = 'pil'
+    _SUBSAMPLING = {'444': 0, '422': 1, '420': 2}
+
+    def __init__(self, subsampling):
+        from PIL import Image
+        self._image = Image
+        self._subsampling = self._SUBSAMPLING[subsampling]
+
+    def encode(self, image, quality):
+        height, width = image.shape[:2]
+        # The raw decoder swaps BGR to RGB while reading the array
+        pil_image = self._image.frombuffer(
+                'RGB', (width, height), image, 'raw', 'BGR', 0, 1)
+        output = io.BytesIO()
+        pil_image.save(
+                output, 'JPEG', quality=quality,
+                subsampling=self._subsampling)
+        return output.getvalue()
+
+
+_BACKEND_CLASSES = {
+        'opencv': _OpenCVBackend,
+        'turbojpeg': _TurboJPEGBackend,
+        'pil': _PILBackend
+        }
+
+
+def available_backends(subsampling='420'):
+    """Return the names of the JPEG backends that can be loaded."""
+    names = []
+    for name in BACKENDS:
+        try:
+            _BACKEND_CLASSES[name](subsampling)
+        except (ImportError, OSError, RuntimeError, ValueError):
+            continue
+        names.append(name)
+    return names
+
+
+class FrameEncoder:
+    """
+    Resize and JPEG encode live feed frames.
+
+    Frames are resized into preallocated buffers, one per stream resolution,
+    instead of a new array per frame, and frames that already fit are
+    encoded as they are. The encoded bytes are the payload the transport
+    sends. The buffers are reused, so an encoder is only used from one
+    thread.
+
+    :type backend: string
+    :param backend: 'turbojpeg', 'opencv' or 'pil', or 'auto' for the first
+                    of these that is installed.
+    :type subsampling: string
+    :param subsampling: Chroma subsampling, '420', '422' or '444'. 4:2:0 is
+                        the smallest and fastest to encode.
+    """
+    def __init__(self, backend='auto', subsampling='420'):
+        if subsampling not in SUBSAMPLING:
+            raise ValueError(
+                    'Unknown subsampling: {}'.format(subsampling))
+        if backend == 'auto':
+            backend = available_backends(subsampling)[0]
+        if backend not in _BACKEND_CLASSES:
+            raise ValueError('Unknown JPEG backend: {}'.format(backend))
+        self._backend = _BACKEND_CLASSES[backend](subsampling)
+        self.backend = backend
+        self.subsampling = subsampling
+        self._buffers = {}
+
+    def _resize(self, frame, width, height):
+        """Fit the frame within `width` x `height`, keeping its aspect."""
+        frame_height, frame_width = frame.shape[:2]
+        scale = min(width / frame_width, height / frame_height)
+        size = (max(int(frame_width * scale), 1),
+                max(int(frame_height * scale), 1))
+        if size == (frame_width, frame_height):
+            return frame
+
+        shape = (size[1], size[0]) + frame.shape[2:]
+        key = (shape, frame.dtype)
+        buffer = self._buffers.get(key, None)
+        if buffer is None:
+            if len(self._buffers) >= _MAX_BUFFERS:
+                self._buffers.clear()
+            buffer = np.empty(shape, dtype=frame.dtype)
+            self._buffers[key] = buffer
+        return cv2.resize(frame, size, dst=buffer)
+
+    def encode(self, frame, width, height, quality):
+        """
+        Return the JPEG bytes of a frame fit within `width` x `height`.
+
+        :type quality: integer
+        :param quality: The JPEG quality, 0 to 100.
+        """
+        image = np.ascontiguousarray(self._resize(frame, width, height))
+        return self._backend.encode(image, int(quality))
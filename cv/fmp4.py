@@ -0,0 +1,238 @@
+import queue
+import struct
+import subprocess
+import threading
+import traceback
+import cv2
+
+# H.264 baseline profile level 3.1, as ffmpeg is told to encode below
+CODEC = 'video/mp4; codecs="avc1.42E01F"'
+
+# Seconds stop() waits for ffmpeg to flush before killing it
+_STOP_TIMEOUT = 5.0
+
+_BOX_HEADER = struct.Struct('>I4s')
+_LARGE_SIZE = struct.Struct('>Q')
+
+
+def _read_box(stream):
+    """Return the type and bytes of the next MP4 box, None at the end."""
+    header = stream.read(_BOX_HEADER.size)
+    if len(header) < _BOX_HEADER.size:
+        return None
+    size, box_type = _BOX_HEADER.unpack(header)
+    if size == 1:
+        large = stream.read(_LARGE_SIZE.size)
+        header += large
+        size = _LARGE_SIZE.unpack(large)[0]
+    body = stream.read(size - len(header))
+    return box_type, header + body
+
+
+def _iter_boxes(data, start=0, end=None):
+    """Yield the type, body start and end of the boxes in `data`."""
+    end = len(data) if end is None else end
+    while start + _BOX_HEADER.size <= end:
+        size, box_type = _BOX_HEADER.unpack_from(data, start)
+        header_size = _BOX_HEADER.size
+        if size == 1:
+            size = _LARGE_SIZE.unpack_from(data, start + header_size)[0]
+            header_size += _LARGE_SIZE.size
+        yield box_type, start + header_size, start + size
+        start += size
+
+
+def sample_count(segment):
+    """Return the number of frames in a media segment."""
+    count = 0
+    for box_type, start, end in _iter_boxes(segment):
+        if box_type != b'moof':
+            continue
+        for traf_type, traf_start, traf_end in _iter_boxes(
+                segment, start, end):
+            if traf_type != b'traf':
+                continue
+            for trun_type, trun_start, _ in _iter_boxes(
+                    segment, traf_start, traf_end):
+                if trun_type == b'trun':
+                    # After the version and flags of the full box
+                    count += struct.unpack_from(
+                            '>I', segment, trun_start + 4)[0]
+    return count
+
+
+class Fmp4Encoder:
+    """
+    Encode the live feed to H.264 in fragmented MP4 segments with ffmpeg.
+
+    Frames are resized and written to ffmpeg by an encoder thread, and a
+    reader thread splits ffmpeg's output into the initialization segment,
+    sent once with `update_init`, and media segments of `key_period` seconds
+    that each start with a keyframe, sent with `update_segment`. A viewer
+    can start from any segment, and one that drops segments skips ahead
+    instead of losing the picture.
+
+    Frames are timestamped when ffmpeg reads them, so frames dropped because
+    the encoder fell behind leave no gaps in the timing.
+
+    :type server_comm: :class:`client.ServerComm`
+    :param server_comm: The connected server communication object.
+    :type error_queue: :class:`queue.Queue`
+    :param error_queue: Queue the exception and traceback are put on if
+                        encoding fails.
+    :type width: integer
+    :param width: The width of the stream, the height keeps the aspect.
+    :type bitrate: integer
+    :param bitrate: The target bitrate in kbit/s.
+    :type key_period: float
+    :param key_period: Seconds between keyframes, and so the duration of a
+                       segment and the least latency added.
+    """
+    def __init__(
+            self, server_comm, error_queue, width=640, bitrate=800,
+            key_period=0.5):
+        self._server_comm = server_comm
+        self._error_queue = error_queue
+        self._width = width
+        self._bitrate = bitrate
+        self._key_period = key_period
+        # Two frames, more only adds latency when ffmpeg falls behind
+        self._frame_queue = queue.Queue(maxsize=2)
+        self._process = None
+        self._threads = [
+                threading.Thread(
+                    target=self._run, args=(self._encode,), name='fmp4-encode',
+                    daemon=True),
+                threading.Thread(
+                    target=self._run, args=(self._read,), name='fmp4-read',
+                    daemon=True)
+                ]
+        self._started = threading.Event()
+        self.dropped = 0
+        self.segments = 0
+        self.bytes = 0
+
+    def _command(self, width, height):
+        return [
+                'ffmpeg', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                '-s', '{}x{}'.format(width, height),
+                '-use_wallclock_as_timestamps', '1', '-i', 'pipe:0',
+                '-c:v', 'libx264', '-preset', 'ultrafast',
+                '-tune', 'zerolatency', '-profile:v', 'baseline',
+                '-level', '3.1', '-pix_fmt', 'yuv420p',
+                '-b:v', '{}k'.format(self._bitrate),
+                '-maxrate', '{}k'.format(self._bitrate),
+                '-bufsize', '{}k'.format(self._bitrate // 2),
+                '-force_key_frames',
+                'expr:gte(t,n_forced*{})'.format(self._key_period),
+                '-vsync', 'passthrough',
+                '-f', 'mp4',
+                '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+                'pipe:1'
+                ]
+
+    def put(self, frame):
+        """Queue a frame without blocking, dropping it if ffmpeg is behind."""
+        try:
+            self._frame_queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def _encode(self):
+        try:
+            while True:
+                frame = self._frame_queue.get()
+                if frame is None:
+                    break
+
+                height, width = frame.shape[:2]
+                if width != self._width:
+                    # H.264 needs even dimensions
+                    height = int(height * self._width / width) // 2 * 2
+                    frame = cv2.resize(frame, (self._width, height))
+                if self._process is None:
+                    self._process = subprocess.Popen(
+                            self._command(self._width, height),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                    self._started.set()
+                try:
+                    self._process.stdin.write(frame.tobytes())
+                except BrokenPipeError:
+                    raise RuntimeError(
+                            'ffmpeg exited with code {}'.format(
+                                self._process.wait()))
+        finally:
+            if self._process is not None:
+                try:
+                    self._process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            # Wakes the reader if no frame ever arrived or ffmpeg failed to
+            # start
+            self._started.set()
+
+    def _read(self):
+        self._started.wait()
+        if self._process is None:
+            return
+
+        init = b''
+        segment = b''
+        while True:
+            box = _read_box(self._process.stdout)
+            if box is None:
+                break
+
+            box_type, data = box
+            if box_type in (b'ftyp', b'moov'):
+                init += data
+                if box_type == b'moov':
+                    self._server_comm.send_update_init(init, CODEC)
+            elif box_type == b'moof':
+                segment = data
+            elif box_type == b'mdat':
+                segment += data
+                self._server_comm.emit_segment(segment)
+                self.segments += 1
+                self.bytes += len(segment)
+        self._process.wait()
+
+    def _run(self, target):
+        try:
+            target()
+        except Exception as e:
+            tb = traceback.format_exc()
+            self._error_queue.put((e, tb))
+            raise e
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop encoding, sending the segment in progress.
+
+        Returns even if ffmpeg failed, killing it if it doesn't exit in
+        time.
+        """
+        # The encoder thread may have stopped with the queue full
+        while True:
+            try:
+                self._frame_queue.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self._frame_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+        for thread in self._threads:
+            thread.join(_STOP_TIMEOUT)
+        if self._process is not None and self._process.poll() is None:
+            print('[WARNING] Killing ffmpeg, it did not exit')
+            self._process.kill()
+        for thread in self._threads:
+            thread.join(_STOP_TIMEOUT)
@@ -0,0 +1,208 @@
+import threading
+import traceback
+import queue
+import time
+import edgeiq
+
+# Engine and accelerator pairs tried after the requested one fails to load
+_FALLBACKS = [
+        ('DNN_OPENVINO', 'CPU'),
+        ('DNN', 'CPU')
+        ]
+
+
+def load_estimator(model_id, engine, accelerator):
+    """
+    Load a pose estimator, falling back to the CPU if the accelerator fails.
+
+    :type model_id: string
+    :param model_id: The alwaysAI model id.
+    :type engine: string
+    :param engine: The name of the :class:`edgeiq.Engine` to try first.
+    :type accelerator: string
+    :param accelerator: The name of the :class:`edgeiq.Accelerator` to try
+                        first.
+    :returns: The loaded :class:`edgeiq.PoseEstimation`, and the engine and
+              accelerator names it was loaded with.
+    """
+    candidates = [(engine, accelerator)]
+    candidates += [c for c in _FALLBACKS if c != (engine, accelerator)]
+    for i, (engine_name, accelerator_name) in enumerate(candidates):
+        pose_estimator = edgeiq.PoseEstimation(model_id)
+        try:
+            pose_estimator.load(
+                    engine=getattr(edgeiq.Engine, engine_name),
+                    accelerator=getattr(edgeiq.Accelerator, accelerator_name))
+            return pose_estimator, engine_name, accelerator_name
+        except Exception as e:
+            if i == len(candidates) - 1:
+                raise e
+            print('[WARNING] Failed to load {} on {}/{}: {}'.format(
+                model_id, engine_name, accelerator_name, e))
+
+
+class _RequestThread(threading.Thread):
+    """Run inference requests on one loaded estimator."""
+    def __init__(self, pose_estimator, request_queue, complete, error_queue):
+        self._pose_estimator = pose_estimator
+        self._request_queue = request_queue
+        self._complete = complete
+        self._error_queue = error_queue
+        self.inference_time = 0.0
+        self.num_inferences = 0
+        super(_RequestThread, self).__init__(daemon=True)
+
+    def _run_requests(self):
+        while True:
+            request = self._request_queue.get()
+            if request is None:
+                break
+            seq, frame = request
+            start = time.perf_counter()
+            results = self._pose_estimator.estimate(frame)
+            self.inference_time += time.perf_counter() - start
+            self.num_inferences += 1
+            self._complete(seq, results)
+
+    def run(self):
+        try:
+            self._run_requests()
+        except Exception as e:
+            tb = traceback.format_exc()
+            self._error_queue.put((e, tb))
+            raise e
+
+
+class AsyncInference:
+    """
+    Keep several pose inference requests in flight, returning results in
+    frame order.
+
+    Each request has its own loaded estimator on its own thread, so the next
+    frame is captured and the previous results post-processed while the
+    model runs. The estimator releases the GIL while the model runs, so the
+    requests overlap on multi-core CPUs as well as on accelerators.
+
+    :type model_id: string
+    :param model_id: The alwaysAI model id.
+    :type engine: string
+    :param engine: The name of the :class:`edgeiq.Engine` to try first.
+    :type accelerator: string
+    :param accelerator: The name of the :class:`edgeiq.Accelerator` to try
+                        first, the CPU is used if it fails to load.
+    :type num_requests: integer
+    :param num_requests: The number of requests in flight.
+    :type error_queue: :class:`queue.Queue`
+    :param error_queue: Queue the exception and traceback are put on if a
+                        request fails.
+    """
+    def __init__(
+            self, model_id, engine='DNN_OPENVINO', accelerator='MYRIAD',
+            num_requests=1, error_queue=None):
+        self._model_id = model_id
+        self._engine_name = engine
+        self._accelerator_name = accelerator
+        self._num_requests = num_requests
+        self._error_queue = error_queue
+        if self._error_queue is None:
+            self._error_queue = queue.Queue()
+
+        self._request_queue = queue.Queue()
+        self._in_flight = threading.BoundedSemaphore(num_requests)
+        self._cond = threading.Condition()
+        # Completed (tag, results, inferred) by sequence number, until their
+        # turn
+        self._completed = {}
+        self._tags = {}
+        self._next_submit = 0
+        self._next_get = 0
+        self._closed = False
+        self._threads = []
+        self.engine = None
+        self.accelerator = None
+
+    def _load_estimator(self):
+        # Later requests load straight onto whatever the first one got
+        loaded = load_estimator(
+                self._model_id, self._engine_name, self._accelerator_name)
+        pose_estimator, self._engine_name, self._accelerator_name = loaded
+        return pose_estimator
+
+    def load(self):
+        for _ in range(self._num_requests):
+            pose_estimator = self._load_estimator()
+            self._threads.append(_RequestThread(
+                pose_estimator, self._request_queue, self._complete,
+                self._error_queue))
+        self.engine = pose_estimator.engine
+        self.accelerator = pose_estimator.accelerator
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def _complete(self, seq, results):
+        with self._cond:
+            self._completed[seq] = (self._tags.pop(seq), results, True)
+            self._cond.notify_all()
+
+    def submit(self, frame, tag=None):
+        """
+        Queue a frame for inference, blocking while all requests are busy.
+
+        :type frame: numpy array
+        :param frame: The frame to run the model on. With None, no inference
+                      is run and None is returned as its results, in order
+                      with the other frames.
+        :param tag: Returned with the results.
+        """
+        if frame is not None:
+            self._in_flight.acquire()
+        with self._cond:
+            seq = self._next_submit
+            self._next_submit += 1
+            if frame is None:
+                self._completed[seq] = (tag, None, False)
+                self._cond.notify_all()
+                return
+            self._tags[seq] = tag
+        self._request_queue.put((seq, frame))
+
+    def get(self):
+        """
+        Block until the results of the next frame in order are ready.
+
+        :returns: The tag and results of the frame, or None once closed.
+        """
+        with self._cond:
+            while self._next_get not in self._completed and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            tag, results, inferred = self._completed.pop(self._next_get)
+            self._next_get += 1
+
+        if inferred:
+            self._in_flight.release()
+        return tag, results
+
+    def get_stats(self):
+        """Return the number of inferences and the total inference time."""
+        return {
+                'inferences': sum(t.num_inferences for t in self._threads),
+                'inference_time': sum(t.inference_time for t in self._threads)
+                }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for _ in self._threads:
+            self._request_queue.put(None)
+        # Unblock a submit waiting on a request slot
+        for _ in self._threads:
+            try:
+                self._in_flight.release()
+            except ValueError:
+                break
+        for thread in self._threads:
+            thread.join()
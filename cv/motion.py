@@ -0,0 +1,81 @@
+import time
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    Decide whether a frame is worth running the pose model on.
+
+    Frames are downscaled to grayscale and compared against a running
+    average background. The model runs when the fraction of changed pixels
+    crosses the threshold, and at least once per keep-alive period so
+    someone standing still is not lost.
+
+    :type threshold: float
+    :param threshold: The fraction of pixels that must change to count as
+                      motion.
+    :type keepalive_period: float
+    :param keepalive_period: The longest time in seconds between inferences
+                             on a static scene.
+    :type width: integer
+    :param width: The width frames are downscaled to before comparing.
+    :type pixel_threshold: integer
+    :param pixel_threshold: The grayscale difference at which a pixel counts
+                            as changed.
+    :type learning_rate: float
+    :param learning_rate: The weight of each frame in the background, so
+                          slow changes like lighting blend in.
+    """
+    def __init__(
+            self, threshold=0.005, keepalive_period=2.0, width=160,
+            pixel_threshold=25, learning_rate=0.05):
+        self._threshold = threshold
+        self._keepalive_period = keepalive_period
+        self._width = width
+        self._pixel_threshold = pixel_threshold
+        self._learning_rate = learning_rate
+
+        self._background = None
+        self._last_pass = 0
+        self.motion = 0.0
+        self.frames = 0
+        self.skipped = 0
+
+    def _preprocess(self, frame):
+        height = max(int(frame.shape[0] * self._width / frame.shape[1]), 1)
+        # Area interpolation averages out sensor noise while downscaling
+        small = cv2.resize(
+                frame, (self._width, height), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+    def check(self, frame):
+        """Return True if the frame should be passed to the model."""
+        gray = self._preprocess(frame)
+        if self._background is None or self._background.shape != gray.shape:
+            self._background = gray
+            self.motion = 1.0
+        else:
+            diff = np.abs(gray - self._background)
+            self.motion = np.count_nonzero(
+                    diff > self._pixel_threshold) / diff.size
+            self._background += self._learning_rate * (
+                    gray - self._background)
+
+        self.frames += 1
+        now = time.time()
+        if (self.motion >= self._threshold or
+                now - self._last_pass >= self._keepalive_period):
+            self._last_pass = now
+            return True
+
+        self.skipped += 1
+        return False
+
+    def get_stats(self):
+        """Return the number of frames checked and skipped."""
+        return {
+                'frames': self.frames,
+                'skipped': self.skipped,
+                'skip_fraction': self.skipped / max(self.frames, 1)
+                }
@@ -0,0 +1,350 @@
+import threading
+import traceback
+import queue
+import time
+import edgeiq
+import metrics
+from tracker import CentroidTracker, pose_points
+
+
+class LatestSlot:
+    """
+    Single item handoff between two pipeline stages.
+
+    A newer item replaces one the consumer has not picked up yet, so a slow
+    consumer drops stale frames instead of stalling the producer.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._closed = False
+        self.drops = 0
+
+    def put(self, item):
+        with self._cond:
+            if self._item is not None:
+                self.drops += 1
+            self._item = item
+            self._cond.notify()
+
+    def get(self):
+        """Block until an item is available. Returns None once closed."""
+        with self._cond:
+            while self._item is None and not self._closed:
+                self._cond.wait()
+            item = self._item
+            self._item = None
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class _StageThread(threading.Thread):
+    """
+    Run one pipeline stage on items from the input slot.
+
+    The time `work` takes per item is observed in `histogram`, if given.
+    """
+    def __init__(
+            self, name, work, in_slot, out_slot, exit_event, error_queue,
+            histogram=None):
+        self._work = work
+        self._in_slot = in_slot
+        self._out_slot = out_slot
+        self._exit_event = exit_event
+        self._error_queue = error_queue
+        self._histogram = histogram
+        self.fps = edgeiq.FPS()
+        super(_StageThread, self).__init__(name=name, daemon=True)
+
+    def _run_stage(self):
+        self.fps.start()
+        while not self._exit_event.is_set():
+            if self._in_slot is not None:
+                item = self._in_slot.get()
+                if item is None:
+                    break
+            else:
+                item = {}
+
+            start = time.perf_counter()
+            item = self._work(item)
+            if item is None:
+                continue
+            if self._histogram is not None:
+                self._histogram.observe(time.perf_counter() - start)
+
+            if self._out_slot is not None:
+                self._out_slot.put(item)
+            self.fps.update()
+
+    def run(self):
+        try:
+            self._run_stage()
+        except Exception as e:
+            tb = traceback.format_exc()
+            self._error_queue.put((e, tb))
+            self._exit_event.set()
+            raise e
+        finally:
+            self.fps.stop()
+
+
+class Pipeline:
+    """
+    Capture, inference, encode and emit stages, each on its own thread.
+
+    The inference stage submits frames to the inference engine without
+    waiting for the results, and the results stage collects them in frame
+    order, so capture overlaps the requests in flight.
+
+    :type video_stream: edgeiq video stream
+    :param video_stream: The started video stream to read frames from.
+    :type inference: :class:`inference.AsyncInference`
+    :param inference: The loaded inference engine.
+    :type server_comm: :class:`client.ServerComm`
+    :param server_comm: The connected server communication object.
+    :type max_capture_fps: float
+    :param max_capture_fps: Upper bound on the capture rate, since the video
+                            stream returns its latest frame without blocking.
+    :type motion_gate: :class:`motion.MotionGate`
+    :param motion_gate: Skips inference on frames without motion, reusing
+                        the previous results. Every frame is inferred when
+                        None.
+    :type recorder: :class:`recording.EventRecorder`
+    :param recorder: Given every frame with the ids of the tracked people in
+                     it, and their poses when inferred, to record events.
+                     Nothing is recorded when None.
+    :type analytics: :class:`analytics.WorkoutAnalytics`
+    :param analytics: Updated with the keypoints of the tracked people, its
+                      counts are sent with the frames when they change.
+    :type live_encoder: :class:`fmp4.Fmp4Encoder`
+    :param live_encoder: Given every frame to send the live feed as
+                         fragmented MP4, instead of encoding and emitting
+                         JPEG frames. JPEG frames are sent when None.
+    """
+    def __init__(
+            self, video_stream, inference, server_comm,
+            max_capture_fps=30, motion_gate=None, recorder=None,
+            analytics=None, live_encoder=None):
+        self._video_stream = video_stream
+        self._inference_engine = inference
+        self._server_comm = server_comm
+        self._capture_period = 1.0 / max_capture_fps
+        self._last_capture = 0
+        self._motion_gate = motion_gate
+        self._recorder = recorder
+        self._tracker = CentroidTracker()
+        self._analytics = analytics
+        self._live_encoder = live_encoder
+        self._sent_workout_version = None
+        self._last_results = None
+        self._last_people = []
+        self._start_time = time.time()
+
+        self.metrics = metrics.Registry()
+        self._inference_latency = self.metrics.histogram(
+                'inference_latency_seconds',
+                'Time from submitting a frame to receiving its results')
+        self._frame_latency = self.metrics.histogram(
+                'frame_latency_seconds',
+                'Time from capturing a frame to sending it')
+
+        self._exit_event = threading.Event()
+        self._error_queue = queue.Queue()
+
+        self._slots = {
+                'inference': LatestSlot(),
+                'encode': LatestSlot(),
+                'emit': LatestSlot()
+                }
+
+        self._stages = [
+                _StageThread(
+                    'capture', self._capture, None,
+                    self._slots['inference'], self._exit_event,
+                    self._error_queue, None),
+                _StageThread(
+                    'inference', self._inference, self._slots['inference'],
+                    None, self._exit_event, self._error_queue,
+                    self._stage_histogram('inference')),
+                _StageThread(
+                    'results', self._results, None, self._slots['encode'],
+                    self._exit_event, self._error_queue, None),
+                _StageThread(
+                    'encode', self._encode, self._slots['encode'],
+                    self._slots['emit'], self._exit_event,
+                    self._error_queue, self._stage_histogram('encode')),
+                _StageThread(
+                    'emit', self._emit, self._slots['emit'], None,
+                    self._exit_event, self._error_queue,
+                    self._stage_histogram('emit'))
+                ]
+
+    def _capture(self, item):
+        delay = self._last_capture + self._capture_period - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self._last_capture = time.time()
+
+        # Timed here, the stage itself mostly sleeps to the capture rate
+        with self._stage_histogram('capture').time():
+            item['frame'] = self._video_stream.read()
+        if item['frame'] is None:
+            # End of a file source
+            return None
+        item['timestamp'] = self._last_capture
+        return item
+
+    def _inference(self, item):
+        if (self._motion_gate is not None and
+                not self._motion_gate.check(item['frame'])):
+            # Passed through in order, the results stage fills in the
+            # previous results
+            self._inference_engine.submit(None, item)
+        else:
+            item['submitted'] = time.perf_counter()
+            self._inference_engine.submit(item['frame'], item)
+        return item
+
+    def _results(self, item):
+        completed = self._inference_engine.get()
+        if completed is None:
+            return None
+
+        item, results = completed
+        item['inferred'] = results is not None
+        if item['inferred']:
+            self._inference_latency.observe(
+                    time.perf_counter() - item['submitted'])
+        if results is None:
+            results = self._last_results
+        else:
+            # Only new results move the tracks, skipped frames reuse them
+            poses = getattr(results, 'poses', None) or []
+            points = pose_points(poses)
+            matches = self._tracker.update(points)
+            tracks = {i: points[n] for i, n in matches.items()}
+            item['poses'] = [
+                    (i, getattr(poses[n], 'score', 0.0), points[n])
+                    for i, n in matches.items()]
+            self._last_people = list(tracks)
+            if self._analytics is not None:
+                self._analytics.update(item['timestamp'], tracks)
+        item['results'] = results
+        item['people'] = self._last_people
+        self._last_results = results
+        if self._recorder is not None:
+            # Queued without waiting, the recorder encodes on its own thread
+            self._recorder.put(
+                    item['frame'], item['timestamp'], item['people'],
+                    item.get('poses', None))
+        return item
+
+    def _encode(self, item):
+        if self._live_encoder is not None:
+            # The encoder sends its own segments, nothing is left to emit
+            self._live_encoder.put(item['frame'])
+            self._send_workout()
+            return None
+        # Skip frames above the send rate the server can keep up with
+        if not self._server_comm.frame_due():
+            return None
+        item['payload'] = self._server_comm.encode_frame(item['frame'])
+        return item
+
+    def _emit(self, item):
+        self._server_comm.emit_frame(item['payload'])
+        self._frame_latency.observe(time.time() - item['timestamp'])
+        self._send_workout()
+        return item
+
+    def _send_workout(self):
+        if (self._analytics is not None and
+                self._analytics.version != self._sent_workout_version):
+            workout = self._analytics.get_state()
+            self._server_comm.send_update_workout(workout)
+            self._sent_workout_version = workout['version']
+
+    def _stage_histogram(self, stage):
+        return self.metrics.histogram(
+                'stage_seconds', 'Time spent in a pipeline stage per frame',
+                {'stage': stage})
+
+    def start(self):
+        self._start_time = time.time()
+        for stage in self._stages:
+            stage.start()
+
+    def check_for_errors(self):
+        try:
+            error, traceback = self._error_queue.get_nowait()
+            print(traceback)
+            raise error
+        except queue.Empty:
+            pass
+
+    def stop(self):
+        self._exit_event.set()
+        for slot in self._slots.values():
+            slot.close()
+        self._inference_engine.close()
+        for stage in self._stages:
+            stage.join()
+
+    def get_stats(self):
+        """Return throughput of each stage and drops at its input slot."""
+        stats = []
+        for stage in self._stages:
+            slot = self._slots.get(stage.name, None)
+            stats.append({
+                'stage': stage.name,
+                'fps': stage.fps.compute_fps(),
+                'drops': slot.drops if slot is not None else 0
+                })
+        return stats
+
+    def get_inference_stats(self):
+        """
+        Return inference counts and the model time saved by the motion gate.
+
+        The saved time is the skipped frames at the mean inference time,
+        and `busy` is the model time per second of wall time, above one when
+        requests overlap.
+        """
+        stats = self._inference_engine.get_stats()
+        num_inferences = stats['inferences']
+        mean_time = stats['inference_time'] / max(num_inferences, 1)
+        skipped = 0
+        if self._motion_gate is not None:
+            skipped = self._motion_gate.skipped
+        return {
+                'inferences': num_inferences,
+                'skipped': skipped,
+                'skip_fraction': skipped / max(num_inferences + skipped, 1),
+                'mean_time': mean_time,
+                'saved_time': skipped * mean_time,
+                'busy': stats['inference_time'] / max(
+                    time.time() - self._start_time, 1e-3)
+                }
+
+    def get_metrics(self):
+        """Return the histogram snapshots and the drops at each slot."""
+        return {
+                'histograms': self.metrics.snapshot(),
+                'drops': {name: s.drops for name, s in self._slots.items()}
+                }
+
+    def print_stats(self):
+        for s in self.get_stats():
+            print('[INFO] {:<10} {:6.2f} FPS, {} dropped'.format(
+                s['stage'], s['fps'], s['drops']))
+        s = self.get_inference_stats()
+        print(
+                '[INFO] Inference {:.3f} s per frame, busy {:.0%}, skipped '
+                '{:.0%} of frames, saving {:.1f} s'.format(
+                    s['mean_time'], s['busy'], s['skip_fraction'],
+                    s['saved_time']))
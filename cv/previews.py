@@ -0,0 +1,141 @@
+import os
+import threading
+import traceback
+import cv2
+import edgeiq
+import database
+
+
+class PreviewWorker(threading.Thread):
+    """
+    Extract a poster image and a keyframe strip for each recorded event.
+
+    Events are added to the database once their video is saved, so the
+    worker picks up events without previews and reads their finished video.
+    The images are written to `database.THUMBNAIL_DIR` and their filenames
+    stored with the event, then the server is notified so web clients fetch
+    the updated events. Previews of events deleted while they were made are
+    removed again.
+
+    :type server_comm: :class:`client.ServerComm`
+    :param server_comm: The connected server communication object.
+    :type error_queue: :class:`queue.Queue`
+    :param error_queue: Queue the exception and traceback are put on if the
+                        worker fails.
+    :type num_keyframes: integer
+    :param num_keyframes: The number of frames in the keyframe strip, evenly
+                          spaced through the video.
+    :type width: integer
+    :param width: The width of the poster and of each keyframe.
+    :type check_period: float
+    :param check_period: The time in seconds between checks for new events.
+    :type batch_size: integer
+    :param batch_size: The number of events processed per database update.
+    """
+    JPEG_QUALITY = 70
+
+    def __init__(
+            self, server_comm, error_queue, num_keyframes=6, width=160,
+            check_period=5.0, batch_size=10):
+        self._server_comm = server_comm
+        self._error_queue = error_queue
+        self._num_keyframes = num_keyframes
+        self._width = width
+        self._check_period = check_period
+        self._batch_size = batch_size
+        self._stop_event = threading.Event()
+        super(PreviewWorker, self).__init__(name='previews', daemon=True)
+
+    def _read_keyframes(self, path):
+        """Return evenly spaced frames of the video, resized."""
+        cap = cv2.VideoCapture(path)
+        try:
+            num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            if num_frames <= 0:
+                return []
+
+            frames = []
+            step = num_frames / self._num_keyframes
+            for i in range(self._num_keyframes):
+                # Sample the middle of each segment, skipping fades at the
+                # start and end of the clip
+                cap.set(cv2.CAP_PROP_POS_FRAMES, int((i + 0.5) * step))
+                ok, frame = cap.read()
+                if not ok:
+                    continue
+                frames.append(edgeiq.resize(
+                    frame, width=self._width, keep_scale=True))
+            return frames
+        finally:
+            cap.release()
+
+    def _write(self, filename, image):
+        cv2.imwrite(
+                os.path.join(database.THUMBNAIL_DIR, filename), image,
+                [cv2.IMWRITE_JPEG_QUALITY, self.JPEG_QUALITY])
+
+    def _extract(self, path):
+        """Write the previews of a video and return their filenames."""
+        frames = self._read_keyframes(
+                os.path.join(database.VIDEO_DIR, os.path.basename(path)))
+        if len(frames) == 0:
+            print('[WARNING] No frames read from {}'.format(path))
+            return '', ''
+
+        name = os.path.splitext(os.path.basename(path))[0]
+        thumbnail = '{}.jpg'.format(name)
+        keyframes = '{}_keyframes.jpg'.format(name)
+        self._write(thumbnail, frames[len(frames) // 2])
+        self._write(keyframes, cv2.hconcat(frames))
+        return thumbnail, keyframes
+
+    def _remove(self, filenames):
+        for filename in filenames:
+            if not filename:
+                continue
+            try:
+                os.remove(os.path.join(database.THUMBNAIL_DIR, filename))
+            except FileNotFoundError:
+                pass
+
+    def _fill_previews(self):
+        """Extract previews of all pending events, returning the count."""
+        num_filled = 0
+        while not self._stop_event.is_set():
+            with database.Database() as db:
+                missing = db.get_missing_previews(self._batch_size)
+            if len(missing) == 0:
+                break
+
+            previews = []
+            for event_id, path in missing:
+                thumbnail, keyframes = self._extract(path)
+                previews.append((event_id, path, thumbnail, keyframes))
+            with database.Database() as db:
+                deleted = set(db.set_previews(previews))
+            for event_id, _, thumbnail, keyframes in previews:
+                if event_id in deleted:
+                    self._remove((thumbnail, keyframes))
+            num_filled += len(previews) - len(deleted)
+        return num_filled
+
+    def _run_worker(self):
+        if not os.path.exists(database.THUMBNAIL_DIR):
+            os.makedirs(database.THUMBNAIL_DIR)
+
+        while not self._stop_event.is_set():
+            if self._fill_previews() > 0:
+                self._server_comm.send_notify_db_update()
+            self._stop_event.wait(self._check_period)
+
+    def run(self):
+        try:
+            self._run_worker()
+        except Exception as e:
+            tb = traceback.format_exc()
+            self._error_queue.put((e, tb))
+            raise e
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
@@ -0,0 +1,112 @@
+import threading
+
+
+class StreamQualityController:
+    """
+    Adjust live feed quality from the stream stats reported by the server.
+
+    On congestion the controller first lowers the JPEG quality, then the
+    resolution, then the send rate. When there is headroom again it restores
+    them in the reverse order, one step per report.
+
+    :type max_width: integer
+    :param max_width: The width of the full resolution stream.
+    :type max_height: integer
+    :param max_height: The height of the full resolution stream.
+    :type max_fps: float
+    :param max_fps: The highest send rate.
+    :type target_latency: float
+    :param target_latency: The per-client delivery latency in seconds to stay
+                           below.
+    :type max_bandwidth: integer
+    :param max_bandwidth: Optional upper bound on bytes per second sent to
+                          the server.
+    """
+    QUALITY_STEP = 10
+    MIN_QUALITY = 30
+    MAX_QUALITY = 90
+    SCALES = [1.0, 0.75, 0.5, 0.375]
+    MIN_FPS = 2
+
+    def __init__(
+            self, max_width=640, max_height=480, max_fps=30,
+            target_latency=0.25, max_bandwidth=None):
+        self._max_width = max_width
+        self._max_height = max_height
+        self._max_fps = max_fps
+        self._target_latency = target_latency
+        self._max_bandwidth = max_bandwidth
+        # Stats and encode run on different threads
+        self._lock = threading.Lock()
+
+        self._quality = self.MAX_QUALITY
+        self._scale_idx = 0
+        self._fps = max_fps
+
+    def _is_congested(self, stats, bandwidth):
+        if stats.get('drops', 0) > 0:
+            return True
+        latency = stats.get('latency', None)
+        if latency is not None and latency > self._target_latency:
+            return True
+        if self._max_bandwidth is not None and bandwidth > self._max_bandwidth:
+            return True
+        return False
+
+    def _has_headroom(self, stats, bandwidth):
+        latency = stats.get('latency', None)
+        if latency is not None and latency > self._target_latency / 2:
+            return False
+        if (self._max_bandwidth is not None and
+                bandwidth > 0.8 * self._max_bandwidth):
+            return False
+        return True
+
+    def _decrease(self):
+        if self._quality > self.MIN_QUALITY:
+            self._quality = max(
+                    self._quality - self.QUALITY_STEP, self.MIN_QUALITY)
+        elif self._scale_idx < len(self.SCALES) - 1:
+            self._scale_idx += 1
+        else:
+            self._fps = max(self._fps / 2, self.MIN_FPS)
+
+    def _increase(self):
+        if self._fps < self._max_fps:
+            self._fps = min(self._fps + 2, self._max_fps)
+        elif self._scale_idx > 0:
+            self._scale_idx -= 1
+        elif self._quality < self.MAX_QUALITY:
+            self._quality = min(
+                    self._quality + self.QUALITY_STEP, self.MAX_QUALITY)
+
+    def update(self, stats, bandwidth):
+        """
+        Apply one control step.
+
+        :type stats: dictionary
+        :param stats: The `update_stream_stats` message from the server.
+        :type bandwidth: float
+        :param bandwidth: The measured bytes per second sent to the server.
+        :returns: True if the settings changed.
+        """
+        with self._lock:
+            prev = self._get_settings()
+            if self._is_congested(stats, bandwidth):
+                self._decrease()
+            elif self._has_headroom(stats, bandwidth):
+                self._increase()
+            return self._get_settings() != prev
+
+    def _get_settings(self):
+        scale = self.SCALES[self._scale_idx]
+        return {
+                'width': int(self._max_width * scale),
+                'height': int(self._max_height * scale),
+                'quality': self._quality,
+                'fps': self._fps
+                }
+
+    def get_settings(self):
+        with self._lock:
+            return self._get_settings()
@@ -0,0 +1,396 @@
+import collections
+import math
+import os
+import queue
+import threading
+import time
+import traceback
+import cv2
+import numpy as np
+import database
+import keypoints
+
+
+class PreRollBuffer:
+    """
+    Ring of JPEG-compressed frames covering the last `duration` seconds.
+
+    Frames are copied into one preallocated byte arena in write order, with
+    their offsets, lengths and timestamps in preallocated index lists. Writing
+    a frame evicts the oldest frames it overlaps or that are older than
+    `duration`, so the buffered frames take no memory beyond the arena and
+    index however long the camera runs. Only those are preallocated: the
+    encoded JPEG passed to :meth:`put` and the frames copied out by
+    :meth:`get_frames` are still allocated per frame.
+
+    :type duration: float
+    :param duration: The number of seconds of frames to keep.
+    :type max_fps: float
+    :param max_fps: The highest frame rate, which sizes the index.
+    :type bytes_per_frame: integer
+    :param bytes_per_frame: The expected JPEG size, which sizes the arena.
+                            Larger frames evict more old ones.
+    """
+    def __init__(self, duration=5.0, max_fps=30, bytes_per_frame=64 * 1024):
+        self._duration = duration
+        self._max_frames = int(math.ceil(duration * max_fps)) + 1
+        self._data = bytearray(self._max_frames * bytes_per_frame)
+        self._offsets = [0] * self._max_frames
+        self._lengths = [0] * self._max_frames
+        self._timestamps = [0.0] * self._max_frames
+        self._head = 0
+        self._count = 0
+        self._write_pos = 0
+        self._raw_frame_bytes = 0
+        self._lock = threading.Lock()
+        self.skipped = 0
+
+    def _evict(self):
+        self._head = (self._head + 1) % self._max_frames
+        self._count -= 1
+
+    def put(self, jpeg, timestamp, raw_frame_bytes=0):
+        """
+        Add a JPEG frame.
+
+        :type jpeg: bytes
+        :param jpeg: The encoded frame.
+        :type timestamp: float
+        :param timestamp: The capture time of the frame.
+        :type raw_frame_bytes: integer
+        :param raw_frame_bytes: The size of the frame before encoding, for
+                                :meth:`get_stats`.
+        """
+        length = len(jpeg)
+        if length > len(self._data):
+            self.skipped += 1
+            return
+
+        with self._lock:
+            pos = self._write_pos
+            if pos + length > len(self._data):
+                # Frames left in the tail are the oldest, drop them and wrap
+                while self._count > 0 and self._offsets[self._head] >= pos:
+                    self._evict()
+                pos = 0
+
+            while self._count > 0:
+                i = self._head
+                overlaps = (self._offsets[i] < pos + length and
+                            pos < self._offsets[i] + self._lengths[i])
+                if (overlaps or self._count == self._max_frames or
+                        self._timestamps[i] < timestamp - self._duration):
+                    self._evict()
+                else:
+                    break
+
+            self._data[pos:pos + length] = jpeg
+            i = (self._head + self._count) % self._max_frames
+            self._offsets[i] = pos
+            self._lengths[i] = length
+            self._timestamps[i] = timestamp
+            self._count += 1
+            self._write_pos = pos + length
+            self._raw_frame_bytes = raw_frame_bytes
+
+    def get_frames(self, since=None):
+        """Return a copy of the (timestamp, jpeg) frames, oldest first."""
+        with self._lock:
+            frames = []
+            for n in range(self._count):
+                i = (self._head + n) % self._max_frames
+                if since is not None and self._timestamps[i] <= since:
+                    continue
+                start = self._offsets[i]
+                frames.append((
+                    self._timestamps[i],
+                    bytes(self._data[start:start + self._lengths[i]])))
+            return frames
+
+    def get_stats(self):
+        """Return the memory used against buffering the raw frames."""
+        with self._lock:
+            used = 0
+            for n in range(self._count):
+                used += self._lengths[(self._head + n) % self._max_frames]
+            return {
+                    'frames': self._count,
+                    'used_bytes': used,
+                    'allocated_bytes': len(self._data),
+                    'raw_bytes': self._count * self._raw_frame_bytes
+                    }
+
+
+class _EventWriterThread(threading.Thread):
+    """
+    Decode buffered JPEG frames into event videos, write the poses to
+    keypoint archives and add the events.
+
+    Videos are written at `fps`. Frames are repeated or skipped by their
+    capture timestamps, so a video plays in real time whatever rate its
+    frames were captured or dropped at.
+    """
+    def __init__(self, job_queue, server_comm, camera_id, fps, error_queue):
+        self._job_queue = job_queue
+        self._server_comm = server_comm
+        self._camera_id = camera_id
+        self._fps = fps
+        self._error_queue = error_queue
+        self._writer = None
+        self._keypoint_writer = None
+        # Capture time the next video frame is shown at
+        self._next_time = None
+        super(_EventWriterThread, self).__init__(
+                name='event-writer', daemon=True)
+
+    def _open(self, path, frame):
+        height, width = frame.shape[:2]
+        # H.264 plays in browsers, not every OpenCV build can write it
+        for codec in ('avc1', 'mp4v'):
+            writer = cv2.VideoWriter(
+                    path, cv2.VideoWriter_fourcc(*codec), self._fps,
+                    (width, height))
+            if writer.isOpened():
+                return writer
+        raise RuntimeError('Unable to open video writer for {}'.format(path))
+
+    def _finish(self, event):
+        self._keypoint_writer.close()
+        self._keypoint_writer = None
+        if self._writer is None:
+            # No video and so no event row, nothing would delete the poses
+            os.remove(event['keypoints'])
+            return
+        self._writer.release()
+        self._writer = None
+
+        num_people = len(event['people'])
+        with database.Database() as db:
+            db.add_entry(
+                    event['path'], event['date'], event['time'], num_people,
+                    os.path.getsize(event['path']), self._camera_id,
+                    os.path.basename(event['keypoints']))
+        print('[INFO] Recorded {} with {} people'.format(
+            os.path.basename(event['path']), num_people))
+        self._server_comm.send_notify_db_update()
+
+    def _write_events(self):
+        event = None
+        while True:
+            job = self._job_queue.get()
+            if job is None:
+                if event is not None:
+                    self._finish(event)
+                break
+
+            cmd, data = job
+            if cmd == 'start':
+                event = data
+                self._keypoint_writer = keypoints.KeypointWriter(
+                        event['keypoints'])
+            elif cmd == 'poses':
+                timestamp, poses = data
+                for person_id, score, points in poses:
+                    self._keypoint_writer.write(
+                            timestamp, person_id, score, points)
+            elif cmd == 'frame':
+                timestamp, jpeg = data
+                # Half a frame early still counts, so jitter in the capture
+                # times doesn't skip and repeat frames at the same rate
+                due = timestamp + 0.5 / self._fps
+                if self._writer is not None and due < self._next_time:
+                    continue
+                frame = cv2.imdecode(
+                        np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if self._writer is None:
+                    self._writer = self._open(event['path'], frame)
+                    self._next_time = timestamp
+                while self._next_time <= due:
+                    self._writer.write(frame)
+                    self._next_time += 1.0 / self._fps
+            elif cmd == 'end':
+                self._finish(event)
+                event = None
+
+    def run(self):
+        try:
+            self._write_events()
+        except Exception as e:
+            tb = traceback.format_exc()
+            self._error_queue.put((e, tb))
+            raise e
+
+
+class EventRecorder(threading.Thread):
+    """
+    Record videos of the events when people are in the frame.
+
+    Every frame is JPEG encoded into a :class:`PreRollBuffer`. When people
+    are tracked, the buffered frames and the following ones go to a writer
+    thread until nobody has been seen for the post-roll time. The writer
+    saves the video and the poses of the event in a keypoint archive, and
+    adds the event to the database, so neither the capture nor the encoding
+    here waits on the disk.
+
+    :type camera_id: string
+    :param camera_id: The camera the events are recorded by.
+    :type server_comm: :class:`client.ServerComm`
+    :param server_comm: Used to notify the server of new events.
+    :type error_queue: :class:`queue.Queue`
+    :param error_queue: Queue the exception and traceback are put on if the
+                        recorder fails.
+    :type pre_roll: float
+    :param pre_roll: The seconds of video kept before people appear.
+    :type post_roll: float
+    :param post_roll: The seconds of video kept after people leave.
+    :type fps: float
+    :param fps: The frame rate of the recordings.
+    :type quality: integer
+    :param quality: The JPEG quality of the buffered frames.
+
+    Frames wait for the writer in a queue of at most the pre-roll and
+    another second of frames. Frames beyond that are dropped from the
+    video and counted in the stats as `write_dropped`.
+    """
+    def __init__(
+            self, camera_id, server_comm, error_queue, pre_roll=5.0,
+            post_roll=5.0, fps=30, quality=80):
+        self._camera_id = camera_id
+        self._error_queue = error_queue
+        self._post_roll = post_roll
+        self._quality = quality
+        # About a second of frames, newer ones are dropped beyond that
+        self._frame_queue = queue.Queue(maxsize=int(fps))
+        self._buffer = PreRollBuffer(pre_roll, fps)
+        self._pre_roll = pre_roll
+        # Poses of the pre-roll, a few hundred bytes each
+        self._recent_poses = collections.deque()
+        # A job per frame and per inferred frame's poses, the pre-roll is
+        # queued at once when an event starts
+        self._job_queue = queue.Queue(
+                maxsize=2 * (int(math.ceil(pre_roll * fps)) + int(fps)))
+        self._writer = _EventWriterThread(
+                self._job_queue, server_comm, camera_id, fps, error_queue)
+        self._event = None
+        self._last_seen = 0
+        self._last_written = None
+        self.dropped = 0
+        self.write_dropped = 0
+        super(EventRecorder, self).__init__(name='recorder', daemon=True)
+
+    def put(self, frame, timestamp, people, poses=None):
+        """
+        Queue a captured frame without blocking.
+
+        :type people: list
+        :param people: The tracker ids of the people in the frame. The
+                       number of different ids is stored with the event.
+        :type poses: list
+        :param poses: Tuples of track id, score and keypoints of shape
+                      (keypoints, 2) for frames that were inferred, None
+                      for frames that reuse earlier results.
+        """
+        try:
+            self._frame_queue.put_nowait((frame, timestamp, people, poses))
+        except queue.Full:
+            self.dropped += 1
+
+    def _put_job(self, job):
+        """Queue a job for the writer, dropping frames it is behind on."""
+        if job is not None and job[0] in ('frame', 'poses'):
+            try:
+                self._job_queue.put_nowait(job)
+            except queue.Full:
+                if job[0] == 'frame':
+                    self.write_dropped += 1
+            return
+
+        # Events are always started and ended, unless the writer failed
+        while self._writer.is_alive():
+            try:
+                self._job_queue.put(job, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def _start_event(self, timestamp, people):
+        t = time.localtime(timestamp)
+        date = time.strftime('%Y-%m-%d', t)
+        start_time = time.strftime('%H:%M:%S', t)
+        name = '{}_{}'.format(
+                self._camera_id, time.strftime('%Y-%m-%d_%H-%M-%S', t))
+        self._event = {
+                'path': os.path.join(database.VIDEO_DIR, name + '.mp4'),
+                'keypoints': os.path.join(
+                    database.KEYPOINT_DIR, name + '.keypoints'),
+                'date': date,
+                'time': start_time,
+                'people': set(people)
+                }
+        self._put_job(('start', self._event))
+        for frame in self._buffer.get_frames(since=self._last_written):
+            self._put_job(('frame', frame))
+        for entry in self._recent_poses:
+            if self._last_written is None or entry[0] > self._last_written:
+                self._put_job(('poses', entry))
+
+    def _record(self):
+        for directory in (database.VIDEO_DIR, database.KEYPOINT_DIR):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        while True:
+            entry = self._frame_queue.get()
+            if entry is None:
+                break
+
+            frame, timestamp, people, poses = entry
+            jpeg = cv2.imencode(
+                    '.jpg', frame,
+                    [cv2.IMWRITE_JPEG_QUALITY, self._quality])[1].tobytes()
+            self._buffer.put(jpeg, timestamp, frame.nbytes)
+            if poses is not None:
+                self._recent_poses.append((timestamp, poses))
+            while (len(self._recent_poses) > 0 and self._recent_poses[0][0] <
+                    timestamp - self._pre_roll):
+                self._recent_poses.popleft()
+            if len(people) > 0:
+                self._last_seen = timestamp
+
+            if self._event is None:
+                if len(people) > 0:
+                    self._start_event(timestamp, people)
+                    self._last_written = timestamp
+                continue
+
+            self._put_job(('frame', (timestamp, jpeg)))
+            if poses is not None:
+                self._put_job(('poses', (timestamp, poses)))
+            self._last_written = timestamp
+            self._event['people'].update(people)
+            if timestamp - self._last_seen > self._post_roll:
+                self._put_job(('end', None))
+                self._event = None
+
+    def run(self):
+        self._writer.start()
+        try:
+            self._record()
+        except Exception as e:
+            tb = traceback.format_exc()
+            self._error_queue.put((e, tb))
+            raise e
+        finally:
+            self._put_job(None)
+
+    def stop(self):
+        """Stop recording, saving the event in progress."""
+        self._frame_queue.put(None)
+        self.join()
+        self._writer.join()
+
+    def get_stats(self):
+        stats = self._buffer.get_stats()
+        stats['dropped'] = self.dropped
+        stats['write_dropped'] = self.write_dropped
+        return stats
@@ -0,0 +1,102 @@
+import multiprocessing
+import os
+import time
+
+
+def parse_camera(spec):
+    """
+    Parse a camera given as `[id=]source`.
+
+    Sources that are integers are webcam indexes, anything else is a video
+    file path. Without an id, the webcam index or the file name is used.
+
+    :returns: A tuple of the camera id and the source.
+    """
+    camera_id, sep, source = spec.partition('=')
+    if not sep:
+        source = camera_id
+        camera_id = None
+
+    if source.isdigit():
+        source = int(source)
+        if camera_id is None:
+            camera_id = 'cam{}'.format(source)
+    elif camera_id is None:
+        camera_id = os.path.splitext(os.path.basename(source))[0]
+    return camera_id, source
+
+
+class CameraSupervisor:
+    """
+    Run a capture and inference worker process per camera.
+
+    Each camera runs `target(camera_id, source, stop_event, **kwargs)` in
+    its own process, so cameras scale across cores instead of sharing the
+    GIL. Workers that fail are restarted after a delay. A worker that
+    returns normally, like one playing a video file to its end, is not.
+
+    :type cameras: list
+    :param cameras: Tuples of camera id and source from
+                    :func:`parse_camera`.
+    :type target: function
+    :param target: The module level function run by each worker.
+    :type kwargs: dictionary
+    :param kwargs: Keyword arguments passed to every worker.
+    :type restart_delay: float
+    :param restart_delay: The time in seconds before restarting a worker.
+    """
+    def __init__(self, cameras, target, kwargs=None, restart_delay=5.0):
+        self._cameras = dict(cameras)
+        self._target = target
+        self._kwargs = kwargs or {}
+        self._restart_delay = restart_delay
+        # Spawned rather than forked, the parent holds sockets and threads
+        self._context = multiprocessing.get_context('spawn')
+        self._stop_event = self._context.Event()
+        self._workers = {}
+        self._restart_at = {}
+
+    def _start(self, camera_id):
+        worker = self._context.Process(
+                target=self._target, name=camera_id,
+                args=(camera_id, self._cameras[camera_id], self._stop_event),
+                kwargs=self._kwargs)
+        worker.start()
+        self._workers[camera_id] = worker
+        print('[INFO] Started camera {} ({}) in process {}'.format(
+            camera_id, self._cameras[camera_id], worker.pid))
+
+    def start(self):
+        for camera_id in self._cameras:
+            self._start(camera_id)
+
+    def check(self):
+        """Restart failed workers, returning the number not finished."""
+        now = time.time()
+        for camera_id, worker in list(self._workers.items()):
+            if worker.is_alive():
+                continue
+
+            if worker.exitcode == 0:
+                print('[INFO] Camera {} finished'.format(camera_id))
+                del self._workers[camera_id]
+            elif camera_id not in self._restart_at:
+                print('[WARNING] Camera {} exited with {}, restarting in '
+                      '{} s'.format(
+                          camera_id, worker.exitcode, self._restart_delay))
+                self._restart_at[camera_id] = now + self._restart_delay
+            elif now >= self._restart_at[camera_id]:
+                del self._restart_at[camera_id]
+                self._start(camera_id)
+        return len(self._workers)
+
+    def stop(self, timeout=10.0):
+        self._stop_event.set()
+        end = time.time() + timeout
+        for worker in self._workers.values():
+            worker.join(max(end - time.time(), 0))
+        for worker in self._workers.values():
+            if worker.is_alive():
+                print('[WARNING] Terminating camera {}'.format(worker.name))
+                worker.terminate()
+                worker.join()
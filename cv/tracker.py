@@ -0,0 +1,230 @@
+import numpy as np
+
+# Cost of pairs that must not be matched, above any real distance
+_NO_MATCH = 1e12
+
+
+def linear_assignment(cost):
+    """
+    Match rows to columns with the lowest total cost.
+
+    Hungarian method with shortest augmenting paths, O(n^2 m) for n rows and
+    m columns, with the column scans done as NumPy operations. Rows start
+    matched to their cheapest column where no other row takes it, so between
+    frames of a tracker only the rows competing for a column are augmented.
+    Every row is matched when there are at least as many columns, and every
+    column otherwise.
+
+    :type cost: numpy array
+    :param cost: Cost matrix of shape (rows, columns).
+    :returns: Arrays of the matched row and column indexes.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    if cost.size == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+
+    n, m = cost.shape
+    # Index 0 is a virtual column, rows and columns are 1-based below.
+    # Reducing each row by its minimum keeps the duals feasible, and makes
+    # each row's cheapest column a valid starting match.
+    u = np.zeros(n + 1)
+    u[1:] = cost.min(axis=1)
+    v = np.zeros(m + 1)
+    match = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    cheapest = cost.argmin(axis=1)
+    cols, first_rows = np.unique(cheapest, return_index=True)
+    match[cols + 1] = first_rows + 1
+    unmatched = []
+    if len(first_rows) < n:
+        unmatched = np.setdiff1d(np.arange(1, n + 1), first_rows + 1)
+
+    for i in unmatched:
+        match[0] = i
+        j0 = 0
+        min_slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = match[j0]
+            free = ~used
+            free[0] = False
+            slack = cost[i0 - 1] - u[i0] - v[1:]
+            better = free[1:] & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = j0
+
+            candidates = np.where(free, min_slack, np.inf)
+            j1 = int(np.argmin(candidates))
+            delta = candidates[j1]
+            u[match[used]] += delta
+            v[used] -= delta
+            min_slack[free] -= delta
+            j0 = j1
+            if match[j0] == 0:
+                break
+
+        while j0 != 0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+
+    cols = np.nonzero(match[1:])[0]
+    rows = match[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def box_points(boxes):
+    """
+    Return the centroids of boxes as points for :class:`CentroidTracker`.
+
+    :type boxes: list
+    :param boxes: (start_x, start_y, end_x, end_y) tuples, or edgeiq
+                  bounding boxes.
+    :returns: Array of shape (boxes, 1, 2).
+    """
+    boxes = np.array([
+        (b.start_x, b.start_y, b.end_x, b.end_y) if hasattr(b, 'start_x')
+        else b for b in boxes], dtype=np.float64).reshape(-1, 4)
+    return ((boxes[:, :2] + boxes[:, 2:]) / 2).reshape(-1, 1, 2)
+
+
+def pose_points(poses):
+    """
+    Return the keypoints of poses as points for :class:`CentroidTracker`.
+
+    Keypoints that were not detected, given as negative coordinates by the
+    pose estimator, are NaN.
+
+    :type poses: list
+    :param poses: edgeiq `HumanPose` objects.
+    :returns: Array of shape (poses, keypoints, 2).
+    """
+    if len(poses) == 0:
+        return np.empty((0, 1, 2))
+    points = np.array(
+            [list(p.key_points.values()) for p in poses], dtype=np.float64)
+    points[(points < 0).any(axis=2)] = np.nan
+    return points
+
+
+def point_distances(a, b):
+    """
+    Return the mean distance over the keypoints visible in both of each pair.
+
+    :type a: numpy array
+    :param a: Points of shape (n, keypoints, 2), NaN where not visible.
+    :type b: numpy array
+    :param b: Points of shape (m, keypoints, 2).
+    :returns: Array of shape (n, m), infinite for pairs with no keypoint
+              visible in both.
+    """
+    # x and y separately, reducing over an axis of two is slow
+    dx = a[:, None, :, 0] - b[None, :, :, 0]
+    dy = a[:, None, :, 1] - b[None, :, :, 1]
+    dist = np.sqrt(dx * dx + dy * dy)
+    visible = ~np.isnan(dist)
+    counts = visible.sum(axis=2)
+    dist[~visible] = 0
+    total = dist.sum(axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, total / counts, np.inf)
+
+
+class CentroidTracker:
+    """
+    Track people across frames by their positions.
+
+    Tracks are matched to detections with the lowest total distance by
+    :func:`linear_assignment`, on the box centroids from :func:`box_points`
+    or the keypoints from :func:`pose_points`. With keypoints, the distance
+    is the mean over the joints visible in both, so people crossing each
+    other keep their ids when their centroids come close. A track that goes
+    unmatched for more than `max_disappeared` updates is removed, so someone
+    briefly hidden keeps their id if they reappear within that window.
+
+    The tracks are kept in arrays and the distances computed as one matrix,
+    so an update costs a few NumPy operations however many people there are.
+
+    :type max_disappeared: integer
+    :param max_disappeared: Updates a track can go unmatched before removal.
+    :type max_distance: float
+    :param max_distance: The furthest in pixels a track is matched.
+    """
+    def __init__(self, max_disappeared=30, max_distance=150.0):
+        self._max_disappeared = max_disappeared
+        self._max_distance = max_distance
+        self._ids = np.empty(0, dtype=int)
+        self._points = None
+        self._disappeared = np.empty(0, dtype=int)
+        self.next_id = 0
+
+    def _register(self, points):
+        ids = np.arange(self.next_id, self.next_id + len(points))
+        self.next_id += len(points)
+        self._ids = np.concatenate([self._ids, ids])
+        self._points = np.concatenate([self._points, points])
+        self._disappeared = np.concatenate([
+            self._disappeared, np.zeros(len(points), dtype=int)])
+
+    def update(self, points):
+        """
+        Match the detections of a frame to the tracks.
+
+        :type points: numpy array
+        :param points: Points of shape (people, keypoints, 2), from
+                       :func:`box_points` or :func:`pose_points`.
+        :returns: Dictionary of the track ids in the frame to the index of
+                  their detection in `points`.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if len(points) == 0 and self._points is not None:
+            # An empty frame ages the tracks whatever its point shape
+            points = np.empty((0,) + self._points.shape[1:])
+        if self._points is None or self._points.shape[1] != points.shape[1]:
+            # First update, or a change between boxes and keypoints
+            self._ids = np.empty(0, dtype=int)
+            self._points = np.empty((0,) + points.shape[1:])
+            self._disappeared = np.empty(0, dtype=int)
+
+        matched_tracks = np.zeros(len(self._ids), dtype=bool)
+        matched_points = np.zeros(len(points), dtype=bool)
+        frame_ids = {}
+        if len(self._ids) > 0 and len(points) > 0:
+            dist = point_distances(self._points, points)
+            cost = np.where(dist <= self._max_distance, dist, _NO_MATCH)
+            rows, cols = linear_assignment(cost)
+            keep = cost[rows, cols] < _NO_MATCH
+            rows, cols = rows[keep], cols[keep]
+
+            # Joints not detected this frame keep their last position
+            new_points = points[cols]
+            self._points[rows] = np.where(
+                    np.isnan(new_points), self._points[rows], new_points)
+            self._disappeared[rows] = 0
+            matched_tracks[rows] = True
+            matched_points[cols] = True
+            frame_ids.update(zip(self._ids[rows].tolist(), cols.tolist()))
+
+        self._disappeared[~matched_tracks] += 1
+        keep = self._disappeared <= self._max_disappeared
+        self._ids = self._ids[keep]
+        self._points = self._points[keep]
+        self._disappeared = self._disappeared[keep]
+
+        first_id = self.next_id
+        self._register(points[~matched_points])
+        frame_ids.update(zip(
+            range(first_id, self.next_id),
+            np.nonzero(~matched_points)[0].tolist()))
+        return frame_ids
+
+    def get_tracks(self):
+        """Return the ids of all tracks, including ones not in the frame."""
+        return self._ids.tolist()
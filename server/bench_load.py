@@ -0,0 +1,232 @@
+"""
+Load test the server relay and event database with synthetic clients.
+
+Usage:
+
+    $ python3 bench_load.py [--events 1000000] [--fps 30] [--frame-kb 40]
+                            [--stream-clients 10] [--content-clients 10]
+
+Seeds a temporary database, starts the `WebInterface` in a separate process
+and connects a synthetic `/cv` publisher, live feed clients and event list
+clients to it. Live feed clients acknowledge frames like the web page does,
+event list clients repeatedly send `query_db` and some of them `delete`.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import socketio
+import database
+
+# Run in the server process, with the database in the temporary directory
+_SERVER_SCRIPT = '''
+import os
+import sys
+import database
+database.DATA_DIR = sys.argv[1]
+database.VIDEO_DIR = os.path.join(sys.argv[1], 'recordings')
+database.THUMBNAIL_DIR = os.path.join(sys.argv[1], 'thumbnails')
+database.DB_FILE = os.path.join(sys.argv[1], 'person_detections.db')
+import server
+web_interface = server.WebInterface(port=int(sys.argv[2]))
+try:
+    web_interface.setup()
+finally:
+    web_interface.close()
+'''
+
+_CAMERA_ID = 'bench'
+
+
+def _seed(num_events, batch_size=10000):
+    """Add events spread over the last years, a batch per transaction."""
+    start = time.time() - num_events * 60
+    with database.Database() as db:
+        for i in range(0, num_events, batch_size):
+            entries = []
+            for j in range(i, min(i + batch_size, num_events)):
+                t = time.localtime(start + j * 60)
+                entries.append((
+                    'bench_{}.mp4'.format(j),
+                    time.strftime('%Y-%m-%d', t),
+                    time.strftime('%H:%M:%S', t),
+                    random.randint(1, 4), 1024 * 1024, _CAMERA_ID))
+            db.add_entries(entries)
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return 'n/a'
+    return 'p50 {:.1f} ms, p99 {:.1f} ms'.format(
+            1000 * values[len(values) // 2],
+            1000 * values[int(len(values) * 0.99)])
+
+
+class _StreamClient:
+    """Live feed client that acknowledges every frame it receives."""
+    def __init__(self, url):
+        self.latencies = []
+        self.frames = 0
+        self._sio = socketio.Client()
+        self._sio.on('web-data', self._on_data, namespace='/web-stream')
+        self._sio.connect(url, namespaces=['/web-stream'])
+        self._sio.emit(
+                'user-cmd', {'cmd': 'subscribe', 'camera_id': _CAMERA_ID},
+                namespace='/web-stream')
+
+    def _on_data(self, msg):
+        if msg['cmd'] != 'update_frame':
+            return
+        self.frames += 1
+        self.latencies.append(time.time() - msg['sent'])
+        self._sio.emit(
+                'user-cmd', {'cmd': 'frame_ack', 'ts': msg['ts']},
+                namespace='/web-stream')
+
+    def close(self):
+        self._sio.disconnect()
+
+
+class _ContentClient(threading.Thread):
+    """Event list client that queries the full listing in a loop."""
+    def __init__(self, url, exit_event, delete_prob, max_id):
+        self.latencies = []
+        self._exit_event = exit_event
+        self._delete_prob = delete_prob
+        self._max_id = max_id
+        self._reply = threading.Event()
+        self._sio = socketio.Client()
+        self._sio.on('web-data', self._on_data, namespace='/web-content')
+        self._sio.connect(url, namespaces=['/web-content'])
+        super(_ContentClient, self).__init__(daemon=True)
+
+    def _on_data(self, msg):
+        if msg['cmd'] == 'update_text':
+            json.loads(msg['data'])
+            self._reply.set()
+
+    def run(self):
+        while not self._exit_event.is_set():
+            if self._max_id > 0 and random.random() < self._delete_prob:
+                self._sio.emit(
+                        'user-cmd',
+                        {'cmd': 'delete',
+                         'data': random.randint(1, self._max_id)},
+                        namespace='/web-content')
+
+            self._reply.clear()
+            start = time.time()
+            self._sio.emit(
+                    'user-cmd', {'cmd': 'query_db', 'version': 0},
+                    namespace='/web-content')
+            if self._reply.wait(5.0):
+                self.latencies.append(time.time() - start)
+            # Roughly a user reloading the page
+            self._exit_event.wait(random.uniform(0.1, 0.5))
+
+    def close(self):
+        self._sio.disconnect()
+
+
+def _publish(url, fps, frame_size, duration):
+    """Send frames at `fps` for `duration` seconds, returning the count."""
+    sio = socketio.Client()
+    sio.connect(
+            url + '?camera_id={}'.format(_CAMERA_ID), namespaces=['/cv'])
+    frame = os.urandom(frame_size)
+    num_frames = 0
+    start = time.time()
+    while time.time() - start < duration:
+        sio.emit('cv-cmd', {
+            'cmd': 'update_frame', 'data': frame, 'camera_id': _CAMERA_ID,
+            'sent': time.time()})
+        num_frames += 1
+        delay = start + num_frames / fps - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    sio.disconnect()
+    return num_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--frame-kb', type=int, default=40)
+    parser.add_argument('--stream-clients', type=int, default=10)
+    parser.add_argument('--content-clients', type=int, default=10)
+    parser.add_argument('--delete-prob', type=float, default=0.05,
+                        help='Chance of a delete before each query')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--port', type=int, default=5050)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+    database.DATA_DIR = data_dir
+    database.DB_FILE = os.path.join(data_dir, 'person_detections.db')
+    start = time.time()
+    _seed(args.events)
+    print('Seeded {} events in {:.1f} s'.format(
+        args.events, time.time() - start))
+
+    url = 'http://localhost:{}'.format(args.port)
+    server = subprocess.Popen(
+            [sys.executable, '-c', _SERVER_SCRIPT, data_dir, str(args.port)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL)
+    exit_event = threading.Event()
+    stream_clients = []
+    content_clients = []
+    try:
+        time.sleep(3.0)
+        stream_clients = [
+                _StreamClient(url) for _ in range(args.stream_clients)]
+        content_clients = [
+                _ContentClient(url, exit_event, args.delete_prob, args.events)
+                for _ in range(args.content_clients)]
+        for c in content_clients:
+            c.start()
+
+        num_sent = _publish(
+                url, args.fps, args.frame_kb * 1024, args.duration)
+        exit_event.set()
+        time.sleep(1.0)
+        with urllib.request.urlopen(url + '/stats/cache') as response:
+            cache_stats = json.loads(response.read().decode('utf-8'))
+    finally:
+        exit_event.set()
+        for c in stream_clients + content_clients:
+            c.close()
+        server.terminate()
+        server.wait()
+        shutil.rmtree(data_dir)
+
+    num_received = sum(c.frames for c in stream_clients)
+    expected = num_sent * max(len(stream_clients), 1)
+    print('Frames sent: {}, {:.1f} FPS'.format(
+        num_sent, num_sent / args.duration))
+    print('Relay throughput: {:.1f} frames/s, {:.2f} MB/s'.format(
+        num_received / args.duration,
+        num_received * args.frame_kb / 1024 / args.duration))
+    print('Drop rate: {:.1%}'.format(1 - num_received / expected))
+    print('Frame latency, all clients: {}'.format(_percentiles(
+        [lat for c in stream_clients for lat in c.latencies])))
+    for i, c in enumerate(stream_clients):
+        print('  Client {}: {} frames, {}'.format(
+            i, c.frames, _percentiles(c.latencies)))
+    print('update_text latency: {} over {} queries'.format(
+        _percentiles([lat for c in content_clients for lat in c.latencies]),
+        sum(len(c.latencies) for c in content_clients)))
+    print('Event cache: {}'.format(cache_stats))
+
+
+if __name__ == "__main__":
+    main()
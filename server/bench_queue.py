@@ -0,0 +1,87 @@
+"""
+Compare idle CPU and put to get latency of the Tx queues.
+
+Usage:
+
+    $ python3 bench_queue.py [--idle-time 5] [--messages 1000]
+
+Runs under `eventlet.monkey_patch()` like the server, and compares the
+blocking `CircularQueue` against the previous polling implementation.
+"""
+import argparse
+import collections
+import threading
+import time
+import random
+import server
+
+
+class PollingCircularQueue:
+    """The previous queue, which polls the deque every 10 ms."""
+    def __init__(self, max_size=None):
+        self._queue = collections.deque(maxlen=max_size)
+
+    def put(self, item):
+        self._queue.appendleft(item)
+
+    def get(self):
+        while True:
+            try:
+                return self._queue.pop()
+            except IndexError:
+                time.sleep(0.01)
+
+
+def _measure_idle_cpu(q, idle_time):
+    """CPU seconds used by a reader waiting on an empty queue."""
+    reader = threading.Thread(target=q.get)
+    reader.start()
+    start_cpu = time.process_time()
+    time.sleep(idle_time)
+    cpu = time.process_time() - start_cpu
+    q.put('stop')
+    reader.join()
+    return cpu
+
+
+def _measure_latency(q, num_messages):
+    """Put to get latencies in seconds, sorted."""
+    latencies = []
+
+    def _reader():
+        for _ in range(num_messages):
+            ts = q.get()
+            latencies.append(time.perf_counter() - ts)
+
+    reader = threading.Thread(target=_reader)
+    reader.start()
+    for _ in range(num_messages):
+        # Let the reader block before each put, like a live feed would
+        time.sleep(random.uniform(0.001, 0.005))
+        q.put(time.perf_counter())
+    reader.join()
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--idle-time', type=float, default=5.0)
+    parser.add_argument('--messages', type=int, default=1000)
+    args = parser.parse_args()
+
+    print('{:<10} {:>14} {:>12} {:>12}'.format(
+        'Queue', 'Idle CPU %', 'p50 ms', 'p99 ms'))
+    queues = [
+            ('polling', PollingCircularQueue),
+            ('blocking', server.CircularQueue)]
+    for name, queue_cls in queues:
+        idle_cpu = _measure_idle_cpu(queue_cls(2), args.idle_time)
+        latencies = _measure_latency(queue_cls(2), args.messages)
+        print('{:<10} {:>14.3f} {:>12.3f} {:>12.3f}'.format(
+            name, 100 * idle_cpu / args.idle_time,
+            1000 * latencies[len(latencies) // 2],
+            1000 * latencies[int(len(latencies) * 0.99)]))
+
+
+if __name__ == "__main__":
+    main()
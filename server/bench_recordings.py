@@ -0,0 +1,84 @@
+"""
+Compare seek latency and CPU per MB of the recording endpoints.
+
+Usage:
+
+    $ python3 bench_recordings.py [--size-mb 64] [--requests 200]
+
+Writes a synthetic recording, then requests random ranges from it through
+the `/recordings/<filename>` endpoint and the static `/data` route, like a
+player scrubbing through a video.
+"""
+import argparse
+import os
+import random
+import time
+import server
+import database
+
+_FILENAME = 'bench_recording.mp4'
+# Bytes a player asks for after a seek
+_RANGE_SIZE = 512 * 1024
+
+
+def _make_recording(size_mb):
+    if not os.path.exists(database.VIDEO_DIR):
+        os.makedirs(database.VIDEO_DIR)
+    path = os.path.join(database.VIDEO_DIR, _FILENAME)
+    with open(path, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+    return path
+
+
+def _measure(client, url, size, num_requests):
+    """Range request latencies in seconds, sorted, and CPU seconds per MB."""
+    latencies = []
+    num_bytes = 0
+    start_cpu = time.process_time()
+    for _ in range(num_requests):
+        start = random.randrange(0, size - _RANGE_SIZE)
+        headers = {'Range': 'bytes={}-{}'.format(
+            start, start + _RANGE_SIZE - 1)}
+        start_time = time.perf_counter()
+        response = client.get(url, headers=headers)
+        data = response.get_data()
+        latencies.append(time.perf_counter() - start_time)
+        response.close()
+        assert response.status_code == 206, response.status_code
+        num_bytes += len(data)
+    cpu = time.process_time() - start_cpu
+    return sorted(latencies), cpu / (num_bytes / (1024 * 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    path = _make_recording(args.size_mb)
+    size = os.path.getsize(path)
+    # Unthrottled, to measure the route itself
+    server._app.config['RECORDING_RATE'] = None
+    client = server._app.test_client()
+
+    try:
+        print('{:<12} {:>10} {:>10} {:>12}'.format(
+            'Route', 'p50 ms', 'p99 ms', 'CPU ms/MB'))
+        routes = [
+                ('static', '/data/recordings/' + _FILENAME),
+                ('recordings', '/recordings/' + _FILENAME)]
+        for name, url in routes:
+            latencies, cpu_per_mb = _measure(
+                    client, url, size, args.requests)
+            print('{:<12} {:>10.3f} {:>10.3f} {:>12.3f}'.format(
+                name, 1000 * latencies[len(latencies) // 2],
+                1000 * latencies[int(len(latencies) * 0.99)],
+                1000 * cpu_per_mb))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import math
+import mmap
+import struct
+
+MAGIC = b'BWKP'
+FORMAT_VERSION = 1
+# Magic, format version and keypoints per record
+_HEADER = struct.Struct('<4sHH')
+_TIMESTAMP = struct.Struct('<d')
+
+
+def _record_struct(num_keypoints):
+    # Timestamp, track id, pose score and an x, y pair per keypoint
+    return struct.Struct('<dif' + 'ff' * num_keypoints)
+
+
+class KeypointWriter:
+    """
+    Append the poses of an event to a keypoint archive file.
+
+    The file is a header followed by fixed-width little-endian records, one
+    per person per inferred frame, in timestamp order. Keypoints that were
+    not detected are NaN.
+
+    :type path: string
+    :param path: The file to create.
+    :type num_keypoints: integer
+    :param num_keypoints: The keypoints of each pose.
+    """
+    def __init__(self, path, num_keypoints=18):
+        self._record = _record_struct(num_keypoints)
+        self._num_keypoints = num_keypoints
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, FORMAT_VERSION, num_keypoints))
+        self.records = 0
+
+    def write(self, timestamp, person_id, score, points):
+        """
+        Add a pose.
+
+        :type points: list
+        :param points: (x, y) pairs, NaN where not detected.
+        """
+        values = [timestamp, person_id, score]
+        for x, y in points:
+            values.append(x)
+            values.append(y)
+        self._file.write(self._record.pack(*values))
+        self.records += 1
+
+    def close(self):
+        self._file.close()
+
+
+class KeypointArchive:
+    """
+    Read a keypoint archive through a memory map.
+
+    Time ranges are found by binary search on the record timestamps, so a
+    query reads only the records it returns however long the event is.
+
+    :type path: string
+    :param path: The archive written by :class:`KeypointWriter`.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(
+                    self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self._file.close()
+            raise ValueError('Not a keypoint archive: {}'.format(path))
+
+        # A header cut short is not an archive either
+        if len(self._map) < _HEADER.size:
+            self.close()
+            raise ValueError('Not a keypoint archive: {}'.format(path))
+        magic, version, num_keypoints = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise ValueError('Not a keypoint archive: {}'.format(path))
+        self.num_keypoints = num_keypoints
+        self._record = _record_struct(num_keypoints)
+        # A record cut short by a crash while writing is ignored
+        self._num_records = (
+                (len(self._map) - _HEADER.size) // self._record.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._num_records
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _timestamp(self, i):
+        return _TIMESTAMP.unpack_from(
+                self._map, _HEADER.size + i * self._record.size)[0]
+
+    def _bisect(self, timestamp, after=False):
+        """
+        Return the index of the first record at or after `timestamp`, or
+        strictly after it when `after` is True.
+        """
+        lo, hi = 0, self._num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = self._timestamp(mid)
+            if t < timestamp or (after and t == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def time_range(self):
+        """Return the first and last timestamps, None if empty."""
+        if self._num_records == 0:
+            return None
+        return self._timestamp(0), self._timestamp(self._num_records - 1)
+
+    def next_time(self, timestamp):
+        """Return the first timestamp after `timestamp`, None if none."""
+        i = self._bisect(timestamp, after=True)
+        if i == self._num_records:
+            return None
+        return self._timestamp(i)
+
+    def query(self, start=None, end=None, limit=None):
+        """
+        Return the poses from `start` up to but not including `end`.
+
+        :type start: float
+        :param start: Timestamp of the first pose, from the first record
+                      when None.
+        :type end: float
+        :param end: Timestamp the poses end before, to the last record when
+                    None.
+        :type limit: integer
+        :param limit: The most poses returned.
+        :returns: A list of dictionaries with the timestamp `t`, the track
+                  `id`, the pose `score` and the `keypoints` as [x, y]
+                  pairs, None where not detected.
+        """
+        first = 0 if start is None else self._bisect(start)
+        last = self._num_records if end is None else self._bisect(end)
+        if limit is not None:
+            last = min(last, first + limit)
+
+        poses = []
+        for i in range(first, last):
+            values = self._record.unpack_from(
+                    self._map, _HEADER.size + i * self._record.size)
+            keypoints = []
+            for k in range(3, len(values), 2):
+                if math.isnan(values[k]):
+                    keypoints.append(None)
+                else:
+                    keypoints.append([values[k], values[k + 1]])
+            poses.append({
+                't': values[0],
+                'id': values[1],
+                'score': values[2],
+                'keypoints': keypoints
+                })
+        return poses
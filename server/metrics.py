@@ -0,0 +1,203 @@
+import bisect
+import threading
+import time
+
+# Upper bounds in seconds, from sub-millisecond queue hops to slow inference
+DEFAULT_BUCKETS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0)
+
+
+class Histogram:
+    """
+    Fixed bucket histogram of durations in seconds.
+
+    Observing is a bisect and an increment, so it is cheap enough to call
+    for every frame. Percentiles are estimated from the bucket bounds.
+
+    :type buckets: tuple
+    :param buckets: The upper bound of each bucket, in increasing order.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        # The last count is for values above the largest bucket
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def time(self):
+        """Return a context manager that observes the time spent in it."""
+        return _Timer(self)
+
+    def _percentile(self, counts, total, p):
+        rank = p * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank:
+                # Values above the largest bucket report its bound
+                return self._buckets[min(i, len(self._buckets) - 1)]
+        return None
+
+    def snapshot(self):
+        """
+        Return the counts as a dictionary that can be sent as a message.
+
+        `buckets` is a list of [upper bound, cumulative count] pairs.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total_sum = self._sum
+
+        total = sum(counts)
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self._buckets, counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {
+                'count': total,
+                'sum': total_sum,
+                'buckets': buckets,
+                'p50': self._percentile(counts, total, 0.5) if total else None,
+                'p99': self._percentile(counts, total, 0.99) if total else None
+                }
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+            '{}="{}"'.format(k, str(v).replace('"', '\\"'))
+            for k, v in sorted(labels.items())) + '}'
+
+
+class Registry:
+    """
+    Named histograms, gauges and counters, rendered in the Prometheus text
+    format.
+
+    Gauges and counters are read from a function when rendered, so queue
+    depths and drop counts are never stale and cost nothing between scrapes.
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def histogram(
+            self, name, description, labels=None, buckets=DEFAULT_BUCKETS):
+        """Return the histogram with `name` and `labels`, adding it first."""
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._help[name] = description
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            return self._histograms[key]
+
+    def gauge(self, name, description, read):
+        """
+        Add a gauge read when rendered.
+
+        :type read: function
+        :param read: Returns a number, or a list of (labels, number) tuples.
+        """
+        with self._lock:
+            self._help[name] = description
+            self._gauges[name] = (read, 'gauge')
+
+    def counter(self, name, description, read):
+        """
+        Add a counter read when rendered, its name should end in `_total`.
+
+        :type read: function
+        :param read: Returns a number that only goes up, or a list of
+                     (labels, number) tuples.
+        """
+        with self._lock:
+            self._help[name] = description
+            self._gauges[name] = (read, 'counter')
+
+    def snapshot(self):
+        """Return the snapshots of all histograms, keyed by name."""
+        with self._lock:
+            histograms = list(self._histograms.items())
+
+        snapshot = {}
+        for (name, labels), histogram in histograms:
+            snapshot.setdefault(name, []).append(
+                    {'labels': dict(labels), 'value': histogram.snapshot()})
+        return snapshot
+
+    def render(self, remote=None):
+        """
+        Return all metrics in the Prometheus text format.
+
+        :type remote: list
+        :param remote: Tuples of extra labels and a :meth:`snapshot` received
+                       from another process, rendered with the local ones.
+        """
+        snapshots = [({}, self.snapshot())] + list(remote or [])
+        with self._lock:
+            gauges = list(self._gauges.items())
+            descriptions = dict(self._help)
+
+        lines = []
+        for name, (read, metric_type) in gauges:
+            lines.append('# HELP {} {}'.format(name, descriptions[name]))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            values = read()
+            if not isinstance(values, list):
+                values = [({}, values)]
+            for labels, value in values:
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(labels), value))
+
+        histograms = {}
+        for extra_labels, snapshot in snapshots:
+            for name, entries in snapshot.items():
+                for entry in entries:
+                    labels = dict(entry['labels'])
+                    labels.update(extra_labels)
+                    histograms.setdefault(name, []).append(
+                            (labels, entry['value']))
+
+        for name, entries in sorted(histograms.items()):
+            if name in descriptions:
+                lines.append('# HELP {} {}'.format(
+                    name, descriptions[name]))
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, value in entries:
+                for bound, count in value['buckets']:
+                    bucket_labels = dict(labels)
+                    bucket_labels['le'] = bound
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(bucket_labels), count))
+                bucket_labels = dict(labels)
+                bucket_labels['le'] = '+Inf'
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(bucket_labels), value['count']))
+                lines.append('{}_sum{} {}'.format(
+                    name, _format_labels(labels), value['sum']))
+                lines.append('{}_count{} {}'.format(
+                    name, _format_labels(labels), value['count']))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,264 @@
+import os
+import time
+import queue
+import shutil
+import threading
+import traceback
+from eventlet import tpool
+import database
+
+
+class _FileRemoverThread(threading.Thread):
+    """Remove deleted video files without holding up the retention thread."""
+    def __init__(self, file_queue, error_queue):
+        self._file_queue = file_queue
+        self._error_queue = error_queue
+        super(_FileRemoverThread, self).__init__()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            print('Removed {}'.format(os.path.basename(path)))
+        except FileNotFoundError:
+            print('[WARNING] Video already removed: {}'.format(path))
+
+    def _remove_files(self):
+        while True:
+            path = self._file_queue.get()
+            if path is None:
+                break
+            # Run the blocking remove in a native thread so the eventlet
+            # hub keeps serving clients
+            tpool.execute(self._remove, path)
+
+    def run(self):
+        try:
+            self._remove_files()
+        except Exception as e:
+            tb = traceback.format_exc()
+            self._error_queue.put((e, tb))
+            raise e
+
+
+class RetentionMgr(threading.Thread):
+    """
+    Delete events in batches and keep recordings within their disk budget.
+
+    Deletes requested by users and evictions by the retention policies both
+    run here, so they never block the Rx thread. Rows are deleted in one
+    transaction per batch and the video files are removed afterwards by a
+    separate thread.
+
+    :type tx_queue: :class:`server.CircularQueue`
+    :param tx_queue: The web content Tx queue for disk usage reports.
+    :type error_queue: :class:`queue.Queue`
+    :param error_queue: The server error queue.
+    :type max_age_days: integer
+    :param max_age_days: Delete events older than this many days. No age
+                         limit if None.
+    :type max_bytes: integer
+    :param max_bytes: Delete the oldest events while recordings use more than
+                      this many bytes. No size limit if None.
+    :type min_free_bytes: integer
+    :param min_free_bytes: Delete the oldest events while the recordings disk
+                           has less free space than this. No free space
+                           limit if None.
+    :type check_period: float
+    :param check_period: The time in seconds between policy checks.
+    :type batch_size: integer
+    :param batch_size: The number of events deleted per transaction.
+    """
+    def __init__(
+            self, tx_queue, error_queue, max_age_days=None, max_bytes=None,
+            min_free_bytes=None, check_period=60, batch_size=100):
+        self._request_queue = queue.Queue()
+        self._tx_queue = tx_queue
+        self._error_queue = error_queue
+        self._max_age_days = max_age_days
+        self._max_bytes = max_bytes
+        self._min_free_bytes = min_free_bytes
+        self._check_period = check_period
+        self._batch_size = batch_size
+
+        self._file_queue = queue.Queue()
+        self._file_remover = _FileRemoverThread(
+                self._file_queue, error_queue)
+        self._disk_usage = None
+        super(RetentionMgr, self).__init__()
+
+    def request_delete(self, event_ids):
+        """Queue events for deletion."""
+        self._request_queue.put({'cmd': 'delete', 'ids': list(event_ids)})
+
+    def request_delete_date(self, date):
+        """Queue all events of a date for deletion."""
+        self._request_queue.put({'cmd': 'delete_date', 'date': date})
+
+    def get_disk_usage(self):
+        """Return the latest `update_disk_usage` message, or None."""
+        return self._disk_usage
+
+    def _delete(self, event_ids):
+        """Delete events in batches, returning the number deleted."""
+        num_deleted = 0
+        for i in range(0, len(event_ids), self._batch_size):
+            with database.Database() as db:
+                videos = db.delete_by_ids(
+                        event_ids[i:i + self._batch_size])
+
+            for video in videos:
+                filename = os.path.basename(video['path'])
+                self._file_queue.put(
+                        os.path.join(database.VIDEO_DIR, filename))
+                for preview in (video['thumbnail'], video['keyframes']):
+                    if preview:
+                        self._file_queue.put(
+                                os.path.join(database.THUMBNAIL_DIR, preview))
+                if video['keypoints']:
+                    self._file_queue.put(os.path.join(
+                        database.KEYPOINT_DIR, video['keypoints']))
+            num_deleted += len(videos)
+        return num_deleted
+
+    def _fill_sizes(self):
+        """Record the file size of events added without one."""
+        while True:
+            with database.Database() as db:
+                missing = db.get_missing_sizes(self._batch_size)
+            if len(missing) == 0:
+                break
+
+            sizes = []
+            for event_id, path in missing:
+                path = os.path.join(
+                        database.VIDEO_DIR, os.path.basename(path))
+                try:
+                    sizes.append((event_id, os.path.getsize(path)))
+                except OSError:
+                    sizes.append((event_id, 0))
+            with database.Database() as db:
+                db.set_sizes(sizes)
+
+    def _get_free_bytes(self):
+        if not os.path.exists(database.VIDEO_DIR):
+            os.makedirs(database.VIDEO_DIR)
+        return shutil.disk_usage(database.VIDEO_DIR).free
+
+    def _over_budget(self, used_bytes, free_bytes):
+        if self._max_bytes is not None and used_bytes > self._max_bytes:
+            return True
+        if self._min_free_bytes is not None:
+            return free_bytes < self._min_free_bytes
+        return False
+
+    def _enforce_policies(self):
+        """Evict the oldest events until the policies are met."""
+        num_deleted = 0
+        if self._max_age_days is not None:
+            cutoff = time.strftime(
+                    '%Y-%m-%d',
+                    time.localtime(time.time() - self._max_age_days * 86400))
+            while True:
+                with database.Database() as db:
+                    videos = db.get_oldest(self._batch_size, cutoff)
+                if len(videos) == 0:
+                    break
+                num_deleted += self._delete([v['id'] for v in videos])
+
+        with database.Database() as db:
+            used_bytes, num_events = db.get_usage()
+        # Files are removed asynchronously, so count evicted bytes as freed
+        evicted_bytes = 0
+        while num_events > 0 and self._over_budget(
+                used_bytes, self._get_free_bytes() + evicted_bytes):
+            with database.Database() as db:
+                videos = db.get_oldest(self._batch_size)
+            if len(videos) == 0:
+                # The count was stale, nothing is left to evict
+                break
+            # Only evict as many as needed to get back within budget
+            ids = []
+            for video in videos:
+                ids.append(video['id'])
+                used_bytes -= video['size'] or 0
+                evicted_bytes += video['size'] or 0
+                num_events -= 1
+                if not self._over_budget(
+                        used_bytes, self._get_free_bytes() + evicted_bytes):
+                    break
+            num_deleted += self._delete(ids)
+
+        if num_deleted > 0:
+            print('[INFO] Retention removed {} events'.format(num_deleted))
+        return num_deleted
+
+    def _report_usage(self):
+        with database.Database() as db:
+            used_bytes, num_events = db.get_usage()
+
+        self._disk_usage = {
+                'cmd': 'update_disk_usage',
+                'data': {
+                    'used': used_bytes,
+                    'quota': self._max_bytes,
+                    'free': self._get_free_bytes(),
+                    'num_events': num_events
+                    }
+                }
+        self._tx_queue.put(dict(self._disk_usage))
+
+    def _handle_request(self, data):
+        """Carry out a delete request, returning the number deleted."""
+        if data is None:
+            return 0
+        elif data['cmd'] == 'delete':
+            return self._delete(data['ids'])
+        elif data['cmd'] == 'delete_date':
+            with database.Database() as db:
+                videos = db.get_for_date(data['date'])
+            return self._delete([v['id'] for v in videos])
+        return 0
+
+    def _run_retention(self):
+        next_check = 0
+        while True:
+            num_deleted = 0
+            try:
+                data = self._request_queue.get(
+                        timeout=max(next_check - time.time(), 0.01))
+            except queue.Empty:
+                data = None
+
+            if data is not None and data['cmd'] == 'stop':
+                break
+            try:
+                num_deleted += self._handle_request(data)
+            except Exception:
+                # A bad request must not stop deletes and retention sweeps
+                print('[WARNING] Retention request failed: {}\n{}'.format(
+                    data, traceback.format_exc()))
+
+            if time.time() >= next_check:
+                self._fill_sizes()
+                num_deleted += self._enforce_policies()
+                next_check = time.time() + self._check_period
+
+            if num_deleted > 0:
+                self._tx_queue.put({'cmd': 'notify_db_update'})
+            if (data is not None or num_deleted > 0 or
+                    self._disk_usage is None):
+                self._report_usage()
+
+    def run(self):
+        self._file_remover.start()
+        try:
+            self._run_retention()
+        except Exception as e:
+            tb = traceback.format_exc()
+            self._error_queue.put((e, tb))
+            raise e
+        finally:
+            self._file_queue.put(None)
+
+    def stop(self):
+        self._request_queue.put({'cmd': 'stop'})
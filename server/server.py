@@ -1,20 +1,43 @@
 import os
 import socket
-from flask_socketio import SocketIO
-from flask import Flask, render_template, request
+from flask_socketio import SocketIO, join_room, leave_room
+from flask import (
+        Flask, render_template, request, abort, jsonify, url_for, Response)
+from werkzeug.datastructures import Headers
+from werkzeug.wsgi import wrap_file
 import queue
 import traceback
+import base64
 import eventlet
 import threading
 import database
+import retention
+import metrics
+import keypoints
+import argparse
 import collections
 import time
+import json
+import math
 
 
 eventlet.monkey_patch()
 
 
 _FLASK_APP_ROOT_PATH = os.path.dirname(__file__)
+# Read size when serving recordings, large blocks mean fewer writes
+_RECORDING_BLOCK_SIZE = 1024 * 1024
+# Largest SQLite rowid, larger ids overflow its integers
+_MAX_ROWID = 2 ** 63 - 1
+# Most poses returned by one /keypoints request
+_MAX_KEYPOINT_POSES = 5000
+# Seconds an MJPEG stream waits for a frame before ending
+_MJPEG_TIMEOUT = 10.0
+_MJPEG_BOUNDARY = 'frame'
+# Ends the previous part, a leading CRLF is allowed before the first
+_MJPEG_PART_HEADER = (
+        b'\r\n--' + _MJPEG_BOUNDARY.encode() +
+        b'\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n')
 _app = Flask(
         __name__, root_path=_FLASK_APP_ROOT_PATH,
         static_url_path='/data', static_folder='data')
@@ -25,7 +48,11 @@ DEST_WEB_STREAM = {
         'namespace': '/web-stream',
         'msgs': [
             'update_frame',
-            'update_camera_stats'
+            'update_camera_stats',
+            'update_stream_settings',
+            'update_workout',
+            'update_init',
+            'update_segment'
             ]
         }
 
@@ -35,41 +62,126 @@ DEST_WEB_CONTENT = {
         'msgs': [
             'notify_db_update',
             'update_text',
+            'update_events',
+            'update_page',
+            'update_disk_usage',
             'update_status'
             ]
         }
 
 DEST_SERVER = {}
 
-DEST_CVAPP = {}
+DEST_CVAPP = {
+        'msg-name': 'server-data',
+        'namespace': '/cv',
+        'msgs': [
+            'update_stream_stats'
+            ]
+        }
 
 
 class _RxThread(threading.Thread):
     """Monitor the Rx queue for received messages."""
     def __init__(
-            self, rx_queue, tx_queue, exit_event, error_queue):
+            self, rx_queue, tx_queue, exit_event, error_queue, page_size,
+            cache, retention_mgr, registry):
         self._rx_queue = rx_queue
         self._tx_queue = tx_queue
         self._exit_event = exit_event
         self._error_queue = error_queue
+        self._page_size = page_size
+        self._cache = cache
+        self._retention_mgr = retention_mgr
+        self._query_time = {
+                query: registry.histogram(
+                    'db_query_seconds', 'Event database query time',
+                    {'query': query})
+                for query in ('changes', 'page')}
         super(_RxThread, self).__init__()
 
-    def _query_db(self):
-        with database.Database() as db:
-            videos = db.get_all(organize_by_date=True)
-
-        self._tx_queue.put({'cmd': 'update_text', 'data': videos})
+    def _get_filters(self, data):
+        """Pick the event query filters out of a user message."""
+        filters = {}
+        for key in ['start', 'end', 'num_people', 'camera_id']:
+            if data.get(key, None) is not None:
+                filters[key] = data[key]
+        return filters
+
+    def _load_changes(self, version):
+        with self._query_time['changes'].time():
+            with database.Database() as db:
+                changes = db.get_changes(version)
+
+        if changes is None:
+            return None
+        new_version, inserted, deleted = changes
+        return new_version, json.dumps({
+            'version': new_version, 'inserted': inserted, 'deleted': deleted})
+
+    def _load_page(self, filters, cursor=None):
+        with self._query_time['page'].time():
+            with database.Database() as db:
+                # Read the version first, rows added meanwhile are sent
+                # again in the next update
+                version = db.get_version()
+                videos, cursor = db.query_events(
+                        limit=self._page_size, cursor=cursor, **filters)
+
+        return json.dumps({
+            'version': version, 'events': videos, 'cursor': cursor})
+
+    def _query_db(self, client_id, version, filters):
+        """Send the client the events changed since `version`."""
+        changes = None
+        if version:
+            changes = self._cache.get_listing(
+                    ('changes', version),
+                    lambda: self._load_changes(version))
+
+        if changes is None:
+            data = self._cache.get_listing(
+                    ('page', tuple(sorted(filters.items())), None),
+                    lambda: self._load_page(filters))
+            msg = {'cmd': 'update_text', 'data': data}
+        else:
+            new_version, data = changes
+            if new_version == version:
+                # Client is up to date
+                return
+            msg = {'cmd': 'update_events', 'data': data}
+
+        msg['room'] = client_id
+        self._tx_queue.put(msg)
+
+    def _parse_cursor(self, cursor):
+        """Return a cursor sent by a client as a tuple, None if malformed."""
+        if not isinstance(cursor, list) or len(cursor) != 3:
+            return None
+        date, time, rowid = cursor
+        if (not isinstance(date, str) or not isinstance(time, str) or
+                not isinstance(rowid, int) or isinstance(rowid, bool) or
+                not 0 <= rowid <= _MAX_ROWID):
+            return None
+        return date, time, rowid
+
+    def _parse_date(self, date):
+        """Return a date sent by a client, None if not `YYYY-MM-DD`."""
+        if not isinstance(date, str) or len(date) != 10:
+            return None
+        try:
+            time.strptime(date, '%Y-%m-%d')
+        except ValueError:
+            return None
+        return date
 
-    def _delete_event(self, event_id):
-        with database.Database() as db:
-            video = db.get_for_id(event_id)
-            db.delete_by_id(event_id)
+    def _query_page(self, client_id, cursor, filters):
+        """Send the client the page of events after `cursor`."""
+        data = self._cache.get_listing(
+                ('page', tuple(sorted(filters.items())), cursor),
+                lambda: self._load_page(filters, cursor))
 
-        # Once database delete completes, delete the video file
-        filename = os.path.basename(video['path'])
-        path = os.path.join(database.VIDEO_DIR, filename)
-        os.remove(path)
-        print('Removed {}'.format(filename))
+        self._tx_queue.put({
+            'cmd': 'update_page', 'data': data, 'room': client_id})
 
     def _rx_msg(self):
         while True:
@@ -79,9 +191,40 @@ class _RxThread(threading.Thread):
                 self._exit_event.set()
                 break
             elif data['cmd'] == 'query_db':
-                self._query_db()
+                self._query_db(
+                        data['sid'], data.get('version', 0),
+                        self._get_filters(data))
+            elif data['cmd'] == 'query_page':
+                # Client input, a bad cursor must not stop this thread
+                cursor = self._parse_cursor(data.get('cursor', None))
+                if cursor is None:
+                    print('[WARNING] Ignoring query_page with cursor: '
+                          '{}'.format(data.get('cursor', None)))
+                    continue
+                self._query_page(
+                        data['sid'], cursor, self._get_filters(data))
             elif data['cmd'] == 'delete':
-                self._delete_event(data['data'])
+                # A single id from the video page, a list for bulk deletes
+                event_ids = data.get('data', None)
+                if not isinstance(event_ids, list):
+                    event_ids = [event_ids]
+                try:
+                    event_ids = [int(i) for i in event_ids]
+                except (ValueError, TypeError):
+                    event_ids = None
+                if event_ids is None or not all(
+                        0 < i <= _MAX_ROWID for i in event_ids):
+                    print('[WARNING] Ignoring delete of ids: {}'.format(
+                        data['data']))
+                    continue
+                self._retention_mgr.request_delete(event_ids)
+            elif data['cmd'] == 'delete_date':
+                date = self._parse_date(data.get('data', None))
+                if date is None:
+                    print('[WARNING] Ignoring delete of date: {}'.format(
+                        data.get('data', None)))
+                    continue
+                self._retention_mgr.request_delete_date(date)
 
     def run(self):
         try:
@@ -107,8 +250,13 @@ class _TxThread(threading.Thread):
     def _tx_msg(self):
         while True:
             data = self._tx_queue.get()
+            if data is None:
+                break
+            # Replies to a single client carry its sid
+            room = data.pop('room', None)
             _socketio.emit(
-                    self._msg_name, data, namespace=self._namespace)
+                    self._msg_name, data, namespace=self._namespace,
+                    room=room)
             # Sleep is required for message to be sent
             _socketio.sleep(self._inter_msg_time)
 
@@ -121,6 +269,95 @@ class _TxThread(threading.Thread):
             raise e
 
 
+class _StreamClientTxThread(threading.Thread):
+    """
+    Send live feed frames to a single web client.
+
+    The client has a one frame slot, so a slow client only drops its own
+    frames. The next frame is sent once the client acknowledges the previous
+    one, or after the ack timeout. Only frames of the camera the client
+    subscribed to are put in its slot.
+    """
+    def __init__(
+            self, client_id, msg_name, namespace, ack_timeout, error_queue,
+            latency_histogram=None, init_segments=None):
+        self.client_id = client_id
+        self._msg_name = msg_name
+        self._namespace = namespace
+        self._ack_timeout = ack_timeout
+        self._error_queue = error_queue
+        self._latency_histogram = latency_histogram
+        self._init_segments = init_segments
+        self._sent_init = None
+
+        self._slot = CircularQueue(1)
+        self._ack_event = threading.Event()
+        self.camera_id = None
+        self.delivered = 0
+        self.latency = None
+        super(_StreamClientTxThread, self).__init__()
+        self.daemon = True
+
+    @property
+    def dropped(self):
+        return self._slot.drops
+
+    @property
+    def pending(self):
+        return len(self._slot)
+
+    def put(self, message):
+        self._slot.put(message)
+
+    def ack(self, ts):
+        """Record the acknowledgement of the frame received at `ts`."""
+        latency = time.time() - ts
+        if self._latency_histogram is not None:
+            self._latency_histogram.observe(latency)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        self.delivered += 1
+        self._ack_event.set()
+
+    def stop(self):
+        self._slot.close()
+        self._ack_event.set()
+
+    def _tx_msg(self):
+        while True:
+            data = self._slot.get()
+            if data is None:
+                break
+
+            if (data['cmd'] == 'update_segment' and
+                    self._init_segments is not None):
+                init = self._init_segments.get(data['camera_id'], None)
+                if init is not None and init is not self._sent_init:
+                    # Before the first segment, and when the camera
+                    # restarts its encoder
+                    _socketio.emit(
+                            self._msg_name, init, namespace=self._namespace,
+                            room=self.client_id)
+                    self._sent_init = init
+
+            self._ack_event.clear()
+            _socketio.emit(
+                    self._msg_name, data, namespace=self._namespace,
+                    room=self.client_id)
+            # Waiting also yields so the message is sent
+            self._ack_event.wait(self._ack_timeout)
+
+    def run(self):
+        try:
+            self._tx_msg()
+        except Exception as e:
+            tb = traceback.format_exc()
+            self._error_queue.put((e, tb))
+            raise e
+
+
 class ConnectionMgr:
     def __init__(self):
         self._connections = {
@@ -128,6 +365,10 @@ class ConnectionMgr:
                 '/web-stream': [],
                 '/cv': []
                 }
+        # Tx thread with the latest frame slot of each live feed client
+        self._stream_clients = {}
+        # Camera id of each CV app connection
+        self._cameras = {}
         # Mgr will potentially be used across mutliple threads
         self._lock = threading.Lock()
 
@@ -155,6 +396,56 @@ class ConnectionMgr:
         print('[INFO] Client disconnected: {}:{}'.format(
                     namespace, client_id))
 
+    def add_stream_client(self, tx_thread):
+        with self._lock:
+            self._stream_clients[tx_thread.client_id] = tx_thread
+        tx_thread.start()
+
+    def remove_stream_client(self, client_id):
+        with self._lock:
+            tx_thread = self._stream_clients.pop(client_id, None)
+
+        if tx_thread is not None:
+            tx_thread.stop()
+            print('[INFO] Stream client {}: {} delivered, {} dropped'.format(
+                client_id, tx_thread.delivered, tx_thread.dropped))
+
+    def get_stream_client(self, client_id):
+        with self._lock:
+            return self._stream_clients.get(client_id, None)
+
+    def get_stream_clients(self, camera_id=None):
+        """Return the live feed clients subscribed to `camera_id`, or all."""
+        with self._lock:
+            return [
+                    c for c in self._stream_clients.values()
+                    if camera_id is None or c.camera_id == camera_id]
+
+    def add_camera(self, client_id, camera_id):
+        with self._lock:
+            self._cameras[client_id] = camera_id
+        print('[INFO] Camera connected: {}:{}'.format(camera_id, client_id))
+
+    def remove_camera(self, client_id):
+        """Forget a CV app connection, returning its camera id or None."""
+        with self._lock:
+            camera_id = self._cameras.pop(client_id, None)
+        if camera_id is not None:
+            print('[INFO] Camera disconnected: {}:{}'.format(
+                camera_id, client_id))
+        return camera_id
+
+    def close_stream_clients(self):
+        """Stop the Tx threads of all live feed clients."""
+        with self._lock:
+            tx_threads = list(self._stream_clients.values())
+            self._stream_clients = {}
+
+        for tx_thread in tx_threads:
+            tx_thread.stop()
+        for tx_thread in tx_threads:
+            tx_thread.join()
+
     def get_num_connections(self, namespace):
         with self._lock:
             c = self._connections.get(namespace, None)
@@ -165,19 +456,267 @@ class ConnectionMgr:
 
 
 class CircularQueue:
-    """Thread-safe circular queue using a deque."""
+    """
+    Thread-safe circular queue that blocks readers until data arrives.
+
+    When full, putting an item drops the oldest one. Readers wait on a
+    condition variable, which is green under `eventlet.monkey_patch()`, so
+    they wake as soon as an item is put and cost nothing while idle.
+    """
     def __init__(self, max_size=None):
         self._queue = collections.deque(maxlen=max_size)
+        self._cond = threading.Condition()
+        self._closed = False
+        self.drops = 0
 
-    def put(self, item):
-        self._queue.appendleft(item)
+    def __len__(self):
+        return len(self._queue)
 
-    def get(self):
-        while True:
+    def put(self, item):
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._queue) == self._queue.maxlen:
+                self.drops += 1
+            self._queue.appendleft(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Return the oldest item, waiting for one to be put if empty.
+
+        :returns: None if the queue was closed or the timeout expired.
+        """
+        with self._cond:
+            if timeout is not None:
+                end = time.time() + timeout
+            while len(self._queue) == 0 and not self._closed:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+
+            if self._closed:
+                return None
+            return self._queue.pop()
+
+    def get_nowait(self):
+        with self._cond:
             try:
                 return self._queue.pop()
             except IndexError:
-                time.sleep(0.01)
+                raise queue.Empty
+
+    def close(self):
+        """Drop pending items and wake all readers."""
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+
+
+class LiveFrameBuffer:
+    """
+    Hold the latest live feed frame of each camera for MJPEG viewers.
+
+    The `update_frame` message relayed to socket.io clients is stored by
+    reference, so every viewer writes the bytes the CV app sent without a
+    copy or re-encode. Base64 frames are decoded once, by the first viewer
+    that needs them. Viewers wait on a green condition variable and skip
+    frames they were too slow to write, like a socket.io client's one frame
+    slot.
+    """
+    def __init__(self):
+        # Camera id to a list of the sequence number, message and JPEG
+        self._frames = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self.viewers = 0
+
+    def put(self, camera_id, message):
+        with self._cond:
+            self._seq += 1
+            self._frames[camera_id] = [self._seq, message, None]
+            self._cond.notify_all()
+
+    def remove(self, camera_id):
+        """Drop the camera's frame, ending the streams of its viewers."""
+        with self._cond:
+            self._frames.pop(camera_id, None)
+            self._cond.notify_all()
+
+    def wait(self, camera_id, seq=0, timeout=None):
+        """
+        Wait for a frame newer than the one numbered `seq`.
+
+        :returns: A tuple of the frame's sequence number and JPEG bytes, or
+                  None if the timeout expired or the camera went offline
+                  after sending frames.
+        """
+        with self._cond:
+            if timeout is not None:
+                end = time.time() + timeout
+            while True:
+                frame = self._frames.get(camera_id, None)
+                if frame is None and seq > 0:
+                    return None
+                if frame is not None and frame[0] > seq:
+                    break
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+
+            if frame[2] is None:
+                data = frame[1]['data']
+                if isinstance(data, str):
+                    # A base64 data URI from --base64-frames
+                    data = base64.b64decode(data.partition(',')[2])
+                frame[2] = data
+            return frame[0], frame[2]
+
+
+class EventCache:
+    """
+    Cache of serialized event listings and per id event lookups.
+
+    Listings are stored as JSON strings, so the many clients asking for the
+    same listing after an update cost one query and one serialization. Any
+    change to the events clears the listings, a delete also clears the
+    lookup of that event.
+
+    :type max_size: integer
+    :param max_size: The number of listings and of events to keep, least
+                     recently used ones are evicted first.
+    """
+    def __init__(self, max_size=256):
+        self._max_size = max_size
+        self._listings = collections.OrderedDict()
+        self._entries = collections.OrderedDict()
+        # Incremented on every invalidation so loads that raced with a
+        # change are not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, cache, key, load):
+        with self._lock:
+            if key in cache:
+                self.hits += 1
+                cache.move_to_end(key)
+                return cache[key]
+            self.misses += 1
+            generation = self._generation
+
+        value = load()
+        with self._lock:
+            if generation == self._generation:
+                cache[key] = value
+                if len(cache) > self._max_size:
+                    cache.popitem(last=False)
+        return value
+
+    def get_listing(self, key, load):
+        """Return the listing for `key`, calling `load()` on a miss."""
+        return self._get(self._listings, key, load)
+
+    def get_entry(self, event_id, load):
+        """
+        Return the event with `event_id`, calling `load()` on a miss.
+
+        Unknown ids are not cached, since the CV app may add them later.
+        """
+        entry = self._get(self._entries, event_id, load)
+        if entry is None:
+            with self._lock:
+                self._entries.pop(event_id, None)
+        return entry
+
+    def invalidate(self, op=None, event_id=None):
+        """
+        Drop the listings and the changed event after a change.
+
+        Without an `event_id`, as for changes made by the CV app, any event
+        may have changed, so all of them are dropped.
+        """
+        with self._lock:
+            self._generation += 1
+            self._listings.clear()
+            if event_id is not None:
+                self._entries.pop(event_id, None)
+            else:
+                self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'listings': len(self._listings),
+                    'entries': len(self._entries)
+                    }
+
+
+class StreamStats:
+    """
+    Collect live feed delivery stats to report back to the CV app.
+
+    Latency and drops are reported for the median client, so a single slow
+    viewer does not lower the stream quality for everyone.
+
+    :type report_period: float
+    :param report_period: The minimum time in seconds between reports.
+    """
+    def __init__(self, report_period=1.0):
+        self._report_period = report_period
+        self._last_report = time.time()
+        # Drop count of each client at the previous report
+        self._last_drops = {}
+        self._lock = threading.Lock()
+
+    def get_report(self, stream_clients):
+        """Return an `update_stream_stats` message if one is due."""
+        with self._lock:
+            now = time.time()
+            if now - self._last_report < self._report_period:
+                return None
+            self._last_report = now
+
+            drops = []
+            last_drops = {}
+            for c in stream_clients:
+                last_drops[c.client_id] = c.dropped
+                drops.append(
+                        c.dropped - self._last_drops.get(c.client_id, 0))
+            self._last_drops = last_drops
+
+        latencies = sorted(
+                c.latency for c in stream_clients if c.latency is not None)
+        clients = {}
+        for c in stream_clients:
+            clients[c.client_id] = {
+                    'delivered': c.delivered,
+                    'dropped': c.dropped,
+                    'latency': c.latency
+                    }
+
+        return {
+                'cmd': 'update_stream_stats',
+                'queue_depth': sum(c.pending for c in stream_clients),
+                'drops': sorted(drops)[len(drops) // 2] if drops else 0,
+                'latency': (
+                    latencies[len(latencies) // 2] if latencies else None),
+                'max_latency': latencies[-1] if latencies else None,
+                'num_clients': len(stream_clients),
+                'clients': clients
+                }
 
 
 class WebInterface(object):
@@ -193,19 +732,46 @@ class WebInterface(object):
     :type drop_frames: boolean
     :param drop_frames: Indicates whether :func:`~send_data()` should block
                         when queue is full or drop frames.
+    :type ack_timeout: float
+    :param ack_timeout: The time in seconds to wait for a live feed client to
+                        acknowledge a frame before sending it the next one.
+    :type page_size: integer
+    :param page_size: The number of events sent to a web client at a time.
+    :type max_age_days: integer
+    :param max_age_days: Delete recordings older than this many days.
+    :type max_bytes: integer
+    :param max_bytes: Delete the oldest recordings while they use more than
+                      this many bytes.
+    :type min_free_bytes: integer
+    :param min_free_bytes: Delete the oldest recordings while the disk has
+                           less free space than this.
+    :type max_transfer_rate: integer
+    :param max_transfer_rate: Bytes per second each recording is served at,
+                              so playback can't starve the live feed. None
+                              for no limit.
+    :type port: integer
+    :param port: The port to serve on.
     """
     def __init__(
-            self, queue_depth=2, inter_msg_time=0, drop_frames=True):
+            self, queue_depth=2, inter_msg_time=0, drop_frames=True,
+            ack_timeout=1.0, page_size=50, max_age_days=None,
+            max_bytes=None, min_free_bytes=None,
+            max_transfer_rate=4 * 1024 * 1024, port=5000):
         # Bind to all interfaces
         self._ipaddr = '0.0.0.0'
-        self._port = 5000
+        self._port = port
         self._queue_depth = queue_depth
         self._inter_msg_time = inter_msg_time
         self._drop_frames = drop_frames
+        self._ack_timeout = ack_timeout
+        self._page_size = page_size
+        self._max_transfer_rate = max_transfer_rate
 
         # Rx and Tx queues are used only by server process
-        self._content_tx_queue = queue.Queue()
-        self._stream_tx_queue = CircularQueue(2)
+        self._content_tx_queue = CircularQueue()
+        # Frames go to per client slots, this queue is for other messages
+        self._stream_tx_queue = CircularQueue()
+        self._cv_tx_queue = CircularQueue()
         self._rx_queue = queue.Queue()
 
         # Error queue is shared between server process and CV process
@@ -215,13 +781,24 @@ class WebInterface(object):
         # Exit event is used only in server process
         self._exit_event = threading.Event()
 
+        self._metrics = metrics.Registry()
+        self._event_cache = EventCache()
+        database.add_change_listener(self._event_cache.invalidate)
+
+        self._retention_mgr = retention.RetentionMgr(
+                self._content_tx_queue, self._error_queue,
+                max_age_days=max_age_days, max_bytes=max_bytes,
+                min_free_bytes=min_free_bytes)
+
         self._rx_thread = _RxThread(
                 self._rx_queue, self._content_tx_queue, self._exit_event,
-                self._error_queue)
+                self._error_queue, self._page_size, self._event_cache,
+                self._retention_mgr, self._metrics)
 
     def setup(self):
         """Setup and start the web server."""
         self._rx_thread.start()
+        self._retention_mgr.start()
 
         _app.config['CONTENT_TX_QUEUE'] = self._content_tx_queue
         _app.config['CONTENT_TX_THREAD'] = _TxThread(
@@ -235,15 +812,84 @@ class WebInterface(object):
                 DEST_WEB_STREAM['namespace'], self._inter_msg_time,
                 self._error_queue)
 
+        _app.config['CV_TX_QUEUE'] = self._cv_tx_queue
+        _app.config['CV_TX_THREAD'] = _TxThread(
+                self._cv_tx_queue, DEST_CVAPP['msg-name'],
+                DEST_CVAPP['namespace'], self._inter_msg_time,
+                self._error_queue)
+        # Stream stats of each camera, reported to its CV app
+        _app.config['STREAM_STATS'] = collections.defaultdict(StreamStats)
+        _app.config['ACK_TIMEOUT'] = self._ack_timeout
+        _app.config['ERROR_QUEUE'] = self._error_queue
+
         _app.config['RX_QUEUE'] = self._rx_queue
-        _app.config['CAMERA_STATUS'] = 'Offline'
+        _app.config['EVENT_CACHE'] = self._event_cache
+        _app.config['RETENTION_MGR'] = self._retention_mgr
+        # Status of each camera that has connected
+        _app.config['CAMERA_STATUS'] = {}
+        # Last fragmented MP4 initialization segment of each camera
+        _app.config['LIVE_INIT'] = {}
+        # Last stream settings of each camera, for viewers that subscribe
+        # after they changed
+        _app.config['STREAM_SETTINGS'] = {}
+        # Latest JPEG frame of each camera, shared by MJPEG viewers
+        _app.config['LIVE_FRAMES'] = LiveFrameBuffer()
         _app.config['CONNECTION_MGR'] = ConnectionMgr()
+        _app.config['RECORDING_RATE'] = self._max_transfer_rate
+        _app.config['METRICS'] = self._metrics
+        # Latest pipeline metrics pushed by each camera
+        _app.config['CAMERA_METRICS'] = {}
+        self._add_gauges()
 
         print(
                 '[INFO] Web interface started at http://localhost:{}'.format(
                         self._port))
         _socketio.run(app=_app, host=self._ipaddr, port=self._port)
 
+    def _add_gauges(self):
+        """Register the queue depth gauges and drop counters for `/metrics`."""
+        queues = {
+                'content_tx': self._content_tx_queue,
+                'stream_tx': self._stream_tx_queue,
+                'cv_tx': self._cv_tx_queue
+                }
+        connection_mgr = _app.config['CONNECTION_MGR']
+        camera_metrics = _app.config['CAMERA_METRICS']
+        live_frames = _app.config['LIVE_FRAMES']
+
+        def _queue_depths():
+            depths = [({'queue': k}, len(q)) for k, q in queues.items()]
+            depths.append(({'queue': 'rx'}, self._rx_queue.qsize()))
+            for c in connection_mgr.get_stream_clients():
+                depths.append(({'queue': 'client', 'client': c.client_id},
+                               c.pending))
+            return depths
+
+        def _drops():
+            drops = [({'queue': k}, q.drops) for k, q in queues.items()]
+            for c in connection_mgr.get_stream_clients():
+                drops.append(({'queue': 'client', 'client': c.client_id},
+                              c.dropped))
+            for camera_id, m in camera_metrics.items():
+                for slot, count in m['drops'].items():
+                    drops.append(({'camera': camera_id, 'slot': slot}, count))
+            return drops
+
+        self._metrics.gauge(
+                'queue_depth', 'Messages waiting in a queue', _queue_depths)
+        self._metrics.counter(
+                'dropped_total', 'Messages or frames dropped by a queue',
+                _drops)
+        self._metrics.counter(
+                'event_cache_hits_total', 'Event cache hits',
+                lambda: self._event_cache.hits)
+        self._metrics.counter(
+                'event_cache_misses_total', 'Event cache misses',
+                lambda: self._event_cache.misses)
+        self._metrics.gauge(
+                'mjpeg_viewers', 'Clients streaming a live feed as MJPEG',
+                lambda: live_frames.viewers)
+
     def _check_for_errors(self):
         try:
             error, traceback = self._error_queue.get_nowait()
@@ -262,8 +908,19 @@ class WebInterface(object):
 
     def close(self):
         """Stop the web server."""
-        self._empty_queue(self._content_tx_queue)
-        self._empty_queue(self._stream_tx_queue)
+        # Closing the Tx queues stops the Tx threads
+        self._content_tx_queue.close()
+        self._stream_tx_queue.close()
+        self._cv_tx_queue.close()
+        for name in ['CONTENT_TX_THREAD', 'STREAM_TX_THREAD', 'CV_TX_THREAD']:
+            tx_thread = _app.config.get(name, None)
+            if tx_thread is not None and tx_thread.is_alive():
+                tx_thread.join()
+
+        connection_mgr = _app.config.get('CONNECTION_MGR', None)
+        if connection_mgr is not None:
+            connection_mgr.close_stream_clients()
+
         self._empty_queue(self._error_queue)
 
         # Send the stop command to the Rx thread
@@ -271,6 +928,10 @@ class WebInterface(object):
             self._rx_queue.put({'cmd': 'stop'})
             self._rx_thread.join()
 
+        if self._retention_mgr.is_alive():
+            self._retention_mgr.stop()
+            self._retention_mgr.join()
+
     def __enter__(self):
         self.setup()
         return self
@@ -287,27 +948,255 @@ def _index():
             'index.html', hostname=hostname)
 
 
-@_app.route('/video/<video_id>')
+@_app.route('/video/<int:video_id>')
 def _video(video_id):
     """Video replay page."""
     hostname = socket.gethostname()
 
-    with database.Database() as db:
-        result = db.get_for_id(video_id)
+    def _load():
+        with database.Database() as db:
+            return db.get_for_id(video_id)
+
+    result = _app.config['EVENT_CACHE'].get_entry(video_id, _load)
+    if result is None:
+        abort(404)
 
     video_filename = os.path.basename(result['path'])
-    video_path = os.path.join('recordings', video_filename)
+    video_url = url_for('_recording', filename=video_filename)
+    previews = {}
+    for key in ('thumbnail', 'keyframes'):
+        previews[key + '_url'] = None
+        if result[key]:
+            previews[key + '_url'] = url_for(
+                    'static', filename='thumbnails/' + result[key])
 
     return render_template(
             'video.html', hostname=hostname,
             date=result['date'], time=result['time'],
             num_people=result['num_people'], video_filename=video_filename,
-            video_path=video_path)
+            camera_id=result['camera_id'], video_url=video_url, **previews)
 
 
-def update_camera_status(new_status=None):
-    if new_status is not None:
-        _app.config['CAMERA_STATUS'] = new_status
+class _ThrottledFile:
+    """
+    A file read no faster than `rate` bytes per second.
+
+    Disk reads don't yield to other green threads, so reads after the first
+    sleep, which does, until the bytes read so far are due. Each transfer
+    then takes a bounded share of the server however many run at once, and
+    the live feed is sent in between. Seeking, as for a range request,
+    starts the count again so the first block after it is not delayed.
+    """
+    def __init__(self, file, rate):
+        self._file = file
+        self._rate = rate
+        self._start = None
+        self._bytes = 0
+
+    def read(self, size=-1):
+        now = time.time()
+        if self._start is None:
+            self._start = now
+        else:
+            delay = self._start + self._bytes / self._rate - now
+            if delay > 0:
+                time.sleep(delay)
+        data = self._file.read(size)
+        self._bytes += len(data)
+        return data
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._start = None
+        self._bytes = 0
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+@_app.route('/recordings/<filename>')
+def _recording(filename):
+    """
+    Serve a recording with Range, ETag and Last-Modified support.
+
+    With `USE_X_SENDFILE` set, the front end server sends the file itself.
+    Otherwise the file goes to the WSGI server's file wrapper in large
+    blocks, and range requests seek to the offset instead of reading up to
+    it. Each transfer is limited to `RECORDING_RATE` bytes per second, so
+    playback can't starve the live feed however many players there are.
+    The blocks are still read and written by this process; only X-Sendfile
+    hands the file to the front end server without copying it through here.
+    """
+    path = os.path.join(database.VIDEO_DIR, os.path.basename(filename))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        abort(404)
+
+    headers = Headers()
+    if _app.use_x_sendfile:
+        headers['X-Sendfile'] = path
+        data = None
+    else:
+        file = open(path, 'rb')
+        rate = _app.config['RECORDING_RATE']
+        if rate is not None:
+            file = _ThrottledFile(file, rate)
+        data = wrap_file(
+                request.environ, file, buffer_size=_RECORDING_BLOCK_SIZE)
+
+    response = _app.response_class(
+            data, mimetype='video/mp4', headers=headers,
+            direct_passthrough=True)
+    response.content_length = stat.st_size
+    response.last_modified = stat.st_mtime
+    response.cache_control.public = True
+    response.set_etag('{}-{}-{}'.format(
+        int(stat.st_mtime), stat.st_size, stat.st_ino))
+    if _app.use_x_sendfile:
+        # The front end server handles ranges on the file it sends
+        return response.make_conditional(request)
+    return response.make_conditional(
+            request, accept_ranges=True, complete_length=stat.st_size)
+
+
+@_app.route('/keypoints/<int:video_id>')
+def _keypoints(video_id):
+    """
+    Poses of an event in a time range, read from its keypoint archive.
+
+    `start` and `end` are seconds from the first pose, and at most `limit`
+    poses are returned. Times in the response are relative too, and `next`
+    is the `start` of the following poses when the limit cut them off. The
+    poses of a frame are kept together, unless a frame alone has more than
+    `limit`; the rest of that frame is then skipped.
+    """
+    def _load():
+        with database.Database() as db:
+            return db.get_for_id(video_id)
+
+    result = _app.config['EVENT_CACHE'].get_entry(video_id, _load)
+    if result is None or not result['keypoints']:
+        abort(404)
+
+    start = request.args.get('start', None, type=float)
+    end = request.args.get('end', None, type=float)
+    limit = max(min(
+            request.args.get('limit', _MAX_KEYPOINT_POSES, type=int),
+            _MAX_KEYPOINT_POSES), 1)
+    path = os.path.join(
+            database.KEYPOINT_DIR, os.path.basename(result['keypoints']))
+    try:
+        archive = keypoints.KeypointArchive(path)
+    except (OSError, ValueError):
+        abort(404)
+
+    with archive:
+        time_range = archive.time_range()
+        if time_range is None:
+            return jsonify({'id': video_id, 'poses': [], 'next': None})
+        first = time_range[0]
+        poses = archive.query(
+                None if start is None else first + start,
+                None if end is None else first + end, limit + 1)
+
+        next_start = None
+        if len(poses) > limit:
+            next_pose = poses.pop()
+            next_time = next_pose['t']
+            if poses[0]['t'] != next_time:
+                # The poses of a frame share its time, keep them together
+                while poses[-1]['t'] == next_time:
+                    poses.pop()
+            else:
+                # One frame filled the page, continuing from it would
+                # return the same poses again
+                next_time = archive.next_time(next_time)
+                if next_time is not None and end is not None and (
+                        next_time >= first + end):
+                    next_time = None
+            if next_time is not None:
+                next_start = next_time - first
+    for pose in poses:
+        pose['t'] -= first
+    return jsonify({
+        'id': video_id,
+        'start': first,
+        'duration': time_range[1] - first,
+        'num_keypoints': archive.num_keypoints,
+        'poses': poses,
+        'next': next_start
+        })
+
+
+@_app.route('/live/<camera_id>.mjpg')
+def _live_mjpeg(camera_id):
+    """
+    Stream a camera's live feed as multipart MJPEG.
+
+    Each part is the JPEG the CV app encoded, so NVRs and `<img>` tags can
+    watch a camera without the socket.io client. The stream ends when the
+    camera goes offline or sends no JPEG frames for a while, as with
+    `--live-mode fmp4`.
+    """
+    if camera_id not in _app.config['CAMERA_STATUS']:
+        abort(404)
+    live_frames = _app.config['LIVE_FRAMES']
+
+    def _generate():
+        live_frames.viewers += 1
+        try:
+            seq = 0
+            while True:
+                frame = live_frames.wait(camera_id, seq, _MJPEG_TIMEOUT)
+                if frame is None:
+                    break
+                seq, jpeg = frame
+                # Written as is, the header carries the previous part's end
+                yield _MJPEG_PART_HEADER % len(jpeg)
+                yield jpeg
+        finally:
+            live_frames.viewers -= 1
+
+    response = Response(
+            _generate(),
+            mimetype='multipart/x-mixed-replace; boundary={}'.format(
+                _MJPEG_BOUNDARY))
+    response.cache_control.no_cache = True
+    response.cache_control.no_store = True
+    return response
+
+
+@_app.route('/metrics')
+def _metrics():
+    """Server and camera pipeline metrics in the Prometheus text format."""
+    remote = []
+    for camera_id, m in _app.config['CAMERA_METRICS'].items():
+        remote.append(({'camera': camera_id}, m['histograms']))
+    return Response(
+            _app.config['METRICS'].render(remote),
+            mimetype='text/plain; version=0.0.4')
+
+
+@_app.route('/stats/cache')
+def _cache_stats():
+    """Event cache hit and miss counters."""
+    return jsonify(_app.config['EVENT_CACHE'].get_stats())
+
+
+def _camera_room(camera_id):
+    return 'camera-{}'.format(camera_id)
+
+
+def update_camera_status(camera_id=None, new_status=None):
+    if camera_id is not None:
+        _app.config['CAMERA_STATUS'][camera_id] = new_status
 
     _app.config['CONTENT_TX_QUEUE'].put(
             {'cmd': 'update_status', 'data': _app.config['CAMERA_STATUS']})
@@ -324,6 +1213,11 @@ def _connect_web_content():
     connection_mgr.add_connection('/web-content', request.sid)
 
     update_camera_status()
+    disk_usage = _app.config['RETENTION_MGR'].get_disk_usage()
+    if disk_usage is not None:
+        disk_usage = dict(disk_usage)
+        disk_usage['room'] = request.sid
+        _app.config['CONTENT_TX_QUEUE'].put(disk_usage)
 
 
 @_socketio.on('disconnect', namespace='/web-content')
@@ -341,41 +1235,128 @@ def _connect_web_stream():
             tx_thread.start()
 
     connection_mgr.add_connection('/web-stream', request.sid)
+    connection_mgr.add_stream_client(_StreamClientTxThread(
+        request.sid, DEST_WEB_STREAM['msg-name'],
+        DEST_WEB_STREAM['namespace'], _app.config['ACK_TIMEOUT'],
+        _app.config['ERROR_QUEUE'],
+        _app.config['METRICS'].histogram(
+            'relay_latency_seconds',
+            'Time from the server receiving a frame to the client ack'),
+        _app.config['LIVE_INIT']))
 
 
 @_socketio.on('disconnect', namespace='/web-stream')
 def _disconnect_web_stream():
     connection_mgr = _app.config['CONNECTION_MGR']
     connection_mgr.remove_connection('/web-stream', request.sid)
+    connection_mgr.remove_stream_client(request.sid)
 
 
 @_socketio.on('connect', namespace='/cv')
 def _connect_cv():
     connection_mgr = _app.config['CONNECTION_MGR']
+    if connection_mgr.get_num_connections('/cv') == 0:
+        tx_thread = _app.config['CV_TX_THREAD']
+        if not tx_thread.is_alive():
+            tx_thread.start()
+
     connection_mgr.add_connection('/cv', request.sid)
-    update_camera_status('Online')
+    # Connections without a camera id only send notifications
+    camera_id = request.args.get('camera_id', None)
+    if camera_id is not None:
+        connection_mgr.add_camera(request.sid, camera_id)
+        update_camera_status(camera_id, 'Online')
 
 
 @_socketio.on('disconnect', namespace='/cv')
 def _disconnect_cv():
     connection_mgr = _app.config['CONNECTION_MGR']
-    connection_mgr.remove_connection('/web-stream', request.sid)
-    update_camera_status('Offline')
+    connection_mgr.remove_connection('/cv', request.sid)
+    camera_id = connection_mgr.remove_camera(request.sid)
+    if camera_id is not None:
+        _app.config['LIVE_INIT'].pop(camera_id, None)
+        _app.config['STREAM_SETTINGS'].pop(camera_id, None)
+        _app.config['LIVE_FRAMES'].remove(camera_id)
+        update_camera_status(camera_id, 'Offline')
 
 
 @_socketio.on('user-cmd', namespace='/web-content')
 def _handle_message_from_user(message):
+    message['sid'] = request.sid
     _app.config['RX_QUEUE'].put(message)
 
 
+@_socketio.on('user-cmd', namespace='/web-stream')
+def _handle_stream_message_from_user(message):
+    connection_mgr = _app.config['CONNECTION_MGR']
+    tx_thread = connection_mgr.get_stream_client(request.sid)
+    if tx_thread is None:
+        return
+
+    if message['cmd'] == 'frame_ack':
+        ts = message.get('ts', None)
+        # Sent by the browser, an ack without a usable time is ignored
+        if (isinstance(ts, (int, float)) and not isinstance(ts, bool) and
+                math.isfinite(ts)):
+            tx_thread.ack(ts)
+    elif message['cmd'] == 'subscribe':
+        # Frames are filtered per client, other stream messages go to the
+        # camera's room
+        if tx_thread.camera_id is not None:
+            leave_room(_camera_room(tx_thread.camera_id))
+        tx_thread.camera_id = message['camera_id']
+        join_room(_camera_room(tx_thread.camera_id))
+        settings = _app.config['STREAM_SETTINGS'].get(
+                tx_thread.camera_id, None)
+        if settings is not None:
+            # A copy, the Tx thread pops the room of what it sends
+            _app.config['STREAM_TX_QUEUE'].put(
+                    dict(settings, room=request.sid))
+
+
 @_socketio.on('cv-cmd')
 def _handle_message_from_cv_app(message):
     connection_mgr = _app.config['CONNECTION_MGR']
     if message['cmd'] in DEST_WEB_CONTENT['msgs']:
+        if message['cmd'] == 'notify_db_update':
+            # The CV app changed the events in its own process
+            _app.config['EVENT_CACHE'].invalidate()
         _app.config['CONTENT_TX_QUEUE'].put(message)
     elif message['cmd'] in DEST_WEB_STREAM['msgs']:
-        if connection_mgr.get_num_connections('/web-stream') > 0:
+        camera_id = message.get('camera_id', None)
+        stream_clients = connection_mgr.get_stream_clients(camera_id)
+        if message['cmd'] == 'update_camera_stats':
+            # Histograms are served from /metrics, not sent to browsers
+            camera_metrics = message.pop('metrics', None)
+            if camera_metrics is not None:
+                _app.config['CAMERA_METRICS'][camera_id] = camera_metrics
+        elif message['cmd'] == 'update_stream_settings':
+            # Sent only on change, later viewers get it on subscribe
+            _app.config['STREAM_SETTINGS'][camera_id] = dict(message)
+
+        if message['cmd'] in ('update_frame', 'update_segment'):
+            # Frames are relayed untouched, binary attachments stay binary.
+            # Receive time lets web clients report delivery latency.
+            message['ts'] = time.time()
+            for tx_thread in stream_clients:
+                tx_thread.put(message)
+            if message['cmd'] == 'update_frame':
+                # The same message, MJPEG viewers share it with the relay
+                _app.config['LIVE_FRAMES'].put(camera_id, message)
+        elif message['cmd'] == 'update_init':
+            # Sent by each client's Tx thread ahead of its first segment
+            _app.config['LIVE_INIT'][camera_id] = message
+        elif len(stream_clients) > 0:
+            if camera_id is not None:
+                message['room'] = _camera_room(camera_id)
             _app.config['STREAM_TX_QUEUE'].put(message)
+
+        report = _app.config['STREAM_STATS'][camera_id].get_report(
+                stream_clients)
+        if report is not None:
+            # Only the camera's own CV app adapts to its viewers
+            report['room'] = request.sid
+            _app.config['CV_TX_QUEUE'].put(report)
     elif message['cmd'] in DEST_SERVER:
         _app.config['RX_QUEUE'].put(message)
     else:
@@ -385,7 +1366,24 @@ def _handle_message_from_cv_app(message):
 
 
 if __name__ == "__main__":
-    web_interface = WebInterface()
+    parser = argparse.ArgumentParser(description='BetterWorkout server')
+    parser.add_argument(
+            '--max-age-days', type=int, default=None,
+            help='Delete recordings older than this many days')
+    parser.add_argument(
+            '--max-gb', type=float, default=None,
+            help='Delete the oldest recordings above this many GB')
+    parser.add_argument(
+            '--min-free-gb', type=float, default=None,
+            help='Delete the oldest recordings below this much free space')
+    args = parser.parse_args()
+
+    gb = 1024 ** 3
+    web_interface = WebInterface(
+            max_age_days=args.max_age_days,
+            max_bytes=int(args.max_gb * gb) if args.max_gb else None,
+            min_free_bytes=(
+                int(args.min_free_gb * gb) if args.min_free_gb else None))
     try:
         web_interface.setup()
     finally: